@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import itertools
 from torch.nn import init
-from torch.autograd import Variable
 import torch.nn.functional as F
 
 import random
@@ -14,10 +13,41 @@ Set of modules for aggregating embeddings of neighbors.
 These modules take as input embeddings of neighbors.
 """
 
+def _sample_neighs(to_neighs, keep_prob, max_keep):
+    """
+    Samples without replacement up to max_keep neighbors of every node, keeping
+    ceil(keep_prob * number of neighbors) of them.
+    Returns the sampled neighbors flattened and the offset of every node's bag in them.
+    """
+    _int = int
+    _min = min
+    _len = len
+    _ceil = math.ceil
+    _sample = random.sample
+    samp_neighs = [_sample(list(to_neigh),
+                    _min(_int(_ceil(_len(to_neigh)*keep_prob)), max_keep)
+                    ) for to_neigh in to_neighs]
+    offsets = np.zeros(len(samp_neighs), dtype=np.int64)
+    np.cumsum([len(samp_neigh) for samp_neigh in samp_neighs[:-1]], out=offsets[1:])
+    return [n for samp_neigh in samp_neighs for n in samp_neigh], torch.from_numpy(offsets)
+
+def _unique_embeds(features, neighs, mode):
+    """
+    Embeds every distinct node of neighs once.
+    Returns the embeddings and, per entry of neighs, its row in them.
+    """
+    unique_nodes, index = torch.unique(torch.as_tensor(neighs, dtype=torch.long), return_inverse=True)
+    embed_matrix = features(unique_nodes, mode)
+    if len(embed_matrix.size()) == 1:
+        embed_matrix = embed_matrix.unsqueeze(dim=0)
+    return embed_matrix, index
+
 class MeanAggregator(nn.Module):
     """
     Aggregates a node's embeddings using mean of neighbors' embeddings
     """
+    sample_replace = False
+
     def __init__(self, features, cuda=False): 
         """
         Initializes the aggregator for a specific graph.
@@ -35,42 +65,43 @@ class MeanAggregator(nn.Module):
         """
         Aggregates embeddings for a batch of nodes.
         keep_prob and max_keep are the parameters for edge/neighbour dropout.
+        The sampled neighbors are averaged as bags of an embedding bag, so the
+        cost is linear in the number of sampled edges.
 
         to_neighs -- list of neighbors of nodes
         keep_prob -- probability of keeping a neighbor
         max_keep  -- maximum number of neighbors kept per node
         """
+        neighs, offsets = _sample_neighs(to_neighs, keep_prob, max_keep)
+        return self.aggregate(neighs, offsets, rel)
 
-        # Local pointers to functions (speed hack)
-        _int = int
-        _set = set
-        _min = min
-        _len = len
-        _ceil = math.ceil
-        _sample = random.sample
-        samp_neighs = [_set(_sample(to_neigh, 
-                        _min(_int(_ceil(_len(to_neigh)*keep_prob)), max_keep)
-                        )) for to_neigh in to_neighs]
-        unique_nodes_list = list(set.union(*samp_neighs))
-        unique_nodes = {n:i for i,n in enumerate(unique_nodes_list)}
-        mask = Variable(torch.zeros(len(samp_neighs), len(unique_nodes)))
-        column_indices = [unique_nodes[n] for samp_neigh in samp_neighs for n in samp_neigh]   
-        row_indices = [i for i in range(len(samp_neighs)) for j in range(len(samp_neighs[i]))]
-        mask[row_indices, column_indices] = 1
-        if self.cuda:
-            mask = mask.cuda()
-        num_neigh = mask.sum(1, keepdim=True)
-        mask = mask.div(num_neigh)
-        embed_matrix = self.features(unique_nodes_list, rel[-1])
-        if len(embed_matrix.size()) == 1:
-            embed_matrix = embed_matrix.unsqueeze(dim=0)
-        to_feats = mask.mm(embed_matrix)
-        return to_feats
+    def aggregate(self, neighs, offsets, rel):
+        """
+        Aggregates already sampled neighbors (see csr_graph.NeighborSampler).
+
+        neighs  -- sampled neighbors of all nodes, node after node
+        offsets -- LongTensor of the offset of every node's neighbors in neighs
+        """
+        embed_matrix, index = _unique_embeds(self.features, neighs, rel[-1])
+        return self.pool(embed_matrix, index, offsets, rel)
+
+    def pool(self, embed_matrix, index, offsets, rel):
+        """
+        Aggregates rows of embed_matrix, the neighbor embeddings computed beforehand.
+
+        index   -- LongTensor of the row of every sampled neighbor
+        offsets -- LongTensor of the offset of every node's neighbors in index
+        """
+        index = index.to(embed_matrix.device)
+        offsets = offsets.to(embed_matrix.device)
+        return F.embedding_bag(index, embed_matrix, offsets, mode="mean")
 
 class FastMeanAggregator(nn.Module):
     """
     Aggregates a node's embeddings using mean of neighbors' embeddings
     """
+    sample_replace = True
+
     def __init__(self, features, cuda=False): 
         """
         Initializes the aggregator for a specific graph.
@@ -102,10 +133,28 @@ class FastMeanAggregator(nn.Module):
         to_feats = embed_matrix.view(max_keep, len(to_neighs), embed_matrix.size()[1])
         return to_feats.mean(dim=0)
 
+    def aggregate(self, neighs, offsets, rel):
+        """
+        Aggregates neighbors sampled with replacement, the same number for every node
+        (see csr_graph.NeighborSampler).
+        """
+        embed_matrix, index = _unique_embeds(self.features, neighs, rel[-1])
+        return self.pool(embed_matrix, index, offsets, rel)
+
+    def pool(self, embed_matrix, index, offsets, rel):
+        """
+        Aggregates rows of embed_matrix, as MeanAggregator.pool.
+        """
+        embed_matrix = embed_matrix[index.to(embed_matrix.device)]
+        to_feats = embed_matrix.view(len(offsets), -1, embed_matrix.size()[1])
+        return to_feats.mean(dim=1)
+
 class PoolAggregator(nn.Module):
     """
     Aggregates a node's embeddings using mean pooling of neighbors' embeddings
     """
+    sample_replace = False
+
     def __init__(self, features, feature_dims, cuda=False): 
         """
         Initializes the aggregator for a specific graph.
@@ -134,32 +183,33 @@ class PoolAggregator(nn.Module):
         keep_prob -- probability of keeping a neighbor
         max_keep  -- maximum number of neighbors kept per node
         """
-        _int = int
-        _set = set
-        _min = min
-        _len = len
-        _ceil = math.ceil
-        _sample = random.sample
-        samp_neighs = [_set(_sample(to_neigh, 
-                        _min(_int(_ceil(_len(to_neigh)*keep_prob)), max_keep)
-                        )) for to_neigh in to_neighs]
-        unique_nodes_list = list(set.union(*samp_neighs))
-        unique_nodes = {n:i for i,n in enumerate(unique_nodes_list)}
-        mask = Variable(torch.zeros(len(samp_neighs), len(unique_nodes)))
-        column_indices = [unique_nodes[n] for samp_neigh in samp_neighs for n in samp_neigh]   
-        row_indices = [i for i in range(len(samp_neighs)) for j in range(len(samp_neighs[i]))]
-        mask[row_indices, column_indices] = 1
+        neighs, offsets = _sample_neighs(to_neighs, keep_prob, max_keep)
+        return self.aggregate(neighs, offsets, rel)
+
+    def aggregate(self, neighs, offsets, rel):
+        """
+        Aggregates already sampled neighbors, as MeanAggregator.aggregate.
+        """
+        embed_matrix, index = _unique_embeds(self.features, neighs, rel[-1])
+        return self.pool(embed_matrix, index, offsets, rel)
+
+    def pool(self, embed_matrix, index, offsets, rel):
+        """
+        Aggregates rows of embed_matrix, as MeanAggregator.pool.
+        """
         mode = rel[0]
-        if self.cuda:
-            mask = mask.cuda()
-        embed_matrix = self.features(unique_nodes, rel[-1]).mm(self.pool_matrix[mode])
-        to_feats = F.relu(mask.mm(embed_matrix))
+        index = index.to(embed_matrix.device)
+        offsets = offsets.to(embed_matrix.device)
+        embed_matrix = embed_matrix.mm(self.pool_matrix[mode])
+        to_feats = F.relu(F.embedding_bag(index, embed_matrix, offsets, mode="sum"))
         return to_feats
 
 class FastPoolAggregator(nn.Module):
     """
     Aggregates a node's embeddings using mean pooling of neighbors' embeddings
     """
+    sample_replace = True
+
     def __init__(self, features, feature_dims,
             cuda=False): 
         """
@@ -198,3 +248,19 @@ class FastPoolAggregator(nn.Module):
         embed_matrix = self.features(samp_neighs, rel[-1]).mm(self.pool_matrix[mode])
         to_feats = embed_matrix.view(max_keep, len(to_neighs), embed_matrix.size()[1])
         return to_feats.mean(dim=0)
+
+    def aggregate(self, neighs, offsets, rel):
+        """
+        Aggregates neighbors sampled with replacement, as FastMeanAggregator.aggregate.
+        """
+        embed_matrix, index = _unique_embeds(self.features, neighs, rel[-1])
+        return self.pool(embed_matrix, index, offsets, rel)
+
+    def pool(self, embed_matrix, index, offsets, rel):
+        """
+        Aggregates rows of embed_matrix, as MeanAggregator.pool.
+        """
+        mode = rel[0]
+        embed_matrix = embed_matrix.mm(self.pool_matrix[mode])[index.to(embed_matrix.device)]
+        to_feats = embed_matrix.view(len(offsets), -1, embed_matrix.size()[1])
+        return to_feats.mean(dim=1)
@@ -4,21 +4,30 @@ from collections import OrderedDict, defaultdict
 from multiprocessing import Process
 import random
 import json
-from netquery.data_utils import parallel_sample, load_queries_by_type, sample_clean_test
+from netquery.data_utils import parallel_sample, load_queries_by_type, sample_clean_test, load_dense_graph_data, dense_id_maps
 
 from netquery.graph import Graph, Query, _reverse_edge
+from netquery.csr_graph import CSRAdjLists
+from netquery.utils import make_features
 
-def load_graph(data_dir, embed_dim):
-    rels, adj_lists, node_maps = pickle.load(open(data_dir+"/graph_data.pkl", "rb"))
-    node_maps = {m : {n : i for i, n in enumerate(id_list)} for m, id_list in node_maps.items()}
-    for m in node_maps:
-        node_maps[m][-1] = -1
+def load_graph(data_dir, embed_dim, csr=False, dense=False):
+    """
+    dense -- renumber the nodes of every mode 0..n-1 (see data_utils.load_dense_graph_data),
+             so that the features index the embeddings directly; node_maps then maps the
+             original node ids to the dense ones, to remap queries and preferences on load
+    """
+    if dense:
+        rels, adj_lists, node_maps = load_dense_graph_data(data_dir)
+    else:
+        rels, adj_lists, node_maps = pickle.load(open(data_dir+"/graph_data.pkl", "rb"))
+    node_maps = dense_id_maps(node_maps)
     feature_dims = {m : embed_dim for m in rels}
     feature_modules = {m : torch.nn.Embedding(len(node_maps[m])+1, embed_dim) for m in rels}
     for mode in rels:
         feature_modules[mode].weight.data.normal_(0, 1./embed_dim)
-    features = lambda nodes, mode : feature_modules[mode](
-            torch.autograd.Variable(torch.LongTensor([node_maps[mode][n] for n in nodes])+1))
+    features = make_features(feature_modules, None if dense else node_maps)
+    if csr:
+        adj_lists = CSRAdjLists.from_adj_lists(adj_lists)
     graph = Graph(features, feature_dims, rels, adj_lists)
     return graph, feature_modules, node_maps
 
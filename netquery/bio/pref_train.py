@@ -10,14 +10,13 @@ sys.path.append("../..")
 from argparse import ArgumentParser
 
 from netquery.utils import *
-from netquery.utils import _get_perc_scores
+from netquery.metrics import RankingMetrics
 from netquery.bio.data_utils import load_graph
-from netquery.pref_data_utils import load_prefs_by_formula
+from netquery.pref_data_utils import load_prefs_by_formula, load_prefs_columnar
 from netquery.model import QueryEncoderDecoder
 from netquery.pref_model import PrefRGCN
 
 from torch import optim
-from torch_geometric.utils import dense_to_sparse
 from collections import defaultdict
 
 def load_args():
@@ -38,12 +37,14 @@ def load_args():
     parser.add_argument("--decoder", type=str, default="bilinear")
     parser.add_argument("--inter_decoder", type=str, default="mean")
     parser.add_argument("--opt", type=str, default="adam")
+    parser.add_argument("--dense_ids", action='store_true', default=False)
     # pref
     parser.add_argument("--emb_model_loc", type=str, default="./bio-0-128-0.010000-bilinear-mean-edge_conv")
     parser.add_argument("--hidden", type=int, default=200)
     parser.add_argument("--pref_dec", type=str, default="RGCN")
     parser.add_argument("--pref_graph_type", type=str, default="reverse")
     parser.add_argument("--rel_num", type=int, default=4)
+    parser.add_argument("--pref_format", type=str, default="pickle")
 
     return parser.parse_args()
 
@@ -54,9 +55,9 @@ def run_eval(args, model, prefs, iteration, logger, batch_size=128, seed=36):
     # auc & roc
     perc_scores = defaultdict()
     auc_scores = defaultdict()
+    metrics = RankingMetrics()
     # calculate perc
     for pref_type in prefs:
-        type_perc_scores = []
         for formula in prefs[pref_type]:
             formula_prefs = prefs[pref_type][formula]
             offset = 0
@@ -64,36 +65,25 @@ def run_eval(args, model, prefs, iteration, logger, batch_size=128, seed=36):
             while offset < len(formula_prefs):
                 max_index = min(offset + batch_size, len(formula_prefs))
                 batch_prefs = formula_prefs[offset:max_index]
+                # the preference vectors do not depend on the targets, encode once for all levels
+                pref_vecs = model.encode_preferences(formula, batch_prefs)
                 for level in range(entities_level_num-1):
-                    higher_entity = [random.choice(formula_prefs[j].sampled_entities[level+1]) for j in range(offset, max_index)]
-                    lower_entities = [n for j in range(offset, max_index) for n in formula_prefs[j].sampled_entities[level]]
-                    lengths = [len(formula_prefs[j].sampled_entities[level]) for j in range(offset, max_index)]
-                    current_prefs = batch_prefs + [b for i, b in enumerate(batch_prefs) for _ in range(lengths[i])]
-                    edge_idx, edge_type = dense_to_sparse(torch.Tensor([formula.edge_index for _ in range(len(current_prefs))]))
-                    batch = []
-                    mask = []
-                    for j in range(len(current_prefs)):
-                        batch += [j for _ in range(len(formula.edge_index))]
-                        mask += [1] + [0 for _ in range(len(formula.edge_index)-1)]
-                    batch = torch.LongTensor(batch)
-                    mask = torch.LongTensor(mask)
-                    if args.cuda:
-                        edge_idx = edge_idx.cuda()
-                        edge_type = edge_type.cuda()
-                        batch = batch.cuda()
-                        mask = mask.cuda()
-                    batch_scores = model.forward(
-                        formula=formula,
-                        prefs=current_prefs,
-                        edge_index=edge_idx,
-                        edge_type=edge_type,
-                        batch=batch,
-                        mask=mask,
-                        targets=higher_entity+lower_entities
-                    ).data.tolist()
-                    type_perc_scores.extend(_get_perc_scores(batch_scores, lengths))
+                    higher_entity = [random.choice(pref.sampled_entities[level+1]) for pref in batch_prefs]
+                    lower_entities = [n for pref in batch_prefs for n in pref.sampled_entities[level]]
+                    lengths = [len(pref.sampled_entities[level]) for pref in batch_prefs]
+                    index = list(range(len(batch_prefs))) + [i for i in range(len(batch_prefs)) for _ in range(lengths[i])]
+                    batch_scores = model.score(
+                        pref_vecs=pref_vecs,
+                        targets=higher_entity+lower_entities,
+                        mode=formula.attributes[0][0],
+                        index=index
+                    ).detach()
+                    metrics.add(pref_type, batch_scores[:len(lengths)], batch_scores[len(lengths):], lengths)
                 offset += batch_size
-        perc_scores[pref_type] = np.mean(type_perc_scores)
+    summary = metrics.summary()
+    for pref_type in prefs:
+        # NaN for a pref_type without any evaluated batch, as the mean of no scores was
+        perc_scores[pref_type] = summary.get(pref_type, {}).get("perc", float("nan"))
     # calculate auc & roc
     # for pref_type in prefs:
     #     print(pref_type)
@@ -138,9 +128,10 @@ def run_train():
     args = load_args()
 
     print("Loading graph data..")
-    graph, feature_modules, node_maps = load_graph(args.data_dir, args.embed_dim)
+    graph, feature_modules, node_maps = load_graph(args.data_dir, args.embed_dim, dense=args.dense_ids)
+    id_maps = node_maps if args.dense_ids else None
     if args.cuda:
-        graph.features = cudify(feature_modules, node_maps)
+        graph.features = cudify(feature_modules, None if args.dense_ids else node_maps)
     out_dims = {mode:args.embed_dim for mode in graph.relations}
 
 
@@ -149,8 +140,12 @@ def run_train():
     test_prefs = defaultdict(lambda : defaultdict(list))
 
     for i in range(1, 2):
-        i_train_prefs = load_prefs_by_formula(args.data_dir + "preference/train_pref_{:d}.pkl".format(i))
-        i_test_prefs = load_prefs_by_formula(args.data_dir + "preference/test_pref_{:d}.pkl".format(i))
+        if args.pref_format == "columnar":
+            i_train_prefs = load_prefs_columnar(args.data_dir + "preference/train_pref_{:d}".format(i), id_maps=id_maps)
+            i_test_prefs = load_prefs_columnar(args.data_dir + "preference/test_pref_{:d}".format(i), id_maps=id_maps)
+        else:
+            i_train_prefs = load_prefs_by_formula(args.data_dir + "preference/train_pref_{:d}.pkl".format(i), id_maps=id_maps)
+            i_test_prefs = load_prefs_by_formula(args.data_dir + "preference/test_pref_{:d}.pkl".format(i), id_maps=id_maps)
         train_prefs.update(i_train_prefs)
         test_prefs.update(i_test_prefs)
 
@@ -226,19 +221,7 @@ def run_train():
             end = n if end <= start else end
             # calculate and update loss
             current_prefs = p[formula][start:end]
-            edge_idx, edge_type = dense_to_sparse(torch.Tensor([formula.edge_index for _ in range(end-start)]))
-            batch = []
-            mask = []
-            for j in range(end-start):
-                batch += [j for _ in range(len(formula.edge_index))]
-                mask += [1] + [0 for _ in range(len(formula.edge_index) - 1)]
-            batch = torch.LongTensor(batch)
-            mask = torch.LongTensor(mask)
-            if args.cuda:
-                edge_idx = edge_idx.cuda()
-                edge_type = edge_type.cuda()
-                batch = batch.cuda()
-                mask = mask.cuda()
+            edge_idx, edge_type, batch, mask = formula.batch_graph(end-start)
             # if loss == None:
             #     loss = prefRGCN.margin_loss(formula, current_prefs, edge_idx, edge_type, batch, mask)
             # else:
@@ -29,26 +29,28 @@ parser.add_argument("--model_dir", type=str, default="./")
 parser.add_argument("--decoder", type=str, default="bilinear")
 parser.add_argument("--inter_decoder", type=str, default="mean")
 parser.add_argument("--opt", type=str, default="adam")
+parser.add_argument("--dense_ids", action='store_true', default=False)
 args = parser.parse_args()
 
 print("Loading graph data..")
-graph, feature_modules, node_maps = load_graph(args.data_dir, args.embed_dim)
+graph, feature_modules, node_maps = load_graph(args.data_dir, args.embed_dim, dense=args.dense_ids)
+id_maps = node_maps if args.dense_ids else None
 if args.cuda:
-    graph.features = cudify(feature_modules, node_maps)
+    graph.features = cudify(feature_modules, None if args.dense_ids else node_maps)
 out_dims = {mode:args.embed_dim for mode in graph.relations}
 
 print("Loading edge data..")
-train_queries = load_queries_by_formula(args.data_dir + "/train_edges.pkl")
-val_queries = load_test_queries_by_formula(args.data_dir + "/val_edges.pkl")
-test_queries = load_test_queries_by_formula(args.data_dir + "/test_edges.pkl")
+train_queries = load_queries_by_formula(args.data_dir + "/train_edges.pkl", id_maps=id_maps)
+val_queries = load_test_queries_by_formula(args.data_dir + "/val_edges.pkl", id_maps=id_maps)
+test_queries = load_test_queries_by_formula(args.data_dir + "/test_edges.pkl", id_maps=id_maps)
 
 print("Loading query data..")
 for i in range(2,4):
-    train_queries.update(load_queries_by_formula(args.data_dir + "/train_queries_{:d}.pkl".format(i)))
-    i_val_queries = load_test_queries_by_formula(args.data_dir + "/val_queries_{:d}.pkl".format(i))
+    train_queries.update(load_queries_by_formula(args.data_dir + "/train_queries_{:d}.pkl".format(i), id_maps=id_maps))
+    i_val_queries = load_test_queries_by_formula(args.data_dir + "/val_queries_{:d}.pkl".format(i), id_maps=id_maps)
     val_queries["one_neg"].update(i_val_queries["one_neg"])
     val_queries["full_neg"].update(i_val_queries["full_neg"])
-    i_test_queries = load_test_queries_by_formula(args.data_dir + "/test_queries_{:d}.pkl".format(i))
+    i_test_queries = load_test_queries_by_formula(args.data_dir + "/test_queries_{:d}.pkl".format(i), id_maps=id_maps)
     test_queries["one_neg"].update(i_test_queries["one_neg"])
     test_queries["full_neg"].update(i_test_queries["full_neg"])
 
@@ -0,0 +1,750 @@
+"""
+Compressed (CSR) storage for the adjacency lists of heterogeneous graphs.
+
+CSRAdjLists is a drop-in replacement for the dict-of-dict-of-sets adj_lists
+that Graph (see graph.py and pref_graph.py) is built on. Every relation is
+stored as a pair of NumPy arrays (indptr, indices) over dense per-mode node
+positions, which costs a few bytes per edge instead of a Python set entry.
+Lookups like adj_lists[rel][node] still return set-like objects, so the
+existing samplers keep working unchanged.
+"""
+import copy
+import random
+from itertools import chain
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+
+def _reverse_relation(relation):
+    return (relation[-1], relation[1], relation[0])
+
+
+def _to_py(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+def _segment_indices(starts, lengths):
+    """
+    Returns the flat positions covered by the ranges [start, start+length).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(np.asarray(starts, dtype=np.int64) - offsets, lengths) + np.arange(total, dtype=np.int64)
+
+
+class NodeIndex():
+    """
+    Sorted array of the node ids of one mode.
+    The position of an id in this array is its dense id.
+    """
+
+    def __init__(self, ids):
+        self.ids = np.unique(np.asarray(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, node):
+        """
+        Dense id of a single node, or -1 if the node is unknown.
+        """
+        pos = int(np.searchsorted(self.ids, node))
+        if pos < len(self.ids) and self.ids[pos] == node:
+            return pos
+        return -1
+
+    def lookup_many(self, nodes):
+        """
+        Dense ids of an array of nodes, with -1 for unknown nodes.
+        """
+        nodes = np.asarray(nodes)
+        if len(self.ids) == 0 or len(nodes) == 0:
+            return np.full(len(nodes), -1, dtype=np.int64)
+        pos = np.searchsorted(self.ids, nodes)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        return np.where(self.ids[pos] == nodes, pos, -1).astype(np.int64)
+
+    def to_ids(self, positions):
+        return self.ids[positions]
+
+
+class CSRAdjacency():
+    """
+    Adjacency of a single relation in CSR layout.
+    Rows are the dense ids of the head mode, indices the dense ids of the tail mode.
+    Reads like the node -> set(neighbors) dict it replaces (get, [], in, len, iteration,
+    keys, values, items), but read-only: the neighbor sets are frozensets, and unknown
+    nodes have no neighbors as with a defaultdict(set). Edges are edited through
+    CSRAdjLists.add_edges and remove_edges.
+    The split views of a relation (see split) share indptr and indices: the neighbors
+    of every row are ordered by the first view they belong to, and each view reads a
+    row up to its own end only.
+    """
+
+    def __init__(self, rel, head_index, tail_index, indptr, indices, has_row, bounds=None):
+        """
+        rel         -- relation tuple (head_mode, rel_name, tail_mode)
+        head_index  -- NodeIndex of the head mode
+        tail_index  -- NodeIndex of the tail mode
+        indptr      -- row pointers, len(head_index)+1 entries
+        indices     -- dense tail ids, sorted within each row
+        has_row     -- boolean mask of the head nodes that are keys of this relation
+        bounds      -- for a split view, the row ends of each view up to this one: row pos is
+                       indices[indptr[pos]:bounds[-1][pos]], sorted within the part of every view
+        """
+        self.rel = rel
+        self.head_index = head_index
+        self.tail_index = tail_index
+        self.indptr = indptr
+        self.indices = indices
+        self.has_row = has_row
+        self.bounds = bounds
+
+    @staticmethod
+    def from_pairs(rel, head_index, tail_index, rows, cols, has_row):
+        order = np.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
+        indptr = np.zeros(len(head_index) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(head_index)), out=indptr[1:])
+        idx_dtype = np.int32 if len(tail_index) < np.iinfo(np.int32).max else np.int64
+        return CSRAdjacency(rel, head_index, tail_index, indptr, cols.astype(idx_dtype), has_row)
+
+    @property
+    def starts(self):
+        return self.indptr[:-1]
+
+    @property
+    def ends(self):
+        return self.indptr[1:] if self.bounds is None else self.bounds[-1]
+
+    def arrays(self):
+        """
+        (indptr, indices) of the edges of this adjacency alone.
+        """
+        if self.bounds is None:
+            return self.indptr, self.indices
+        lengths = self.ends - self.starts
+        indptr = np.zeros(len(self.head_index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return indptr, self.indices[_segment_indices(self.starts, lengths)]
+
+    def _edge_rows(self, indptr):
+        return np.repeat(np.arange(len(self.head_index), dtype=np.int64), np.diff(indptr))
+
+    def _unsplit(self):
+        """
+        Gives a split view arrays of its own, sorted within each row, before it is edited.
+        """
+        if self.bounds is None:
+            return
+        indptr, indices = self.arrays()
+        self.indices = indices[np.lexsort((indices, self._edge_rows(indptr)))]
+        self.indptr = indptr
+        self.bounds = None
+
+    def split(self, levels, num_views):
+        """
+        Split views of this adjacency over one shared reordering of its arrays:
+        view k holds the edges whose level is at most k.
+
+        levels    -- level of every edge of indices, e.g. 1 for held-out edges, 0 otherwise
+        num_views -- number of views, one more than the highest level
+        """
+        indptr, indices = self.arrays()
+        rows = self._edge_rows(indptr)
+        order = np.lexsort((indices, levels, rows))
+        indices = indices[order]
+        levels = levels[order]
+        bounds = [indptr[:-1] + np.bincount(rows[levels <= k], minlength=len(self.head_index))
+                  for k in range(num_views)]
+        return [CSRAdjacency(self.rel, self.head_index, self.tail_index, indptr, indices, self.has_row,
+                             bounds[:k+1]) for k in range(num_views)]
+
+    def transpose(self):
+        indptr, indices = self.arrays()
+        has_row = np.zeros(len(self.tail_index), dtype=bool)
+        has_row[indices] = True
+        return CSRAdjacency.from_pairs(_reverse_relation(self.rel), self.tail_index, self.head_index,
+                                       indices.astype(np.int64), self._edge_rows(indptr), has_row)
+
+    def row(self, node):
+        return self.head_index.lookup(node)
+
+    def row_positions(self, pos):
+        """
+        Dense tail ids of the neighbors of the head node at dense id pos.
+        """
+        return self.indices[self.indptr[pos]:self.ends[pos]]
+
+    def gather(self, positions):
+        """
+        Unique dense tail ids reachable from any of the given dense head ids.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = self.indptr[positions]
+        lengths = self.ends[positions] - starts
+        return np.unique(self.indices[_segment_indices(starts, lengths)])
+
+    def neighbors(self, node):
+        """
+        Neighbor ids of node as a NumPy array (empty if node is unknown).
+        """
+        pos = self.row(node)
+        if pos < 0:
+            return self.tail_index.ids[:0]
+        return self.tail_index.to_ids(self.row_positions(pos))
+
+    def degree(self, node):
+        pos = self.row(node)
+        if pos < 0:
+            return 0
+        return int(self.ends[pos] - self.indptr[pos])
+
+    def has_edge(self, head, tail):
+        pos = self.row(head)
+        tail_pos = self.tail_index.lookup(tail)
+        if pos < 0 or tail_pos < 0:
+            return False
+        start = self.indptr[pos]
+        for ends in [self.indptr[1:]] if self.bounds is None else self.bounds:
+            neighs = self.indices[start:ends[pos]]
+            i = int(np.searchsorted(neighs, tail_pos))
+            if i < len(neighs) and neighs[i] == tail_pos:
+                return True
+            start = ends[pos]
+        return False
+
+    def num_edges(self):
+        if self.bounds is None:
+            return int(self.indptr[-1])
+        return int((self.ends - self.starts).sum())
+
+    def remove_pairs(self, rows, cols):
+        """
+        Removes the edges (rows[i], cols[i]), given as dense ids.
+        """
+        if len(rows) == 0:
+            return
+        self._unsplit()
+        n_tail = max(len(self.tail_index), 1)
+        edge_rows = self._edge_rows(self.indptr)
+        keys = edge_rows * n_tail + self.indices
+        keep = ~np.isin(keys, np.asarray(rows, dtype=np.int64) * n_tail + np.asarray(cols, dtype=np.int64))
+        counts = np.bincount(edge_rows[keep], minlength=len(self.head_index))
+        self.indices = self.indices[keep]
+        self.indptr = np.zeros(len(self.head_index) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+    def add_pairs(self, rows, cols):
+        """
+        Adds the edges (rows[i], cols[i]), given as dense ids; edges already there are kept once.
+        The arrays are replaced, never written to, so shallow copies stay independent.
+        """
+        if len(rows) == 0:
+            return
+        self._unsplit()
+        rows = np.asarray(rows, dtype=np.int64)
+        n_tail = max(len(self.tail_index), 1)
+        edge_rows = self._edge_rows(self.indptr)
+        keys = np.unique(np.concatenate([edge_rows * n_tail + self.indices, rows * n_tail + np.asarray(cols, dtype=np.int64)]))
+        self.indptr = np.zeros(len(self.head_index) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // n_tail, minlength=len(self.head_index)), out=self.indptr[1:])
+        self.indices = (keys % n_tail).astype(self.indices.dtype)
+        has_row = self.has_row.copy()
+        has_row[rows] = True
+        self.has_row = has_row
+
+    def nbytes(self):
+        """
+        Bytes of the arrays, including those shared with other split views.
+        """
+        return self.indptr.nbytes + self.indices.nbytes + self.has_row.nbytes + \
+               sum(ends.nbytes for ends in self.bounds or [])
+
+    def __getitem__(self, node):
+        return frozenset(self.neighbors(node).tolist())
+
+    def get(self, node, default=None):
+        return self[node] if node in self else default
+
+    def __contains__(self, node):
+        pos = self.row(node)
+        return pos >= 0 and bool(self.has_row[pos])
+
+    def __len__(self):
+        return int(self.has_row.sum())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.head_index.ids[self.has_row].tolist()
+
+    def values(self):
+        return [self[node] for node in self.keys()]
+
+    def items(self):
+        return [(node, self[node]) for node in self.keys()]
+
+
+class _FlatNodeEdges():
+    """
+    Read-only sequence of the (rel, neigh) pairs of one node, across relations.
+    Supports len() and indexing so random.choice works on it.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.length = sum(end - start for _, start, end in segments)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        for adj, start, end in self.segments:
+            if i < end - start:
+                return (adj.rel, _to_py(adj.tail_index.ids[adj.indices[start + i]]))
+            i -= end - start
+        raise IndexError("edge index out of range")
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+
+class _FlatModeView():
+
+    def __init__(self, adjs):
+        self.adjs = adjs
+
+    def __getitem__(self, node):
+        segments = []
+        for adj in self.adjs:
+            pos = adj.row(node)
+            if pos >= 0 and adj.ends[pos] > adj.indptr[pos]:
+                segments.append((adj, int(adj.indptr[pos]), int(adj.ends[pos])))
+        return _FlatNodeEdges(segments)
+
+
+class CSRFlatAdjLists():
+    """
+    Lazy replacement for Graph.flat_adj_lists (mode -> node -> [(rel, neigh)]).
+    """
+
+    def __init__(self, adj_lists):
+        self.modes = {}
+        for rel, adj in adj_lists.items():
+            self.modes.setdefault(rel[0], []).append(adj)
+
+    def __getitem__(self, mode):
+        return _FlatModeView(self.modes.get(mode, []))
+
+
+class CSRAdjLists():
+    """
+    Map from relation tuple -> CSRAdjacency, sharing one NodeIndex per mode.
+    """
+
+    def __init__(self, node_index, adjs):
+        self.node_index = node_index
+        self.adjs = adjs
+        self.reverse_adjs = {}
+
+    @staticmethod
+    def from_adj_lists(adj_lists):
+        """
+        Builds the CSR store from a relation -> node -> set(neighbors) dict.
+        """
+        mode_ids = {}
+        for rel, adjs in adj_lists.items():
+            mode_ids.setdefault(rel[0], []).append(np.asarray(list(adjs.keys())))
+            mode_ids.setdefault(rel[-1], []).append(np.asarray(list(set(chain.from_iterable(adjs.values())))))
+        node_index = {mode: NodeIndex(np.concatenate([i for i in ids if len(i) > 0] or [ids[0]]))
+                      for mode, ids in mode_ids.items()}
+
+        csr_adjs = {}
+        for rel, adjs in adj_lists.items():
+            head_index = node_index[rel[0]]
+            tail_index = node_index[rel[-1]]
+            heads = list(adjs.keys())
+            counts = np.asarray([len(adjs[node]) for node in heads], dtype=np.int64)
+            head_pos = head_index.lookup_many(heads)
+            rows = np.repeat(head_pos, counts)
+            cols = tail_index.lookup_many(np.asarray(list(chain.from_iterable(adjs[node] for node in heads))))
+            has_row = np.zeros(len(head_index), dtype=bool)
+            has_row[head_pos] = True
+            csr_adjs[rel] = CSRAdjacency.from_pairs(rel, head_index, tail_index, rows, cols, has_row)
+        return CSRAdjLists(node_index, csr_adjs)
+
+    def reverse(self, rel):
+        """
+        CSR of the reverse relation, transposed once if the graph does not store it.
+        """
+        rev_rel = _reverse_relation(rel)
+        if rev_rel in self.adjs:
+            return self.adjs[rev_rel]
+        if not rev_rel in self.reverse_adjs:
+            self.reverse_adjs[rev_rel] = self.adjs[rel].transpose()
+        return self.reverse_adjs[rev_rel]
+
+    def __getitem__(self, rel):
+        if rel in self.adjs:
+            return self.adjs[rel]
+        if _reverse_relation(rel) in self.adjs:
+            return self.reverse(_reverse_relation(rel))
+        raise KeyError(rel)
+
+    def __contains__(self, rel):
+        return rel in self.adjs
+
+    def __iter__(self):
+        return iter(self.adjs)
+
+    def __len__(self):
+        return len(self.adjs)
+
+    def keys(self):
+        return self.adjs.keys()
+
+    def values(self):
+        return self.adjs.values()
+
+    def items(self):
+        return self.adjs.items()
+
+    def flat_view(self):
+        return CSRFlatAdjLists(self.adjs)
+
+    def metapath_positions(self, node, rels, frontiers=None):
+        """
+        Dense ids of the nodes reachable from node by following rels.
+        frontiers -- if a list, the node ids reached after each of rels[:-1] are appended to it
+        """
+        pos = self.node_index[rels[0][0]].lookup(node)
+        if pos < 0:
+            return np.zeros(0, dtype=np.int64)
+        frontier = np.asarray([pos], dtype=np.int64)
+        for i, rel in enumerate(rels):
+            if i > 0 and not frontiers is None:
+                frontiers.append(self.node_index[rel[0]].to_ids(frontier))
+            frontier = self[rel].gather(frontier)
+        return frontier
+
+    def metapath_neighs(self, node, rels, frontiers=None):
+        return self.node_index[rels[-1][-1]].to_ids(self.metapath_positions(node, rels, frontiers))
+
+    def _pairs_by_rel(self, edge_list):
+        """
+        Map from stored relation -> (dense head ids, dense tail ids) of the edges
+        (head, rel, tail) and their reverse edges.
+        """
+        pairs = {}
+        for head, rel, tail in edge_list:
+            pairs.setdefault(rel, ([], []))
+            pairs[rel][0].append(head)
+            pairs[rel][1].append(tail)
+            pairs.setdefault(_reverse_relation(rel), ([], []))
+            pairs[_reverse_relation(rel)][0].append(tail)
+            pairs[_reverse_relation(rel)][1].append(head)
+        return {rel: (self.adjs[rel].head_index.lookup_many(np.asarray(heads)),
+                      self.adjs[rel].tail_index.lookup_many(np.asarray(tails)))
+                for rel, (heads, tails) in pairs.items() if rel in self.adjs}
+
+    def remove_edges(self, edge_list):
+        """
+        Removes edges given as (head, rel, tail), along with their reverse edges.
+        """
+        for rel, (rows, cols) in self._pairs_by_rel(edge_list).items():
+            known = (rows >= 0) & (cols >= 0)
+            self.adjs[rel].remove_pairs(rows[known], cols[known])
+        self.reverse_adjs = {}
+
+    def add_edges(self, edge_list):
+        """
+        Adds edges given as (head, rel, tail), along with their reverse edges.
+        The node sets are fixed, so the nodes must already be in the graph.
+        """
+        pairs = self._pairs_by_rel(edge_list)
+        for head, rel, tail in edge_list:
+            if not rel in self.adjs and not _reverse_relation(rel) in self.adjs:
+                raise Exception("Unknown relation {:s}".format(str(rel)))
+        for rows, cols in pairs.values():
+            if (rows < 0).any() or (cols < 0).any():
+                raise Exception("Cannot add edges between nodes the CSR graph does not have")
+        for rel, (rows, cols) in pairs.items():
+            self.adjs[rel].add_pairs(rows, cols)
+        self.reverse_adjs = {}
+
+    def copy(self):
+        """
+        Copy sharing the CSR arrays: edits replace the arrays of a relation rather than
+        writing to them, so either copy can be edited without affecting the other.
+        """
+        adj_lists = CSRAdjLists(self.node_index, {rel: copy.copy(adj) for rel, adj in self.adjs.items()})
+        adj_lists.reverse_adjs = dict(self.reverse_adjs)
+        return adj_lists
+
+    def split(self, heldout):
+        """
+        Views of the graph without nested sets of held-out edges, sharing one copy of the
+        CSR arrays: every relation is reordered once so that the neighbors of each row are
+        grouped by the first view they belong to, and a view only adds its row ends.
+
+        heldout -- lists of edges (head, rel, tail), the reverse edges are held out with them
+
+        Returns len(heldout)+1 CSRAdjLists, view k without the edges of heldout[k:]
+        (so the first view is the training graph) and the last one with every edge.
+        """
+        levels = {rel: np.zeros(adj.num_edges(), dtype=np.int64) for rel, adj in self.adjs.items()}
+        for j, edge_list in enumerate(heldout):
+            for rel, (rows, cols) in self._pairs_by_rel(edge_list).items():
+                adj = self.adjs[rel]
+                indptr, indices = adj.arrays()
+                n_tail = max(len(adj.tail_index), 1)
+                keys = adj._edge_rows(indptr) * n_tail + indices
+                levels[rel][np.isin(keys, rows * n_tail + cols)] = j + 1
+        views = [CSRAdjLists(self.node_index, {}) for _ in range(len(heldout) + 1)]
+        for rel, adj in self.adjs.items():
+            for view, view_adj in zip(views, adj.split(levels[rel], len(views))):
+                view.adjs[rel] = view_adj
+        return views
+
+    def nbytes(self):
+        return sum(adj.nbytes() for adj in self.adjs.values()) + \
+               sum(adj.nbytes() for adj in self.reverse_adjs.values()) + \
+               sum(index.ids.nbytes for index in self.node_index.values())
+
+
+class NeighborSampler():
+    """
+    Draws the neighbors of whole batches of nodes from the CSR arrays of each relation,
+    as the aggregators (see aggregators.py) take them: the sampled node ids flattened
+    node by node, and the offset of every node's neighbors in them.
+    Nodes without neighbors, and the null node -1, get the null neighbor -1.
+    A dict adj_lists is converted to CSR once, so later edits to it are not seen;
+    a CSRAdjLists is used as is.
+    """
+
+    def __init__(self, adj_lists, seed=None):
+        if not isinstance(adj_lists, CSRAdjLists):
+            adj_lists = CSRAdjLists.from_adj_lists(adj_lists)
+        self.adj_lists = adj_lists
+        self.rng = np.random.default_rng(seed)
+
+    def _rows(self, nodes, adj):
+        """
+        Start in adj.indices and degree of every node, 0 for unknown nodes.
+        """
+        pos = adj.head_index.lookup_many(nodes)
+        known = (pos >= 0) & (nodes != -1)
+        pos = np.where(known, pos, 0)
+        starts = np.where(known, adj.indptr[pos], 0)
+        degs = np.where(known, adj.ends[pos] - adj.indptr[pos], 0)
+        return starts, degs
+
+    def sample(self, nodes, rel, keep_prob=0.5, max_keep=10, replace=False):
+        """
+        nodes     -- list, array or LongTensor of node ids of mode rel[0]
+        keep_prob -- without replacement, ceil(keep_prob * degree) neighbors are kept,
+                     at most max_keep; None keeps up to max_keep
+        max_keep  -- maximum number of neighbors per node, exactly max_keep with replace
+        replace   -- sample uniformly with replacement
+        Returns (neighbors, offsets) as LongTensors.
+        """
+        if isinstance(nodes, torch.Tensor):
+            nodes = nodes.cpu().numpy()
+        nodes = np.asarray(nodes, dtype=np.int64)
+        adj = self.adj_lists[rel]
+        starts, degs = self._rows(nodes, adj)
+        has_neighs = degs > 0
+        if replace:
+            counts = np.full(len(nodes), max_keep, dtype=np.int64)
+            picks = np.repeat(starts, counts) + \
+                    (self.rng.random(int(counts.sum())) * np.repeat(degs, counts)).astype(np.int64)
+            picks = picks[np.repeat(has_neighs, counts)]
+        else:
+            if keep_prob is None:
+                counts = np.minimum(degs, max_keep)
+            else:
+                counts = np.minimum(np.ceil(degs * keep_prob).astype(np.int64), max_keep)
+            # order the neighbors of each node randomly, then keep the first counts of them
+            edges = _segment_indices(starts, degs)
+            edge_rows = np.repeat(np.arange(len(nodes), dtype=np.int64), degs)
+            order = np.lexsort((self.rng.random(len(edges)), edge_rows))
+            rank = np.arange(len(edges), dtype=np.int64) - np.repeat(np.cumsum(degs) - degs, degs)
+            picks = edges[order][rank < np.repeat(counts, degs)]
+            counts = np.where(has_neighs, counts, 1)
+        neighs = np.full(int(counts.sum()), -1, dtype=np.int64)
+        neighs[np.repeat(has_neighs, counts)] = adj.tail_index.to_ids(adj.indices[picks])
+        offsets = np.zeros(len(nodes), dtype=np.int64)
+        np.cumsum(counts[:-1], out=offsets[1:])
+        return torch.from_numpy(neighs), torch.from_numpy(offsets)
+
+
+def _popcount(words):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).astype(np.int64)
+    return np.unpackbits(words.view(np.uint8)).reshape(-1, 64).sum(1)
+
+
+class NodeBitsets():
+    """
+    Sets of nodes of one mode as bitsets: arrays of 64 bit words, bit i standing for
+    the node at position i of the sorted ids of the mode. Unions, intersections and
+    complements are word-wise NumPy operations, independent of the set sizes.
+    """
+
+    def __init__(self, ids, full_sets):
+        """
+        ids       -- map from mode -> sorted array of every node id of the mode
+        full_sets -- map from mode -> nodes the complements are taken in (Graph.full_sets)
+        """
+        self.ids = ids
+        self.full = {mode: self.from_nodes(mode, nodes) for mode, nodes in full_sets.items()}
+
+    @staticmethod
+    def from_adj_lists(adj_lists, full_sets):
+        """
+        Bitsets over every head and tail node of adj_lists, the dense ids of a
+        CSRAdjLists serving as bit positions directly.
+        """
+        if isinstance(adj_lists, CSRAdjLists):
+            return NodeBitsets({mode: index.ids for mode, index in adj_lists.node_index.items()}, full_sets)
+        mode_ids = {}
+        for rel, adjs in adj_lists.items():
+            mode_ids.setdefault(rel[0], []).append(np.fromiter(adjs.keys(), dtype=np.int64, count=len(adjs)))
+            mode_ids.setdefault(rel[-1], []).append(np.fromiter(chain.from_iterable(adjs.values()), dtype=np.int64))
+        return NodeBitsets({mode: np.unique(np.concatenate(ids)) for mode, ids in mode_ids.items()}, full_sets)
+
+    def empty(self, mode):
+        return np.zeros((len(self.ids[mode]) + 63) // 64, dtype="<u8")
+
+    def from_positions(self, mode, positions):
+        bits = self.empty(mode)
+        positions = np.asarray(positions, dtype=np.int64)
+        np.bitwise_or.at(bits, positions >> 6, np.left_shift(np.uint64(1), (positions & 63).astype(np.uint64)))
+        return bits
+
+    def from_nodes(self, mode, nodes):
+        """
+        Bitset of nodes, ignoring nodes that are not in the mode.
+        """
+        ids = self.ids[mode]
+        if hasattr(nodes, "__array__"):
+            nodes = np.asarray(nodes, dtype=np.int64)
+        else:
+            nodes = np.fromiter(nodes, dtype=np.int64, count=len(nodes))
+        if len(ids) == 0 or len(nodes) == 0:
+            return self.empty(mode)
+        positions = np.minimum(np.searchsorted(ids, nodes), len(ids) - 1)
+        return self.from_positions(mode, positions[ids[positions] == nodes])
+
+    @staticmethod
+    def count(bits):
+        return int(_popcount(bits).sum())
+
+    def to_nodes(self, mode, bits, max_num=None):
+        """
+        Node ids of the bitset as a list; with max_num, at most max_num of them drawn
+        uniformly without replacement, only those being materialized.
+        """
+        counts = _popcount(bits)
+        total = int(counts.sum())
+        if max_num is None or total <= max_num:
+            words = np.nonzero(bits)[0]
+            word_bits = np.unpackbits(bits[words].view(np.uint8), bitorder="little").reshape(-1, 64)
+            rows, cols = np.nonzero(word_bits)
+            return self.ids[mode][words[rows] * 64 + cols].tolist()
+        ranks = np.sort(np.asarray(random.sample(range(total), max_num), dtype=np.int64))
+        ends = np.cumsum(counts)
+        words = np.searchsorted(ends, ranks, side="right")
+        within = ranks - (ends[words] - counts[words])
+        word_bits = np.unpackbits(bits[words].view(np.uint8), bitorder="little").reshape(-1, 64)
+        cols = np.argmax(np.cumsum(word_bits, axis=1) > within[:, None], axis=1)
+        return self.ids[mode][words * 64 + cols].tolist()
+
+
+class SparseMetapaths():
+    """
+    Metapath reachability for many (node, rels) metapaths at once, by sparse products
+    with the boolean adjacency matrices of the relations (SciPy CSR matrices over the
+    arrays of a CSRAdjLists). Nodes are numbered globally, mode after mode, and the
+    matrices of all relations are stacked into one, so that every step of the
+    expansion is a single product for all metapaths, whatever relations they follow.
+    A dict adj_lists is converted to CSR once, so later edits to it are not seen.
+    """
+
+    def __init__(self, adj_lists):
+        if not isinstance(adj_lists, CSRAdjLists):
+            adj_lists = CSRAdjLists.from_adj_lists(adj_lists)
+        self.adj_lists = adj_lists
+        node_index = adj_lists.node_index
+        modes = sorted(node_index)
+        sizes = np.asarray([len(node_index[mode]) for mode in modes], dtype=np.int64)
+        self.mode_offsets = dict(zip(modes, (np.cumsum(sizes) - sizes).tolist()))
+        self.ids = np.concatenate([node_index[mode].ids.astype(np.int64) for mode in modes])
+        rels = sorted(set(adj_lists.keys()) | set(_reverse_relation(rel) for rel in adj_lists.keys()))
+        adjs = [adj_lists[rel] for rel in rels]
+        sizes = np.asarray([len(adj.head_index) for adj in adjs], dtype=np.int64)
+        self.rel_offsets = dict(zip(rels, (np.cumsum(sizes) - sizes).tolist()))
+        arrays = [adj.arrays() for adj in adjs]
+        edge_offsets = np.cumsum([0] + [len(indices) for _, indices in arrays])
+        indptr = np.concatenate([[0]] + [indptr[1:] + edge_offsets[k] for k, (indptr, _) in enumerate(arrays)])
+        indices = np.concatenate([indices.astype(np.int64) + self.mode_offsets[rel[-1]]
+                                  for rel, (_, indices) in zip(rels, arrays)])
+        self.matrix = sp.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                    shape=(int(sizes.sum()), len(self.ids)))
+
+    def _select(self, rows, cols, rels, num_rows):
+        """
+        Rows of the stacked matrix to follow rels[i] from the global ids cols of row rows[i].
+        """
+        shifts = np.asarray([self.rel_offsets[rel] - self.mode_offsets[rel[0]] for rel in rels], dtype=np.int64)
+        counts = np.bincount(rows, minlength=num_rows)
+        indptr = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return sp.csr_matrix((np.ones(len(cols), dtype=bool), cols + shifts[rows], indptr),
+                             shape=(num_rows, self.matrix.shape[0]))
+
+    def reach(self, nodes, rels_list, chunk_size=None):
+        """
+        Yields (start, reached, frontiers) for consecutive chunks of at most chunk_size of the
+        metapaths (nodes[i], rels_list[i]), which must all have the same length, starting at
+        metapath start. reached is a boolean CSR matrix with a row per metapath of the chunk
+        over the global node ids; frontiers[i] is the same for the nodes reached after
+        rels[:i+1], i.e. the heads rels[i+1] was followed from (see row_ids).
+        Nodes unknown to the graph get empty rows.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        chunk_size = max(len(nodes), 1) if chunk_size is None else chunk_size
+        for start in range(0, len(nodes), chunk_size):
+            chunk_rels = rels_list[start:start+chunk_size]
+            num_rows = len(chunk_rels)
+            pos = np.asarray([self.adj_lists.node_index[rels[0][0]].lookup(node)
+                              for node, rels in zip(nodes[start:start+chunk_size].tolist(), chunk_rels)], dtype=np.int64)
+            offsets = np.asarray([self.mode_offsets[rels[0][0]] for rels in chunk_rels], dtype=np.int64)
+            rows = np.nonzero(pos >= 0)[0]
+            cols = pos[rows] + offsets[rows]
+            frontiers = []
+            for i in range(len(chunk_rels[0])):
+                step_rels = [rels[i] for rels in chunk_rels]
+                reached = self._select(rows, cols, step_rels, num_rows).dot(self.matrix)
+                if i < len(chunk_rels[0]) - 1:
+                    frontiers.append(reached)
+                    rows = np.repeat(np.arange(num_rows, dtype=np.int64), np.diff(reached.indptr))
+                    cols = reached.indices.astype(np.int64)
+            yield start, reached, frontiers
+
+    def row_ids(self, reached, row):
+        """
+        Node ids in row of a matrix from reach.
+        """
+        return self.ids[reached.indices[reached.indptr[row]:reached.indptr[row + 1]]]
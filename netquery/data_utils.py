@@ -1,19 +1,75 @@
 from collections import defaultdict
+import os
 import pickle as pickle
 from multiprocessing import Process
-from netquery.graph import Query
+from netquery.graph import Query, QueryList
 
-def load_queries(data_file, keep_graph=False):
+def dense_id_maps(id_lists):
+    """
+    Map from mode -> node id -> dense id, the dense id of a node being its
+    position in id_lists[mode]. The null node -1 stays -1.
+    """
+    id_maps = {m : {n : i for i, n in enumerate(id_list)} for m, id_list in id_lists.items()}
+    for m in id_maps:
+        id_maps[m][-1] = -1
+    return id_maps
+
+def remap_adj_lists(adj_lists, id_maps):
+    return {rel : {id_maps[rel[0]][node] : set([id_maps[rel[-1]][n] for n in neighs])
+                for node, neighs in adjs.items()}
+            for rel, adjs in adj_lists.items()}
+
+def load_dense_graph_data(data_dir):
+    """
+    Loads (rels, adj_lists, id_lists) of data_dir/graph_data.pkl with the nodes of every
+    mode renumbered 0..n-1: dense id i of mode m is node id_lists[m][i].
+    The renumbered graph is saved as data_dir/graph_data-dense.pkl, which also serves as
+    the persistent id mapping, and is read from there while it is newer than graph_data.pkl.
+    """
+    data_file = os.path.join(data_dir, "graph_data.pkl")
+    dense_file = os.path.join(data_dir, "graph_data-dense.pkl")
+    if os.path.exists(dense_file) and os.path.getmtime(dense_file) >= os.path.getmtime(data_file):
+        return pickle.load(open(dense_file, "rb"))
+    rels, adj_lists, id_lists = pickle.load(open(data_file, "rb"))
+    adj_lists = remap_adj_lists(adj_lists, dense_id_maps(id_lists))
+    pickle.dump((rels, adj_lists, id_lists), open(dense_file, "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+    return rels, adj_lists, id_lists
+
+def load_queries(data_file, keep_graph=False, id_maps=None):
     raw_info = pickle.load(open(data_file, "rb"))
-    return [Query.deserialize(info, keep_graph=keep_graph) for info in raw_info]
+    queries = [Query.deserialize(info, keep_graph=keep_graph) for info in raw_info]
+    if not id_maps is None:
+        queries = [query.remap(id_maps) for query in queries]
+    return queries
 
-def load_queries_by_formula(data_file):
+def _pack_queries(queries, lazy=False):
+    """
+    Turns the per formula query lists into QueryLists, packing the negatives of
+    each formula into its ragged QueryBatch.
+    lazy -- if True, a formula is only packed when it is first read
+    """
+    for query_type in queries:
+        for formula in queries[query_type]:
+            formula_queries = QueryList(queries[query_type][formula])
+            if not lazy:
+                formula_queries.batch
+            queries[query_type][formula] = formula_queries
+    return queries
+
+def load_queries_by_formula(data_file, id_maps=None, lazy=False):
+    """
+    id_maps -- map from mode -> node id -> dense id, to renumber the queries for a graph
+               loaded with dense ids (see load_dense_graph_data)
+    lazy -- defer packing the negatives of a formula to its first read (see _pack_queries)
+    """
     raw_info = pickle.load(open(data_file, "rb"))
     queries = defaultdict(lambda : defaultdict(list))
     for raw_query in raw_info:
         query = Query.deserialize(raw_query)
+        if not id_maps is None:
+            query.remap(id_maps)
         queries[query.formula.query_type][query.formula].append(query)
-    return queries
+    return _pack_queries(queries, lazy=lazy)
 
 def load_queries_by_type(data_file, keep_graph=True):
     raw_info = pickle.load(open(data_file, "rb"))
@@ -24,22 +80,25 @@ def load_queries_by_type(data_file, keep_graph=True):
     return queries
 
 
-def load_test_queries_by_formula(data_file):
+def load_test_queries_by_formula(data_file, id_maps=None, lazy=False):
     raw_info = pickle.load(open(data_file, "rb"))
     queries = {"full_neg" : defaultdict(lambda : defaultdict(list)), 
             "one_neg" : defaultdict(lambda : defaultdict(list))}
     for raw_query in raw_info:
         neg_type = "full_neg" if len(raw_query[1]) > 1 else "one_neg"
         query = Query.deserialize(raw_query)
+        if not id_maps is None:
+            query.remap(id_maps)
         queries[neg_type][query.formula.query_type][query.formula].append(query)
+    for neg_type in queries:
+        _pack_queries(queries[neg_type], lazy=lazy)
     return queries
 
 def sample_clean_test(graph_loader, data_dir):
-    train_graph = graph_loader()
-    test_graph = graph_loader()
     test_edges = load_queries(data_dir + "/test_edges.pkl")
     val_edges = load_queries(data_dir + "/val_edges.pkl")
-    train_graph.remove_edges([(q.target_node, q.formula.rels[0], q.anchor_nodes[0]) for q in test_edges+val_edges])
+    train_graph, test_graph = graph_loader().split(
+        [[(q.target_node, q.formula.rels[0], q.anchor_nodes[0]) for q in test_edges+val_edges]])
     test_queries_2 = test_graph.sample_test_queries(train_graph, ["2-chain", "2-inter"], 9000, 1)
     test_queries_2.extend(test_graph.sample_test_queries(train_graph, ["2-chain", "2-inter"], 1000, 1000))
     val_queries_2 = test_graph.sample_test_queries(train_graph, ["2-chain", "2-inter"], 10, 900)
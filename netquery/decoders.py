@@ -4,6 +4,7 @@ from torch.nn import init
 
 import numpy as np
 import torch.nn.functional as F
+from functools import reduce
 """
 A set of decoder modules.
 Each decoder takes pairs of embeddings and predicts relationship scores given these embeddings.
@@ -138,17 +139,39 @@ class BilinearMetapathDecoder(nn.Module):
                 self.mats[rel] = nn.Parameter(torch.FloatTensor(dims[rel[0]], dims[rel[2]]))
                 init.xavier_uniform_(self.mats[rel])
                 self.register_parameter("_".join(rel), self.mats[rel])
+        self.composed_cache = {}
+
+    def composed(self, rels):
+        """
+        Product of the matrices of rels, in order, so that a whole batch goes through a
+        chain with a single matrix product. Without autograd (i.e., at inference) the
+        products are cached per rels, and recomputed once one of their matrices has
+        been updated, as tracked by the version counters of the parameters.
+        """
+        mats = [self.mats[rel] for rel in rels]
+        if torch.is_grad_enabled():
+            return reduce(torch.mm, mats)
+        version = tuple((mat._version, mat.data_ptr()) for mat in mats)
+        cached = self.composed_cache.get(tuple(rels))
+        if cached is None or cached[0] != version:
+            cached = (version, reduce(torch.mm, mats))
+            self.composed_cache[tuple(rels)] = cached
+        return cached[1]
 
     def forward(self, embeds1, embeds2, rels):
-        act = embeds1.t()
-        for i_rel in rels:
-            act = act.mm(self.mats[i_rel])
+        act = embeds1.t().mm(self.composed(rels))
         act = self.cos(act.t(), embeds2)
         return act
 
     def project(self, embeds, rel):
         return self.mats[rel].mm(embeds)
 
+    def project_path(self, embeds, rels):
+        """
+        Same as projecting embeds by each relation of rels in turn.
+        """
+        return self.composed(rels[::-1]).mm(embeds)
+
 
    
 class DotBilinearMetapathDecoder(nn.Module):
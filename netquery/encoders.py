@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.nn import init
 import torch.nn.functional as F
+from collections import defaultdict
 
 """
 Set of modules for encoding nodes.
@@ -52,7 +53,9 @@ class Encoder(nn.Module):
             out_dims, relations, adj_lists, aggregator,
             base_model=None, cuda=False, 
             layer_norm=False,
-            feature_modules={}): 
+            feature_modules={},
+            sampler=None,
+            feature_layer=None): 
         """
         Initializes the model for a specific graph.
 
@@ -65,6 +68,11 @@ class Encoder(nn.Module):
         base_model       -- if features are from another encoder, pass it here for training
         cuda             -- whether or not to move params to the GPU
         feature_modules  -- if features come from torch.nn module, pass the modules here for training
+        sampler          -- csr_graph.NeighborSampler over adj_lists, to sample the neighbors of
+                            whole batches at once; by default they are looked up node by node
+        feature_layer    -- with a base_model, the layer of the base_model chain the features are
+                            the output of (1 for the first Encoder). Together with a sampler, this
+                            lets forward compute the whole stack layer by layer (see forward_layers)
         """
 
         super(Encoder, self).__init__()
@@ -74,6 +82,9 @@ class Encoder(nn.Module):
         self.adj_lists = adj_lists
         self.relations = relations
         self.aggregator = aggregator
+        self.sampler = sampler
+        self.feature_layer = feature_layer
+        self.embed_cache = None
         for name, module in feature_modules.items():
             self.add_module("feat-"+name, module)
         if base_model != None:
@@ -105,29 +116,206 @@ class Encoder(nn.Module):
         """
         Generates embeddings for a batch of nodes.
 
-        nodes     -- list of nodes
+        nodes     -- list or LongTensor of nodes
         mode      -- string desiginating the mode of the nodes
+        keep_prob -- as in forward_layers. Computed layer by layer, every layer samples with
+                     its own value; otherwise this layer takes the last one, and the lower
+                     layers, called through the features, their defaults
+        max_keep  -- same as keep_prob
         """
+        if not self.embed_cache is None:
+            return _gather_rows(*self.embed_cache[mode], nodes).t()
+        if not self.sampler is None and (not hasattr(self, "base_model") or not self.feature_layer is None):
+            return self.forward_layers(nodes, mode, keep_prob, max_keep)
+        num_layers = len(self.layers())
+        keep_prob = _per_layer(keep_prob, num_layers, "keep_prob")[-1]
+        max_keep = _per_layer(max_keep, num_layers, "max_keep")[-1]
         self_feat = self.features(nodes, mode).t()
+        if isinstance(nodes, torch.Tensor) and self.sampler is None:
+            nodes = nodes.tolist()
         neigh_feats = []
         for to_r in self.relations[mode]:
             rel = (mode, to_r[1], to_r[0])
-            to_neighs = [[-1] if node == -1 else self.adj_lists[rel][node] for node in nodes]
-            
-            # Special null neighbor for nodes with no edges of this type
-            to_neighs = [[-1] if len(l) == 0 else l for l in to_neighs]
-            to_feats = self.aggregator.forward(to_neighs, rel, keep_prob, max_keep)
+            if self.sampler is None:
+                to_neighs = [[-1] if node == -1 else self.adj_lists[rel][node] for node in nodes]
+                
+                # Special null neighbor for nodes with no edges of this type
+                to_neighs = [[-1] if len(l) == 0 else l for l in to_neighs]
+                to_feats = self.aggregator.forward(to_neighs, rel, keep_prob, max_keep)
+            else:
+                neighs, offsets = self.sampler.sample(nodes, rel, keep_prob, max_keep,
+                        replace=self.aggregator.sample_replace)
+                to_feats = self.aggregator.aggregate(neighs, offsets, rel)
             to_feats = to_feats.t()
             neigh_feats.append(to_feats)
         
         neigh_feats.append(self_feat)
-        combined = torch.cat(neigh_feats, dim=0)
+        return self._combine(neigh_feats, mode)
+
+    def _combine(self, feats, mode):
+        combined = torch.cat(feats, dim=0)
         combined = self.compress_params[mode].mm(combined)
         if self.layer_norm:
             combined = self.lns[mode](combined.t()).t()
         combined = F.relu(combined)
         return combined
 
+    def layers(self):
+        """
+        The Encoders of the stack this one tops, first layer first.
+        """
+        layers = [self]
+        while hasattr(layers[0], "base_model"):
+            layers.insert(0, layers[0].base_model)
+        return layers
+
+    def _input_layer(self):
+        return self.feature_layer if hasattr(self, "base_model") else 0
+
+    def _layer_embeds(self, mode, nodes, samples, outputs):
+        """
+        Embeddings [len(nodes), out_dim] of this layer, from the outputs of the lower layers,
+        outputs[k] being a map from mode -> (sorted node ids, embeddings) of layer k.
+        """
+        neigh_feats = []
+        for rel, neighs, offsets in samples:
+            lower_nodes, lower_embeds = outputs[-1][rel[-1]]
+            index = _row_index(lower_nodes, neighs)
+            neigh_feats.append(self.aggregator.pool(lower_embeds, index, offsets, rel).t())
+        neigh_feats.append(_gather_rows(*outputs[self._input_layer()][mode], nodes).t())
+        return self._combine(neigh_feats, mode).t()
+
+    def _sample(self, mode, nodes, keep_prob, max_keep):
+        samples = []
+        for to_r in self.relations[mode]:
+            rel = (mode, to_r[1], to_r[0])
+            neighs, offsets = self.sampler.sample(nodes, rel, keep_prob, max_keep,
+                    replace=self.aggregator.sample_replace)
+            samples.append((rel, neighs, offsets))
+        return samples
+
+    def forward_layers(self, nodes, mode, keep_prob=0.5, max_keep=10):
+        """
+        Same as forward for a stack of Encoders with a sampler, but every layer is computed
+        once per distinct node: the nodes each layer needs are gathered top-down, sampling
+        the neighbors of every node once, then the layers are computed bottom-up for
+        exactly those nodes.
+
+        keep_prob -- probability of keeping a neighbor, for every layer, or a list of
+                     them, one per layer of the stack first layer first
+        max_keep  -- maximum number of neighbors kept per node, same as keep_prob
+        """
+        layers = self.layers()
+        keep_probs = _per_layer(keep_prob, len(layers), "keep_prob")
+        max_keeps = _per_layer(max_keep, len(layers), "max_keep")
+        if isinstance(nodes, torch.Tensor):
+            nodes = nodes.cpu()
+        nodes = torch.as_tensor(nodes, dtype=torch.long)
+        needed = [defaultdict(list) for _ in range(len(layers)+1)]
+        needed[-1][mode].append(nodes)
+        plans = [None] * (len(layers)+1)
+        for k in range(len(layers), 0, -1):
+            layer = layers[k-1]
+            plans[k] = {}
+            for m, parts in needed[k].items():
+                m_nodes = torch.unique(torch.cat(parts))
+                samples = layer._sample(m, m_nodes, keep_probs[k-1], max_keeps[k-1])
+                for rel, neighs, _ in samples:
+                    needed[k-1][rel[-1]].append(neighs)
+                needed[layer._input_layer()][m].append(m_nodes)
+                plans[k][m] = (m_nodes, samples)
+        outputs = [{}]
+        for m, parts in needed[0].items():
+            m_nodes = torch.unique(torch.cat(parts))
+            outputs[0][m] = (m_nodes, _feature_rows(layers[0].features, m_nodes, m))
+        for k in range(1, len(layers)+1):
+            outputs.append({m : (m_nodes, layers[k-1]._layer_embeds(m, m_nodes, samples, outputs))
+                    for m, (m_nodes, samples) in plans[k].items()})
+        return _gather_rows(*outputs[-1][mode], nodes).t()
+
+    def cache_embeddings(self, node_lists=None, keep_prob=0.5, max_keep=10, batch_size=10000):
+        """
+        Inference mode: computes the embeddings of every node of every mode once, layer by
+        layer over the full graph, and answers forward from them until clear_cache.
+        Needs a sampler, and the feature_layer of every Encoder above the first.
+
+        node_lists -- map from mode -> ids of the nodes to embed; by default every node
+                      of the sampler's graph
+        keep_prob  -- as in forward_layers, for every layer or one per layer
+        max_keep   -- as in forward_layers, for every layer or one per layer
+        """
+        if self.sampler is None:
+            raise Exception("Precomputing embeddings requires a neighbor sampler")
+        if node_lists is None:
+            node_lists = {m : index.ids for m, index in self.sampler.adj_lists.node_index.items()}
+        # the null node -1 is the neighbor of nodes without edges
+        node_lists = {m : torch.unique(torch.cat([torch.LongTensor([-1]), torch.as_tensor(ids, dtype=torch.long)]))
+                for m, ids in node_lists.items()}
+        layers = self.layers()
+        keep_probs = _per_layer(keep_prob, len(layers), "keep_prob")
+        max_keeps = _per_layer(max_keep, len(layers), "max_keep")
+        self.clear_cache()
+        with torch.no_grad():
+            outputs = [{m : (m_nodes, _feature_rows(layers[0].features, m_nodes, m))
+                    for m, m_nodes in node_lists.items()}]
+            for layer, keep_prob, max_keep in zip(layers, keep_probs, max_keeps):
+                embeds = {}
+                for m, m_nodes in node_lists.items():
+                    if not m in layer.relations:
+                        continue
+                    embeds[m] = (m_nodes, torch.cat([
+                        layer._layer_embeds(m, m_nodes[i:i+batch_size],
+                            layer._sample(m, m_nodes[i:i+batch_size], keep_prob, max_keep), outputs)
+                        for i in range(0, len(m_nodes), batch_size)]))
+                outputs.append(embeds)
+        self.embed_cache = outputs[-1]
+        return self.embed_cache
+
+    def clear_cache(self):
+        self.embed_cache = None
+
+
+def _feature_rows(features, nodes, mode):
+    embeds = features(nodes, mode)
+    if len(embeds.size()) == 1:
+        embeds = embeds.unsqueeze(dim=0)
+    return embeds
+
+def _row_index(node_ids, nodes):
+    """
+    Positions of nodes in node_ids, the sorted ids of the rows;
+    raises a KeyError naming the nodes that have no row.
+    """
+    if isinstance(nodes, torch.Tensor):
+        nodes = nodes.cpu()
+    nodes = torch.as_tensor(nodes, dtype=torch.long)
+    if len(node_ids) == 0:
+        found = torch.zeros(nodes.size(), dtype=torch.bool)
+        index = torch.zeros_like(nodes)
+    else:
+        index = torch.searchsorted(node_ids, nodes).clamp(max=len(node_ids)-1)
+        found = node_ids[index] == nodes
+    if not bool(found.all()):
+        raise KeyError("No embeddings of nodes {}".format(torch.unique(nodes[~found]).tolist()))
+    return index
+
+def _gather_rows(node_ids, embeds, nodes):
+    """
+    Rows of embeds for nodes, node_ids being the sorted ids of the rows.
+    """
+    return embeds[_row_index(node_ids, nodes).to(embeds.device)]
+
+def _per_layer(value, num_layers, name):
+    """
+    A sampling parameter for every layer: value itself if it is a list, one per layer
+    first layer first, else value for all of them.
+    """
+    if isinstance(value, (list, tuple)):
+        if len(value) != num_layers:
+            raise Exception("{:s} has {:d} values for {:d} layers".format(name, len(value), num_layers))
+        return list(value)
+    return [value] * num_layers
+
 
 class LayerNorm(nn.Module):
     """
@@ -1,5 +1,7 @@
-from collections import OrderedDict, defaultdict
+from collections import defaultdict
 import random
+import torch
+from netquery.graph_base import BaseGraph
 
 def _reverse_relation(relation):
     return (relation[-1], relation[1], relation[0])
@@ -65,6 +67,26 @@ class Query():
         else:
             self.hard_neg_samples =  None
 
+    def remap(self, id_maps):
+        """
+        Renumbers the nodes of the query in place.
+        id_maps -- map from mode -> old node id -> new node id
+        """
+        def _remap_edge(edge):
+            if isinstance(edge[0], tuple):
+                return tuple([_remap_edge(e) for e in edge])
+            return (id_maps[edge[1][0]][edge[0]], edge[1], id_maps[edge[1][-1]][edge[-1]])
+        target_map = id_maps[self.formula.target_mode]
+        self.target_node = target_map[self.target_node]
+        self.anchor_nodes = tuple([id_maps[mode][n] for mode, n in zip(self.formula.anchor_modes, self.anchor_nodes)])
+        if not self.neg_samples is None:
+            self.neg_samples = [target_map[n] for n in self.neg_samples]
+        if not self.hard_neg_samples is None:
+            self.hard_neg_samples = [target_map[n] for n in self.hard_neg_samples]
+        if not self.query_graph is None:
+            self.query_graph = (self.query_graph[0],) + tuple([_remap_edge(e) for e in self.query_graph[1:]])
+        return self
+
     def contains_edge(self, edge):
         if self.query_graph is None:
             raise Exception("Can only test edge contain if graph is kept. Reinit with keep_graph=True")
@@ -101,66 +123,122 @@ class Query():
 
 
 
-class Graph():
+class RaggedTensor():
     """
-    Simple container for heteregeneous graph data.
+    Rows of varying length packed as a flat values tensor and row offsets,
+    row i being values[offsets[i]:offsets[i+1]].
+    Slicing rows returns a view sharing the values.
     """
-    def __init__(self, features, feature_dims, relations, adj_lists):
-        self.features = features
-        self.feature_dims = feature_dims
-        self.relations = relations
-        self.adj_lists = adj_lists
-        self.full_sets = defaultdict(set)
-        self.full_lists = {}
-        self.meta_neighs = defaultdict(dict)
-        for rel, adjs in self.adj_lists.items():
-            full_set = set(self.adj_lists[rel].keys())
-            self.full_sets[rel[0]] = self.full_sets[rel[0]].union(full_set)
-        for mode, full_set in self.full_sets.items():
-            self.full_lists[mode] = list(full_set)
-        self._cache_edge_counts()
-        self._make_flat_adj_lists()
-
-    def _make_flat_adj_lists(self):
-        self.flat_adj_lists = defaultdict(lambda : defaultdict(list))
-        for rel, adjs in self.adj_lists.items():
-            for node, neighs in adjs.items():
-                self.flat_adj_lists[rel[0]][node].extend([(rel, neigh) for neigh in neighs])
-
-    def _cache_edge_counts(self):
-        self.edges = 0.
-        self.rel_edges = {}
-        for r1 in self.relations:
-            for r2 in self.relations[r1]:
-                rel = (r1,r2[1], r2[0])
-                self.rel_edges[rel] = 0.
-                for adj_list in list(self.adj_lists[rel].values()):
-                    self.rel_edges[rel] += len(adj_list)
-                    self.edges += 1.
-        self.rel_weights = OrderedDict()
-        self.mode_edges = defaultdict(float)
-        self.mode_weights = OrderedDict()
-        for rel, edge_count in self.rel_edges.items():
-            self.rel_weights[rel] = edge_count / self.edges
-            self.mode_edges[rel[0]] += edge_count
-        for mode, edge_count in self.mode_edges.items():
-            self.mode_weights[mode] = edge_count / self.edges
-
-    def remove_edges(self, edge_list):
-        for edge in edge_list:
-            try:
-                self.adj_lists[edge[1]][edge[0]].remove(edge[-1])
-            except Exception:
-                continue
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
 
-            try:
-                self.adj_lists[_reverse_relation(edge[1])][edge[-1]].remove(edge[0])
-            except Exception:
-                continue
-        self.meta_neighs = defaultdict(dict)
-        self._cache_edge_counts()
-        self._make_flat_adj_lists()
+    @staticmethod
+    def from_lists(rows):
+        """
+        rows -- list of lists of ints; None rows are empty
+        """
+        lengths = [0 if row is None else len(row) for row in rows]
+        offsets = torch.zeros(len(rows) + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.LongTensor(lengths), 0)
+        values = torch.LongTensor([n for row in rows if not row is None for n in row])
+        return RaggedTensor(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise Exception("Only contiguous row slices are supported")
+            return RaggedTensor(self.values, self.offsets[start:max(start, stop) + 1])
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def sample(self, generator=None):
+        """
+        One uniformly random value from every row, drawn with a single vectorized op.
+        """
+        lengths = self.lengths()
+        if len(lengths) > 0 and lengths.min().item() == 0:
+            raise Exception("Cannot sample from empty rows")
+        picks = (torch.rand(len(lengths), generator=generator) * lengths.double()).long()
+        return self.values[self.offsets[:-1] + torch.min(picks, lengths - 1)]
 
+
+class QueryBatch():
+    """
+    Tensor form of a list of queries of one formula: target_nodes [num_queries] and
+    anchor_nodes [num_queries, num_anchors] LongTensors of node ids, and the negative
+    samples as RaggedTensors. Contiguous slices are views of the same storage.
+    """
+    def __init__(self, target_nodes, anchor_nodes, neg_samples, hard_neg_samples):
+        self.target_nodes = target_nodes
+        self.anchor_nodes = anchor_nodes
+        self.neg_samples = neg_samples
+        self.hard_neg_samples = hard_neg_samples
+
+    @staticmethod
+    def from_queries(queries):
+        num_anchors = len(queries[0].anchor_nodes) if len(queries) > 0 else 0
+        return QueryBatch(
+                torch.LongTensor([q.target_node for q in queries]),
+                torch.LongTensor([q.anchor_nodes for q in queries]).view(len(queries), num_anchors),
+                RaggedTensor.from_lists([q.neg_samples for q in queries]),
+                RaggedTensor.from_lists([q.hard_neg_samples for q in queries]))
+
+    def __len__(self):
+        return len(self.target_nodes)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise Exception("QueryBatch only supports slicing")
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise Exception("Only contiguous slices are supported")
+        stop = max(start, stop)
+        return QueryBatch(self.target_nodes[start:stop], self.anchor_nodes[start:stop],
+                self.neg_samples[start:stop], self.hard_neg_samples[start:stop])
+
+
+class QueryList(list):
+    """
+    List of the queries of one formula, along with their QueryBatch (batch).
+    The query loaders pack the batch at load time; a QueryList built without
+    one packs it on first use. Contiguous slices keep the batch as a view, so the models can
+    read the anchors, targets and negatives of a slice as tensors.
+    """
+    def __init__(self, queries, batch=None):
+        super(QueryList, self).__init__(queries)
+        self._batch = batch
+
+    @property
+    def batch(self):
+        if self._batch is None:
+            self._batch = QueryBatch.from_queries(self)
+        return self._batch
+
+    @property
+    def neg_samples(self):
+        return self.batch.neg_samples
+
+    @property
+    def hard_neg_samples(self):
+        return self.batch.hard_neg_samples
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and index.step in (None, 1):
+            return QueryList(list.__getitem__(self, index), self.batch[index])
+        return list.__getitem__(self, index)
+
+
+class Graph(BaseGraph):
+    """
+    Simple container for heteregeneous graph data.
+    """
     def get_all_edges(self, seed=0, exclude_rels=set([])):
         """
         Returns all edges in the form (node1, relation, node2)
@@ -201,15 +279,52 @@ class Graph():
         neg_nodes = list(neg_nodes) if len(neg_nodes) <= num else random.sample(list(neg_nodes), num)
         return neg_nodes
 
-    def sample_test_queries(self, train_graph, q_types, samples_per_type, neg_sample_max, verbose=True):
+    def sample_test_queries(self, train_graph, q_types, samples_per_type, neg_sample_max, verbose=True,
+            batch_size=1000):
+        """
+        Candidate query graphs are drawn batch_size at a time, and the metapaths their
+        checks against train_graph and their negatives need are expanded for the whole
+        batch at once (see prefetch_metapath_neighs).
+        """
         queries = []
         for q_type in q_types:
             sampled = 0
             while sampled < samples_per_type:
-                q = self.sample_query_subgraph_bytype(q_type)
-                if q is None or not train_graph._is_negative(q, q[1][0], False):
-                    continue
-                negs, hard_negs = self.get_negative_samples(q)
+                num_cands = min(batch_size, max(4 * (samples_per_type - sampled), 256))
+                batch = [self.sample_query_subgraph_bytype(q_type) for _ in range(num_cands)]
+                batch = [q for q in batch if not q is None]
+                train_graph.prefetch_metapath_neighs([path for q in batch for path in train_graph._negative_check_metapaths(q, q[1][0])])
+                batch = [q for q in batch if train_graph._is_negative(q, q[1][0], False)]
+                self.prefetch_metapath_neighs([path for q in batch for path in self._query_metapaths(q)])
+                for q in batch:
+                    if sampled == samples_per_type:
+                        break
+                    negs, hard_negs = self.get_negative_samples(q, neg_sample_max)
+                    if negs is None or ("inter" in q[0] and hard_negs is None):
+                        continue
+                    query = Query(q, negs, hard_negs, neg_sample_max=neg_sample_max, keep_graph=True)
+                    queries.append(query)
+                    sampled += 1
+                    if sampled % 1000 == 0 and verbose:
+                        print("Sampled", sampled)
+        return queries
+
+    def sample_queries(self, arity, num_samples, neg_sample_max, verbose=True, batch_size=1000):
+        """
+        Query graphs are drawn and their metapaths expanded batch_size at a time,
+        as in sample_test_queries.
+        """
+        sampled = 0
+        queries = []
+        while sampled < num_samples:
+            num_cands = min(batch_size, max(4 * (num_samples - sampled), 256))
+            batch = [self.sample_query_subgraph(arity) for _ in range(num_cands)]
+            batch = [q for q in batch if not q is None]
+            self.prefetch_metapath_neighs([path for q in batch for path in self._query_metapaths(q)])
+            for q in batch:
+                if sampled == num_samples:
+                    break
+                negs, hard_negs = self.get_negative_samples(q, neg_sample_max)
                 if negs is None or ("inter" in q[0] and hard_negs is None):
                     continue
                 query = Query(q, negs, hard_negs, neg_sample_max=neg_sample_max, keep_graph=True)
@@ -219,77 +334,6 @@ class Graph():
                     print("Sampled", sampled)
         return queries
 
-    def sample_queries(self, arity, num_samples, neg_sample_max, verbose=True):
-        sampled = 0
-        queries = []
-        while sampled < num_samples:
-            q = self.sample_query_subgraph(arity)
-            if q is None:
-                continue
-            negs, hard_negs = self.get_negative_samples(q)
-            if negs is None or ("inter" in q[0] and hard_negs is None):
-                continue
-            query = Query(q, negs, hard_negs, neg_sample_max=neg_sample_max, keep_graph=True)
-            queries.append(query)
-            sampled += 1
-            if sampled % 1000 == 0 and verbose:
-                print("Sampled", sampled)
-        return queries
-
-
-    def get_negative_samples(self, query):
-        if query[0] == "3-chain" or query[0] == "2-chain":
-            edges = query[1:]
-            rels = [_reverse_relation(edge[1]) for edge in edges[::-1]]
-            meta_neighs = self.get_metapath_neighs(query[-1][-1], tuple(rels))
-            negative_samples = self.full_sets[query[1][1][0]] - meta_neighs
-            if len(negative_samples) == 0:
-                return None, None
-            else:
-                return negative_samples, None
-        elif query[0] == "2-inter" or query[0] == "3-inter":
-            rel_1 = _reverse_relation(query[1][1])
-            union_neighs = self.adj_lists[rel_1][query[1][-1]]
-            inter_neighs = self.adj_lists[rel_1][query[1][-1]]
-            for i in range(2,len(query)):
-                rel = _reverse_relation(query[i][1])
-                union_neighs = union_neighs.union(self.adj_lists[rel][query[i][-1]])
-                inter_neighs = inter_neighs.intersection(self.adj_lists[rel][query[i][-1]])
-            neg_samples = self.full_sets[query[1][1][0]] - inter_neighs
-            hard_neg_samples = union_neighs - inter_neighs
-            if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
-                return None, None
-            return neg_samples, hard_neg_samples
-        elif query[0] == "3-inter_chain":
-            rel_1 = _reverse_relation(query[1][1])
-            union_neighs = self.adj_lists[rel_1][query[1][-1]]
-            inter_neighs = self.adj_lists[rel_1][query[1][-1]]
-            chain_rels = [_reverse_relation(edge[1]) for edge in query[2][::-1]]
-            chain_neighs = self.get_metapath_neighs(query[2][-1][-1], tuple(chain_rels))
-            union_neighs = union_neighs.union(chain_neighs)
-            inter_neighs = inter_neighs.intersection(chain_neighs)
-            neg_samples = self.full_sets[query[1][1][0]] - inter_neighs
-            hard_neg_samples = union_neighs - inter_neighs
-            if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
-                return None, None
-            return neg_samples, hard_neg_samples
-        elif query[0] == "3-chain_inter":
-            inter_rel_1 = _reverse_relation(query[-1][0][1])
-            inter_neighs_1 = self.adj_lists[inter_rel_1][query[-1][0][-1]]
-            inter_rel_2 = _reverse_relation(query[-1][1][1])
-            inter_neighs_2 = self.adj_lists[inter_rel_2][query[-1][1][-1]]
-            
-            inter_neighs = inter_neighs_1.intersection(inter_neighs_2)
-            union_neighs = inter_neighs_1.union(inter_neighs_2)
-            rel = _reverse_relation(query[1][1])
-            pos_nodes = set([n for neigh in inter_neighs for n in self.adj_lists[rel][neigh]]) 
-            union_pos_nodes = set([n for neigh in union_neighs for n in self.adj_lists[rel][neigh]]) 
-            neg_samples = self.full_sets[query[1][1][0]] - pos_nodes
-            hard_neg_samples = union_pos_nodes - pos_nodes
-            if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
-                return None, None
-            return neg_samples, hard_neg_samples
-
     def sample_edge(self, node, mode):
         rel, neigh = random.choice(self.flat_adj_lists[mode][node])
         edge = (node, rel, neigh)
@@ -433,15 +477,6 @@ class Graph():
                 edge_2 = (node, rel_2, neigh_2)
                 return ("2-inter", edge_1, edge_2)
 
-    def get_metapath_neighs(self, node, rels):
-        if node in self.meta_neighs[rels]:
-            return self.meta_neighs[rels][node]
-        current_set = [node]
-        for rel in rels:
-            current_set = set([neigh for n in current_set for neigh in self.adj_lists[rel][n]])
-        self.meta_neighs[rels][node] = current_set
-        return current_set
-
     ## TESTING CODE
 
     def _check_edge(self, query, i):
@@ -0,0 +1,345 @@
+"""
+Adjacency storage shared by graph.Graph and pref_graph.Graph: edge edits and
+copy-on-write views, the metapath cache and the bitset negative samples.
+"""
+import copy
+from collections import OrderedDict, defaultdict
+from functools import reduce
+
+import numpy as np
+
+from netquery.metapath_cache import MetapathCache
+from netquery.csr_graph import CSRAdjLists, NodeBitsets, SparseMetapaths
+
+def _reverse_relation(relation):
+    return (relation[-1], relation[1], relation[0])
+
+
+class BaseGraph():
+    """
+    Heterogeneous graph data with its adjacency lists, which the query and
+    preference graphs sample from.
+    """
+    def __init__(self, features, feature_dims, relations, adj_lists):
+        self.features = features
+        self.feature_dims = feature_dims
+        self.relations = relations
+        self.adj_lists = adj_lists
+        self.full_sets = defaultdict(set)
+        self.full_lists = {}
+        self.meta_neighs = MetapathCache(max_bytes=1 << 30)
+        self.csr_adj_lists = None
+        self.bitsets = None
+        self.metapaths = None
+        self.owned = None
+        for rel, adjs in self.adj_lists.items():
+            full_set = set(self.adj_lists[rel].keys())
+            self.full_sets[rel[0]] = self.full_sets[rel[0]].union(full_set)
+        for mode, full_set in self.full_sets.items():
+            self.full_lists[mode] = list(full_set)
+        self._cache_edge_counts()
+        self._make_flat_adj_lists()
+
+    def _make_flat_adj_lists(self):
+        if isinstance(self.adj_lists, CSRAdjLists):
+            self.flat_adj_lists = self.adj_lists.flat_view()
+            return
+        self.flat_adj_lists = defaultdict(lambda : defaultdict(list))
+        for rel, adjs in self.adj_lists.items():
+            for node, neighs in adjs.items():
+                self.flat_adj_lists[rel[0]][node].extend([(rel, neigh) for neigh in neighs])
+
+    def _cache_edge_counts(self):
+        self.edges = 0.
+        self.rel_edges = {}
+        for r1 in self.relations:
+            for r2 in self.relations[r1]:
+                rel = (r1,r2[1], r2[0])
+                if isinstance(self.adj_lists, CSRAdjLists):
+                    self.rel_edges[rel] = float(self.adj_lists[rel].num_edges())
+                    self.edges += float(len(self.adj_lists[rel]))
+                    continue
+                self.rel_edges[rel] = 0.
+                for adj_list in list(self.adj_lists[rel].values()):
+                    self.rel_edges[rel] += len(adj_list)
+                    self.edges += 1.
+        self._cache_edge_weights()
+
+    def _cache_edge_weights(self):
+        self.rel_weights = OrderedDict()
+        self.mode_edges = defaultdict(float)
+        self.mode_weights = OrderedDict()
+        for rel, edge_count in self.rel_edges.items():
+            self.rel_weights[rel] = edge_count / self.edges
+            self.mode_edges[rel[0]] += edge_count
+        for mode, edge_count in self.mode_edges.items():
+            self.mode_weights[mode] = edge_count / self.edges
+
+    def remove_edges(self, edge_list):
+        """
+        Removes edges given as (head, rel, tail), along with their reverse edges.
+        The edge counts, flat lists and caches are updated for the removed edges only.
+        """
+        self._edit_edges(edge_list, False)
+
+    def add_edges(self, edge_list):
+        """
+        Adds edges given as (head, rel, tail), along with their reverse edges, updating
+        the graph as remove_edges does. A CSR graph only takes edges between its nodes.
+        """
+        self._edit_edges(edge_list, True)
+
+    def view(self):
+        """
+        Copy of the graph sharing its adjacency, flat lists and node sets with this one.
+        What either graph edits afterwards (see add_edges and remove_edges) is copied on
+        its first edit, relation by relation and row by row, so e.g. a train graph is a
+        view of the full graph with the held-out edges removed, at the cost of the rows
+        they touch.
+        """
+        graph = copy.copy(self)
+        graph.full_sets = defaultdict(set, self.full_sets)
+        graph.full_lists = dict(self.full_lists)
+        graph.rel_edges = dict(self.rel_edges)
+        graph.meta_neighs = MetapathCache(self.meta_neighs.max_entries, self.meta_neighs.max_bytes,
+                                          self.meta_neighs.compress)
+        if isinstance(self.adj_lists, CSRAdjLists):
+            graph.adj_lists = self.adj_lists.copy()
+            graph._make_flat_adj_lists()
+        else:
+            graph.adj_lists = copy.copy(self.adj_lists)
+            graph.flat_adj_lists = copy.copy(self.flat_adj_lists)
+        self.owned = set()
+        graph.owned = set()
+        return graph
+
+    def split(self, heldout):
+        """
+        Train/test style views of the graph without nested sets of held-out edges.
+
+        heldout -- lists of edges (head, rel, tail), the reverse edges are held out with them
+
+        Returns len(heldout)+1 graphs, view k without the edges of heldout[k:], so that e.g.
+        train_graph, test_graph = graph.split([test_edges]). On a CSR graph the views share
+        one reordered copy of the CSR arrays and each only adds its row ends (see
+        CSRAdjLists.split); a dict graph falls back to views with the held-out edges removed.
+        """
+        if not isinstance(self.adj_lists, CSRAdjLists):
+            graphs = []
+            for k in range(len(heldout) + 1):
+                graph = self.view()
+                graph.remove_edges([edge for edge_list in heldout[k:] for edge in edge_list])
+                graphs.append(graph)
+            return graphs
+        graphs = []
+        for adj_lists in self.adj_lists.split(heldout):
+            graph = self.view()
+            graph.adj_lists = adj_lists
+            graph._cache_edge_counts()
+            graph._make_flat_adj_lists()
+            graph.metapaths = None
+            graphs.append(graph)
+        return graphs
+
+    def _own(self, table, key, tag):
+        """
+        table[key] for editing: while the graph shares its data with views, it is
+        copied on the first edit.
+        """
+        if not self.owned is None and not (tag, key) in self.owned:
+            table[key] = copy.copy(table[key])
+            self.owned.add((tag, key))
+        return table[key]
+
+    def _edit_row(self, table, tag, key, node, empty):
+        rows = self._own(table, key, tag)
+        if not node in rows:
+            rows[node] = empty()
+            if not self.owned is None:
+                self.owned.add(((tag, key), node))
+            return rows[node]
+        return self._own(rows, node, (tag, key))
+
+    def _edit_edge(self, head, rel, tail, add):
+        """
+        Adds or removes the single edge (head, rel, tail) of a dict graph.
+        Returns whether the graph changed.
+        """
+        if not rel in self.adj_lists:
+            return False
+        neighs = self.adj_lists[rel].get(head)
+        if add == (not neighs is None and tail in neighs):
+            return False
+        if add and neighs is None and rel in self.rel_edges:
+            self.edges += 1.
+        neighs = self._edit_row(self.adj_lists, "adj", rel, head, set)
+        flat_edges = self._edit_row(self.flat_adj_lists, "flat", rel[0], head, list)
+        if add:
+            neighs.add(tail)
+            flat_edges.append((rel, tail))
+        else:
+            neighs.remove(tail)
+            flat_edges.remove((rel, tail))
+        if rel in self.rel_edges:
+            self.rel_edges[rel] += 1. if add else -1.
+        return True
+
+    def _edit_edges(self, edge_list, add):
+        edge_list = list(edge_list)
+        if isinstance(self.adj_lists, CSRAdjLists):
+            if add:
+                self.adj_lists.add_edges(edge_list)
+            else:
+                self.adj_lists.remove_edges(edge_list)
+            self._cache_edge_counts()
+        else:
+            for head, rel, tail in edge_list:
+                if self._edit_edge(head, rel, tail, add):
+                    self._edit_edge(tail, _reverse_relation(rel), head, add)
+            self._cache_edge_weights()
+            self.csr_adj_lists = None
+        if add:
+            for head, rel, tail in edge_list:
+                for mode, node in ((rel[0], head), (rel[-1], tail)):
+                    if not node in self.full_sets[mode]:
+                        self._own(self.full_sets, mode, "full").add(node)
+                        self.full_lists.setdefault(mode, [])
+                        self._own(self.full_lists, mode, "list").append(node)
+                        self.bitsets = None
+        self.meta_neighs.invalidate_edges(edge_list)
+        self.metapaths = None
+
+    def _csr_adj_lists(self):
+        if isinstance(self.adj_lists, CSRAdjLists):
+            return self.adj_lists
+        if self.csr_adj_lists is None:
+            self.csr_adj_lists = CSRAdjLists.from_adj_lists(self.adj_lists)
+        return self.csr_adj_lists
+
+    def _sparse_metapaths(self):
+        if self.metapaths is None:
+            self.metapaths = SparseMetapaths(self._csr_adj_lists())
+        return self.metapaths
+
+    def prefetch_metapath_neighs(self, paths, chunk_size=10000):
+        """
+        Expands many (node, rels) metapaths at once into the cache of get_metapath_neighs:
+        every step is one sparse matrix product for all of them (see csr_graph.SparseMetapaths),
+        chunk_size metapaths at a time to bound the memory used.
+        """
+        by_length = defaultdict(list)
+        for node, rels in OrderedDict.fromkeys(paths):
+            if not (rels, node) in self.meta_neighs:
+                by_length[len(rels)].append((node, rels))
+        if len(by_length) == 0:
+            return
+        metapaths = self._sparse_metapaths()
+        for length_paths in by_length.values():
+            nodes, rels_list = zip(*length_paths)
+            for start, reached, frontiers in metapaths.reach(nodes, rels_list, chunk_size):
+                for i in range(reached.shape[0]):
+                    self.meta_neighs.put(rels_list[start+i], nodes[start+i], metapaths.row_ids(reached, i),
+                            [metapaths.row_ids(frontier, i) for frontier in frontiers])
+
+    def _query_metapaths(self, query):
+        """
+        The (node, rels) metapaths get_negative_samples expands for query.
+        """
+        if query[0] == "3-chain" or query[0] == "2-chain":
+            return [(query[-1][-1], tuple([_reverse_relation(edge[1]) for edge in query[1:][::-1]]))]
+        if query[0] == "3-inter_chain":
+            return [(query[2][-1][-1], tuple([_reverse_relation(edge[1]) for edge in query[2][::-1]]))]
+        return []
+
+    def _negative_check_metapaths(self, query, neg_node):
+        """
+        The (node, rels) metapaths _is_negative(query, neg_node, ...) expands.
+        """
+        if query[0] == "2-chain":
+            return [(neg_node, (query[1][1], query[2][1]))]
+        if query[0] == "3-chain":
+            return [(neg_node, (query[1][1], query[2][1], query[3][1]))]
+        if query[0] == "3-inter_chain":
+            return [(neg_node, (query[2][0][1], query[2][1][1]))]
+        return []
+
+    def _node_bitsets(self):
+        if self.bitsets is None:
+            self.bitsets = NodeBitsets.from_adj_lists(self.adj_lists, self.full_sets)
+        return self.bitsets
+
+    def _neigh_bits(self, rel, nodes):
+        """
+        Bitset of the nodes reached from any of nodes by rel.
+        """
+        bitsets = self._node_bitsets()
+        if isinstance(self.adj_lists, CSRAdjLists):
+            adj = self.adj_lists[rel]
+            positions = adj.head_index.lookup_many(np.asarray(nodes, dtype=np.int64))
+            return bitsets.from_positions(rel[-1], adj.gather(positions[positions >= 0]))
+        return bitsets.from_nodes(rel[-1], np.asarray([n for node in nodes for n in self.adj_lists[rel][node]], dtype=np.int64))
+
+    def _metapath_bits(self, node, rels):
+        return self._node_bitsets().from_nodes(rels[-1][-1], self.get_metapath_neighs(node, rels))
+
+    def get_negative_samples(self, query, neg_sample_max=None):
+        """
+        Negative and hard negative targets of a query graph, or (None, None) if it has none.
+        Both are lists of node ids, combined as bitsets (see csr_graph.NodeBitsets);
+        with neg_sample_max, only that many of each, drawn at random, are materialized.
+        """
+        bitsets = self._node_bitsets()
+        mode = query[1][1][0]
+        if query[0] == "3-chain" or query[0] == "2-chain":
+            edges = query[1:]
+            rels = [_reverse_relation(edge[1]) for edge in edges[::-1]]
+            neg_bits = bitsets.full[mode] & ~self._metapath_bits(query[-1][-1], tuple(rels))
+            if bitsets.count(neg_bits) == 0:
+                return None, None
+            hard_bits = None
+        else:
+            if query[0] == "2-inter" or query[0] == "3-inter":
+                anchor_bits = [self._neigh_bits(_reverse_relation(query[i][1]), [query[i][-1]]) for i in range(1, len(query))]
+                inter_bits = reduce(np.bitwise_and, anchor_bits)
+                union_bits = reduce(np.bitwise_or, anchor_bits)
+            elif query[0] == "3-inter_chain":
+                chain_rels = [_reverse_relation(edge[1]) for edge in query[2][::-1]]
+                neigh_bits = self._neigh_bits(_reverse_relation(query[1][1]), [query[1][-1]])
+                chain_bits = self._metapath_bits(query[2][-1][-1], tuple(chain_rels))
+                inter_bits = neigh_bits & chain_bits
+                union_bits = neigh_bits | chain_bits
+            elif query[0] == "3-chain_inter":
+                inter_rel_1 = _reverse_relation(query[-1][0][1])
+                inter_neighs_1 = self._neigh_bits(inter_rel_1, [query[-1][0][-1]])
+                inter_neighs_2 = self._neigh_bits(_reverse_relation(query[-1][1][1]), [query[-1][1][-1]])
+                rel = _reverse_relation(query[1][1])
+                inter_bits = self._neigh_bits(rel, bitsets.to_nodes(inter_rel_1[-1], inter_neighs_1 & inter_neighs_2))
+                union_bits = self._neigh_bits(rel, bitsets.to_nodes(inter_rel_1[-1], inter_neighs_1 | inter_neighs_2))
+            neg_bits = bitsets.full[mode] & ~inter_bits
+            hard_bits = union_bits & ~inter_bits
+            if bitsets.count(neg_bits) == 0 or bitsets.count(hard_bits) == 0:
+                return None, None
+        return bitsets.to_nodes(mode, neg_bits, neg_sample_max), \
+               None if hard_bits is None else bitsets.to_nodes(mode, hard_bits, neg_sample_max)
+
+    def set_metapath_cache(self, cache):
+        """
+        Replaces the cache of get_metapath_neighs, e.g. by a MetapathCache with other
+        limits or compressed storage; the default one holds up to about 1GB.
+        """
+        self.meta_neighs = cache
+
+    def get_metapath_neighs(self, node, rels):
+        current_set = self.meta_neighs.get(rels, node)
+        if not current_set is None:
+            return current_set
+        frontiers = []
+        if isinstance(self.adj_lists, CSRAdjLists):
+            current_set = set(self.adj_lists.metapath_neighs(node, rels, frontiers).tolist())
+            return self.meta_neighs.put(rels, node, current_set, frontiers)
+        current_set = [node]
+        for i, rel in enumerate(rels):
+            if i > 0:
+                frontiers.append(current_set)
+            current_set = set([neigh for n in current_set for neigh in self.adj_lists[rel][n]])
+        return self.meta_neighs.put(rels, node, current_set, frontiers)
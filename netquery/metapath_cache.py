@@ -0,0 +1,215 @@
+"""
+Cache of metapath expansions for Graph.get_metapath_neighs.
+
+Entries map (rels, node) to the nodes reached from node by following rels.
+The cache is an LRU bounded by a number of entries and/or an estimate of the
+bytes it holds, and can store the neighbor sets as sorted integer arrays.
+Each entry also keeps the frontiers its expansion went through, indexed by
+(relation, head node), so that removing edges only drops the entries that
+actually used one of them, found without scanning the others.
+"""
+import sys
+from collections import OrderedDict, defaultdict
+from collections.abc import Set
+
+import numpy as np
+
+# estimated bytes of an entry besides its neighbors and frontiers: the key and
+# entry tuples, the frontier list and the slot of the OrderedDict
+_ENTRY_BYTES = sys.getsizeof((None, 0)) + sys.getsizeof((None, None, 0)) + sys.getsizeof([]) + 100
+# estimated bytes of the (rel, head) index: per head, its key tuple and int, its
+# set of entries and the slot of by_head; per entry in one of these sets, its slot
+_INDEX_KEY_BYTES = sys.getsizeof((None, 0)) + 28 + sys.getsizeof(set()) + 48
+_INDEX_SLOT_BYTES = 48
+
+
+def _reverse_relation(relation):
+    return (relation[-1], relation[1], relation[0])
+
+
+def _sorted_ids(nodes):
+    ids = np.unique(np.fromiter(nodes, dtype=np.int64, count=len(nodes)))
+    if len(ids) == 0 or (ids[0] >= np.iinfo(np.int32).min and ids[-1] <= np.iinfo(np.int32).max):
+        ids = ids.astype(np.int32)
+    return ids
+
+
+def _sizeof(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, SortedIdSet):
+        return sys.getsizeof(value) + sys.getsizeof(value.ids)
+    # the set itself plus a small int object per element
+    return sys.getsizeof(value) + 28 * len(value)
+
+
+def _steps(rels, node, frontiers):
+    """
+    The (rel, head) pairs an expansion of node by rels followed rels from.
+    """
+    steps = set([(rels[0], node)])
+    for rel, frontier in zip(rels[1:], frontiers):
+        steps.update((rel, head) for head in frontier.tolist())
+    return steps
+
+
+class SortedIdSet(Set):
+    """
+    Read-only set of node ids stored as a sorted integer array.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __contains__(self, node):
+        i = int(np.searchsorted(self.ids, node))
+        return i < len(self.ids) and self.ids[i] == node
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.ids if dtype is None else self.ids.astype(dtype)
+
+    def __hash__(self):
+        return self._hash()
+
+    @classmethod
+    def _from_iterable(cls, it):
+        # results of set operations are plain sets
+        return set(it)
+
+    def intersection(self, other):
+        return self & other
+
+    def union(self, other):
+        return self | other
+
+
+class MetapathCache():
+    """
+    LRU cache from (rels, node) to metapath neighbors.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, compress=False):
+        """
+        max_entries -- maximum number of cached expansions, None for no limit
+        max_bytes   -- maximum estimated size of the cached neighbor sets and frontiers,
+                       along with the index over them, None for no limit
+        compress    -- store the neighbor sets as sorted int32/int64 arrays (SortedIdSet)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.entries = OrderedDict()
+        self.by_head = defaultdict(set)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        """
+        Whether (rels, node) is cached, without counting as a lookup.
+        """
+        return key in self.entries
+
+    def get(self, rels, node):
+        """
+        Cached neighbors, or None on a miss.
+        """
+        entry = self.entries.get((rels, node))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end((rels, node))
+        return entry[0]
+
+    def put(self, rels, node, neighs, frontiers):
+        """
+        Caches the neighbors of node by rels, a set or an array, and returns them as stored.
+        frontiers -- for i >= 1, the nodes the expansion reached after rels[:i], i.e. the
+                     heads it followed rels[i] from (frontiers[0] is for rels[1])
+        """
+        key = (rels, node)
+        if key in self.entries:
+            self._remove(key)
+        if self.compress:
+            neighs = SortedIdSet(_sorted_ids(neighs))
+        elif isinstance(neighs, np.ndarray):
+            neighs = set(neighs.tolist())
+        frontiers = [_sorted_ids(frontier) for frontier in frontiers]
+        size = _ENTRY_BYTES + _sizeof(neighs) + sum(sys.getsizeof(frontier) for frontier in frontiers)
+        self.entries[key] = (neighs, frontiers, size)
+        self.nbytes += size
+        for step in _steps(rels, node, frontiers):
+            if not step in self.by_head:
+                self.nbytes += _INDEX_KEY_BYTES
+            self.by_head[step].add(key)
+            self.nbytes += _INDEX_SLOT_BYTES
+        self._evict()
+        return neighs
+
+    def _remove(self, key):
+        neighs, frontiers, size = self.entries.pop(key)
+        self.nbytes -= size
+        for step in _steps(key[0], key[1], frontiers):
+            keys = self.by_head[step]
+            keys.discard(key)
+            self.nbytes -= _INDEX_SLOT_BYTES
+            if len(keys) == 0:
+                del self.by_head[step]
+                self.nbytes -= _INDEX_KEY_BYTES
+
+    def _evict(self):
+        while len(self.entries) > 0 and \
+                ((not self.max_entries is None and len(self.entries) > self.max_entries) or
+                 (not self.max_bytes is None and self.nbytes > self.max_bytes)):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate_edges(self, edge_list):
+        """
+        Drops the entries whose expansion followed one of the edges (head, rel, tail)
+        or their reverse edges, as removed by Graph.remove_edges.
+        """
+        stale = set()
+        for head, rel, tail in edge_list:
+            for step in ((rel, head), (_reverse_relation(rel), tail)):
+                if step in self.by_head:
+                    stale.update(self.by_head[step])
+        for key in stale:
+            self._remove(key)
+        self.invalidations += len(stale)
+        return len(stale)
+
+    def clear(self):
+        """
+        Drops every entry and resets the statistics.
+        """
+        self.entries = OrderedDict()
+        self.by_head = defaultdict(set)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return OrderedDict([
+            ("entries", len(self.entries)),
+            ("bytes", self.nbytes),
+            ("hits", self.hits),
+            ("misses", self.misses),
+            ("hit_rate", self.hits / lookups if lookups > 0 else 0.),
+            ("evictions", self.evictions),
+            ("invalidations", self.invalidations)])
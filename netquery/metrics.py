@@ -0,0 +1,125 @@
+"""
+Vectorized ranking metrics for ragged candidate groups.
+
+Query i is scored against one positive target pos_scores[i] and lengths[i]
+negatives, stored back to back in neg_scores (the layout the evaluation loops
+build). All metrics of a batch are computed in one pass over this segment
+layout, on the device the scores live on.
+"""
+from collections import OrderedDict
+
+import torch
+
+
+def _segments(lengths, device):
+    lengths = torch.as_tensor(lengths, dtype=torch.long, device=device)
+    return lengths, torch.repeat_interleave(torch.arange(len(lengths), device=device), lengths)
+
+
+def rank_counts(pos_scores, neg_scores, lengths):
+    """
+    Per query, the number of negatives scored below and tied with the positive.
+    Returns (less, ties, lengths) as tensors of shape [num_queries].
+    """
+    lengths, seg = _segments(lengths, pos_scores.device)
+    pos = pos_scores.detach()
+    neg = neg_scores.detach()
+    target = pos[seg]
+    less = torch.zeros(len(lengths), dtype=torch.long, device=pos.device)
+    ties = torch.zeros(len(lengths), dtype=torch.long, device=pos.device)
+    less.index_add_(0, seg, (neg < target).long())
+    ties.index_add_(0, seg, (neg == target).long())
+    return less, ties, lengths
+
+
+def percentile_scores(pos_scores, neg_scores, lengths):
+    """
+    Percentile rank of every positive among its negatives, as
+    scipy.stats.percentileofscore(negatives, positive) (kind="rank") computes it.
+    Queries without negatives get nan.
+    """
+    less, ties, lengths = rank_counts(pos_scores, neg_scores, lengths)
+    return (2 * less + ties + (ties > 0).long()).double() * (50.0 / lengths.double())
+
+
+def ranking_metrics(pos_scores, neg_scores, lengths, hits=(1, 3, 10)):
+    """
+    Per query metrics of the positive against its negatives, map from name -> tensor [num_queries]:
+        perc   -- percentile rank (see percentile_scores)
+        rr     -- reciprocal rank, ties count as half a rank
+        hits@k -- 1 if the positive ranks in the top k
+        auc    -- fraction of negatives scored below the positive, ties count half
+    """
+    less, ties, lengths = rank_counts(pos_scores, neg_scores, lengths)
+    lengths = lengths.double()
+    greater = lengths - less.double() - ties.double()
+    rank = 1 + greater + 0.5 * ties.double()
+    metrics = OrderedDict()
+    metrics["perc"] = (2 * less + ties + (ties > 0).long()).double() * (50.0 / lengths)
+    metrics["rr"] = 1.0 / rank
+    for k in hits:
+        metrics["hits@{:d}".format(k)] = (rank <= k).double()
+    metrics["auc"] = (less.double() + 0.5 * ties.double()) / lengths
+    return metrics
+
+
+def auc_score(scores, labels):
+    """
+    Area under the ROC curve of binary labels, as sklearn's roc_auc_score computes it
+    (Mann-Whitney statistic with tied scores sharing their average rank).
+    nan scores count as 0, as np.nan_to_num did for the sklearn call.
+    """
+    scores = torch.nan_to_num(torch.as_tensor(scores).detach().double(), nan=0.0)
+    labels = torch.as_tensor(labels, device=scores.device).bool()
+    num_pos = labels.sum().item()
+    num_neg = len(labels) - num_pos
+    if num_pos == 0 or num_neg == 0:
+        raise Exception("AUC is not defined when only one class is present")
+    sorted_scores, order = torch.sort(scores)
+    _, inverse, counts = torch.unique_consecutive(sorted_scores, return_inverse=True, return_counts=True)
+    # average 1-based rank of every group of tied scores
+    ends = torch.cumsum(counts, 0).double()
+    avg_rank = ends - (counts.double() - 1) / 2
+    ranks = avg_rank[inverse]
+    pos_rank_sum = ranks[labels[order]].sum().item()
+    return (pos_rank_sum - num_pos * (num_pos + 1) / 2.0) / (num_pos * num_neg)
+
+
+class RankingMetrics():
+    """
+    Accumulates ranking_metrics over batches, per key (e.g. query formula or
+    preference type), and keeps them on the scores' device until summarized.
+    """
+    def __init__(self, hits=(1, 3, 10)):
+        self.hits = hits
+        self.per_key = OrderedDict()
+
+    def add(self, key, pos_scores, neg_scores, lengths):
+        metrics = ranking_metrics(pos_scores, neg_scores, lengths, self.hits)
+        if not key in self.per_key:
+            self.per_key[key] = OrderedDict((name, []) for name in metrics)
+        for name, values in metrics.items():
+            self.per_key[key][name].append(values)
+        return metrics
+
+    def values(self, key, name):
+        """
+        All per query values of a metric for key, as a tensor.
+        """
+        return torch.cat(self.per_key[key][name])
+
+    def summary(self):
+        """
+        Mean of every metric, per key and over all queries ("all"):
+        map from key -> metric name -> float. perc is a percentage, the others are in [0, 1].
+        """
+        summary = OrderedDict()
+        totals = OrderedDict()
+        for key, metrics in self.per_key.items():
+            summary[key] = OrderedDict()
+            for name, values in metrics.items():
+                values = torch.cat(values)
+                summary[key][name] = values.mean().item()
+                totals.setdefault(name, []).append(values)
+        summary["all"] = OrderedDict((name, torch.cat(values).mean().item()) for name, values in totals.items())
+        return summary
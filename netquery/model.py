@@ -3,7 +3,7 @@ import torch.nn as nn
 import numpy as np
 
 import random
-from netquery.graph import _reverse_relation
+from netquery.graph import _reverse_relation, QueryList
 
 EPS = 10e-6
 
@@ -12,6 +12,42 @@ End-to-end autoencoder models for representation learning on
 heteregenous graphs/networks
 """
 
+def _sample_negatives(graph, formula, queries, hard_negatives=False):
+    """
+    One negative target per query. With a QueryList the negatives of the whole
+    batch are drawn at once from its packed neg_samples / hard_neg_samples.
+    """
+    if formula.query_type == "1-chain" and not hard_negatives:
+        full_list = graph.full_lists[formula.target_mode]
+        return [full_list[i] for i in torch.randint(len(full_list), (len(queries),)).tolist()]
+    if isinstance(queries, QueryList):
+        packed = queries.hard_neg_samples if hard_negatives else queries.neg_samples
+        return packed.sample()
+    if hard_negatives:
+        return [random.choice(query.hard_neg_samples) for query in queries]
+    return [random.choice(query.neg_samples) for query in queries]
+
+def _project_path(path_dec, embeds, rels):
+    """
+    Projects embeds by each relation of rels in turn, with the composed
+    operator of the decoder if it has one.
+    """
+    if hasattr(path_dec, "project_path"):
+        return path_dec.project_path(embeds, rels)
+    for rel in rels:
+        embeds = path_dec.project(embeds, rel)
+    return embeds
+
+def _anchor_nodes(queries, i):
+    if isinstance(queries, QueryList):
+        return queries.batch.anchor_nodes[:, i]
+    return [query.anchor_nodes[i] for query in queries]
+
+def _target_nodes(queries):
+    if isinstance(queries, QueryList):
+        return queries.batch.target_nodes
+    return [query.target_node for query in queries]
+
 class MetapathEncoderDecoder(nn.Module):
     """
     Encoder decoder model that reasons over metapaths
@@ -66,29 +102,42 @@ class QueryEncoderDecoder(nn.Module):
         self.inter_dec = inter_dec
         self.graph = graph
         self.cos = nn.CosineSimilarity(dim=0)
+        self.snapshot = None
+
+    def use_snapshot(self, snapshot):
+        """
+        Serves the node embeddings from a snapshot.EmbeddingSnapshot of enc instead of
+        running enc, for inference; None goes back to enc.
+        """
+        self.snapshot = snapshot
+
+    def embed(self, nodes, mode):
+        if self.snapshot is None:
+            return self.enc(nodes, mode)
+        return self.snapshot(nodes, mode)
 
     def forward(self, formula, queries, source_nodes):
         if formula.query_type == "1-chain" or formula.query_type == "2-chain" or formula.query_type == "3-chain":
             # a chain is simply a call to the path decoder
             return self.path_dec.forward(
-                    self.enc.forward(source_nodes, formula.target_mode), 
-                    self.enc.forward([query.anchor_nodes[0] for query in queries], formula.anchor_modes[0]),
+                    self.embed(source_nodes, formula.target_mode), 
+                    self.embed(_anchor_nodes(queries, 0), formula.anchor_modes[0]),
                     formula.rels)
         elif formula.query_type == "2-inter" or formula.query_type == "3-inter" or formula.query_type == "3-inter_chain":
-            target_embeds = self.enc(source_nodes, formula.target_mode)
+            target_embeds = self.embed(source_nodes, formula.target_mode)
 
-            embeds1 = self.enc([query.anchor_nodes[0] for query in queries], formula.anchor_modes[0])
+            embeds1 = self.embed(_anchor_nodes(queries, 0), formula.anchor_modes[0])
             embeds1 = self.path_dec.project(embeds1, _reverse_relation(formula.rels[0]))
 
-            embeds2 = self.enc([query.anchor_nodes[1] for query in queries], formula.anchor_modes[1])
+            embeds2 = self.embed(_anchor_nodes(queries, 1), formula.anchor_modes[1])
             if len(formula.rels[1]) == 2:
-                for i_rel in formula.rels[1][::-1]:
-                    embeds2 = self.path_dec.project(embeds2, _reverse_relation(i_rel))
+                embeds2 = _project_path(self.path_dec, embeds2,
+                        [_reverse_relation(i_rel) for i_rel in formula.rels[1][::-1]])
             else:
                     embeds2 = self.path_dec.project(embeds2, _reverse_relation(formula.rels[1]))
 
             if formula.query_type == "3-inter":
-                embeds3 = self.enc([query.anchor_nodes[2] for query in queries], formula.anchor_modes[2])
+                embeds3 = self.embed(_anchor_nodes(queries, 2), formula.anchor_modes[2])
                 embeds3 = self.path_dec.project(embeds3, _reverse_relation(formula.rels[2]))
 
                 query_intersection = self.inter_dec(embeds1, embeds2, formula.target_mode, embeds3)
@@ -97,11 +146,11 @@ class QueryEncoderDecoder(nn.Module):
             scores = self.cos(target_embeds, query_intersection)
             return scores
         elif formula.query_type == "3-chain_inter":
-            target_embeds = self.enc(source_nodes, formula.target_mode)
+            target_embeds = self.embed(source_nodes, formula.target_mode)
 
-            embeds1 = self.enc([query.anchor_nodes[0] for query in queries], formula.anchor_modes[0])
+            embeds1 = self.embed(_anchor_nodes(queries, 0), formula.anchor_modes[0])
             embeds1 = self.path_dec.project(embeds1, _reverse_relation(formula.rels[1][0]))
-            embeds2 = self.enc([query.anchor_nodes[1] for query in queries], formula.anchor_modes[1])
+            embeds2 = self.embed(_anchor_nodes(queries, 1), formula.anchor_modes[1])
             embeds2 = self.path_dec.project(embeds2, _reverse_relation(formula.rels[1][1]))
             query_intersection = self.inter_dec(embeds1, embeds2, formula.rels[0][-1])
             query_intersection = self.path_dec.project(query_intersection, _reverse_relation(formula.rels[0]))
@@ -112,14 +161,9 @@ class QueryEncoderDecoder(nn.Module):
     def margin_loss(self, formula, queries, hard_negatives=False, margin=1):
         if not "inter" in formula.query_type and hard_negatives:
             raise Exception("Hard negative examples can only be used with intersection queries")
-        elif hard_negatives:
-            neg_nodes = [random.choice(query.hard_neg_samples) for query in queries]
-        elif formula.query_type == "1-chain":
-            neg_nodes = [random.choice(self.graph.full_lists[formula.target_mode]) for _ in queries]
-        else:
-            neg_nodes = [random.choice(query.neg_samples) for query in queries]
+        neg_nodes = _sample_negatives(self.graph, formula, queries, hard_negatives)
 
-        affs = self.forward(formula, queries, [query.target_node for query in queries])
+        affs = self.forward(formula, queries, _target_nodes(queries))
         neg_affs = self.forward(formula, queries, neg_nodes)
         loss = margin - (affs - neg_affs)
         loss = torch.clamp(loss, min=0)
@@ -137,31 +181,44 @@ class SoftAndEncoderDecoder(nn.Module):
         self.path_dec = path_dec
         self.graph = graph
         self.cos = nn.CosineSimilarity(dim=0)
+        self.snapshot = None
+
+    def use_snapshot(self, snapshot):
+        """
+        Serves the node embeddings from a snapshot.EmbeddingSnapshot of enc instead of
+        running enc, for inference; None goes back to enc.
+        """
+        self.snapshot = snapshot
+
+    def embed(self, nodes, mode):
+        if self.snapshot is None:
+            return self.enc(nodes, mode)
+        return self.snapshot(nodes, mode)
 
     def forward(self, formula, queries, source_nodes):
         if formula.query_type == "1-chain":
             # a chain is simply a call to the path decoder
             return self.path_dec.forward(
-                    self.enc.forward(source_nodes, formula.target_mode), 
-                    self.enc.forward([query.anchor_nodes[0] for query in queries], formula.anchor_modes[0]),
+                    self.embed(source_nodes, formula.target_mode), 
+                    self.embed(_anchor_nodes(queries, 0), formula.anchor_modes[0]),
                     formula.rels)
         elif formula.query_type == "2-inter" or formula.query_type == "3-inter":
-            target_embeds = self.enc(source_nodes, formula.target_mode)
+            target_embeds = self.embed(source_nodes, formula.target_mode)
 
-            embeds1 = self.enc([query.anchor_nodes[0] for query in queries], formula.anchor_modes[0])
+            embeds1 = self.embed(_anchor_nodes(queries, 0), formula.anchor_modes[0])
             embeds1 = self.path_dec.project(embeds1, _reverse_relation(formula.rels[0]))
 
-            embeds2 = self.enc([query.anchor_nodes[1] for query in queries], formula.anchor_modes[1])
+            embeds2 = self.embed(_anchor_nodes(queries, 1), formula.anchor_modes[1])
             if len(formula.rels[1]) == 2:
-                for i_rel in formula.rels[1][::-1]:
-                    embeds2 = self.path_dec.project(embeds2, _reverse_relation(i_rel))
+                embeds2 = _project_path(self.path_dec, embeds2,
+                        [_reverse_relation(i_rel) for i_rel in formula.rels[1][::-1]])
             else:
                     embeds2 = self.path_dec.project(embeds2, _reverse_relation(formula.rels[1]))
 
             scores1 = self.cos(target_embeds, embeds1)
             scores2 = self.cos(target_embeds, embeds2)
             if formula.query_type == "3-inter":
-                embeds3 = self.enc([query.anchor_nodes[2] for query in queries], formula.anchor_modes[2])
+                embeds3 = self.embed(_anchor_nodes(queries, 2), formula.anchor_modes[2])
                 embeds3 = self.path_dec.project(embeds3, _reverse_relation(formula.rels[2]))
                 scores3 = self.cos(target_embeds, embeds2)
                 scores = scores1 * scores2 * scores3
@@ -174,14 +231,9 @@ class SoftAndEncoderDecoder(nn.Module):
     def margin_loss(self, formula, queries, hard_negatives=False, margin=1):
         if not "inter" in formula.query_type and hard_negatives:
             raise Exception("Hard negative examples can only be used with intersection queries")
-        elif hard_negatives:
-            neg_nodes = [random.choice(query.hard_neg_samples) for query in queries]
-        elif formula.query_type == "1-chain":
-            neg_nodes = [random.choice(self.graph.full_lists[formula.target_mode]) for _ in queries]
-        else:
-            neg_nodes = [random.choice(query.neg_samples) for query in queries]
+        neg_nodes = _sample_negatives(self.graph, formula, queries, hard_negatives)
 
-        affs = self.forward(formula, queries, [query.target_node for query in queries])
+        affs = self.forward(formula, queries, _target_nodes(queries))
         neg_affs = self.forward(formula, queries, neg_nodes)
         loss = margin - (affs - neg_affs)
         loss = torch.clamp(loss, min=0)
@@ -1,20 +1,35 @@
+import os
+import random
+import zlib
+import numpy as np
 import torch
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from multiprocessing import get_context
 import pickle as pickle
-from netquery.pref_graph import Query, Graph, SingleValPreference
+from netquery.pref_graph import Query, Graph, SingleValPreference, PrefFormula
+from netquery.csr_graph import CSRAdjLists
+from netquery.utils import make_features
+from netquery.data_utils import load_dense_graph_data, dense_id_maps
 
 
-def load_graph(data_dir, embed_dim):
-    rels, adj_lists, node_maps = pickle.load(open(data_dir+"/graph_data.pkl", "rb"))
-    node_maps = {m : {n : i for i, n in enumerate(id_list)} for m, id_list in node_maps.items()}
-    for m in node_maps:
-        node_maps[m][-1] = -1
+def load_graph(data_dir, embed_dim, csr=False, dense=False):
+    """
+    dense -- renumber the nodes of every mode 0..n-1 (see data_utils.load_dense_graph_data),
+             so that the features index the embeddings directly; node_maps then maps the
+             original node ids to the dense ones, to remap queries and preferences on load
+    """
+    if dense:
+        rels, adj_lists, node_maps = load_dense_graph_data(data_dir)
+    else:
+        rels, adj_lists, node_maps = pickle.load(open(data_dir+"/graph_data.pkl", "rb"))
+    node_maps = dense_id_maps(node_maps)
     feature_dims = {m : embed_dim for m in rels}
     feature_modules = {m : torch.nn.Embedding(len(node_maps[m])+1, embed_dim) for m in rels}
     for mode in rels:
         feature_modules[mode].weight.data.normal_(0, 1./embed_dim)
-    features = lambda nodes, mode : feature_modules[mode](
-            torch.autograd.Variable(torch.LongTensor([node_maps[mode][n] for n in nodes])+1))
+    features = make_features(feature_modules, None if dense else node_maps)
+    if csr:
+        adj_lists = CSRAdjLists.from_adj_lists(adj_lists)
     graph = Graph(features, feature_dims, rels, adj_lists)
     return graph, feature_modules, node_maps
 
@@ -23,17 +38,230 @@ def load_queries(data_file, keep_graph=False):
     return [Query.deserialize(info, keep_graph=keep_graph) for info in raw_info]
 
 
-def load_prefs_by_formula(data_file):
+def load_prefs_by_formula(data_file, id_maps=None):
+    """
+    id_maps -- map from mode -> node id -> dense id, to renumber the preferences for a
+               graph loaded with dense ids
+    """
     raw_info = pickle.load(open(data_file, "rb"))
     prefs = defaultdict(lambda : defaultdict(list))
     for raw_pref in raw_info:
         pref = SingleValPreference.deserialize(raw_pref, True)
+        if id_maps is not None:
+            pref.remap(id_maps)
         prefs[pref.formula.pref_type][pref.formula].append(pref)
     return prefs
 
-def sample_prefs(samples, data_dir):
-    train_graph, _, _ = load_graph(data_dir, 10)
-    test_graph, _, _ = load_graph(data_dir, 10)
+class ColumnarPrefs():
+    """
+    Read-only view of the preferences of one formula in a columnar preference
+    directory (see save_prefs_columnar). The columns are memory-mapped, and
+    indexing or slicing builds SingleValPreference objects on demand, so only
+    the preferences of the current batches are held as Python objects and
+    processes loading the same directory share its pages. The last cache_size
+    preferences built are kept, so indexing the rows of a batch again (e.g. once
+    per level in run_eval) returns the same objects instead of rebuilding them.
+    """
+
+    def __init__(self, formula, columns, start, end, id_maps=None, cache_size=4096):
+        self.formula = formula
+        self.columns = columns
+        self.start = start
+        self.end = end
+        self.id_maps = id_maps
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("preference index out of range")
+        return self._get(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def _get(self, i):
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+        pref = self._build(i)
+        if self.cache_size > 0:
+            self.cache[i] = pref
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return pref
+
+    def _build(self, i):
+        row = self.start + i
+        num_atts = len(self.formula.attributes)
+        levels = self.columns["level_offsets"][self.columns["level_ptr"][row]:self.columns["level_ptr"][row + 1] + 1]
+        entities = self.columns["entities"]
+        sampled_entities = [entities[levels[k]:levels[k + 1]].tolist() for k in range(len(levels) - 1)]
+        pref = SingleValPreference(self.formula.pref_type, list(self.formula.attributes),
+                                   self.columns["values"][row, :num_atts].tolist(),
+                                   sampled_entities=sampled_entities, formula=self.formula)
+        if self.id_maps is not None:
+            pref.remap(self.id_maps)
+        return pref
+
+
+def save_prefs_columnar(prefs, out_dir):
+    """
+    Writes preferences column-wise as .npy files in out_dir, grouped by formula:
+    values.npy        -- [num_prefs, 3] value ids, padded with -1
+    level_ptr.npy     -- [num_prefs+1] start of each preference's levels in level_offsets
+    level_offsets.npy -- [num_levels+1] start of each level's entities in entities
+    entities.npy      -- sampled entities of all levels, concatenated
+    formulas.pkl      -- list of (pref_type, attributes, start, end) row ranges
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    by_formula = OrderedDict()
+    for pref in prefs:
+        key = (pref.pref_type, tuple([tuple(att) for att in pref.attributes]))
+        by_formula.setdefault(key, []).append(pref)
+    prefs = [pref for formula_prefs in by_formula.values() for pref in formula_prefs]
+
+    values = np.full((len(prefs), 3), -1, dtype=np.int64)
+    level_counts = np.zeros(len(prefs), dtype=np.int64)
+    level_sizes = []
+    entities = []
+    for i, pref in enumerate(prefs):
+        values[i, :len(pref.values)] = pref.values
+        level_counts[i] = len(pref.sampled_entities)
+        for level in pref.sampled_entities:
+            level_sizes.append(len(level))
+            entities.extend(level)
+    level_ptr = np.concatenate([[0], np.cumsum(level_counts)]).astype(np.int64)
+    level_offsets = np.concatenate([[0], np.cumsum(level_sizes, dtype=np.int64)]).astype(np.int64)
+
+    formulas = []
+    start = 0
+    for (pref_type, attributes), formula_prefs in by_formula.items():
+        formulas.append((pref_type, attributes, start, start + len(formula_prefs)))
+        start += len(formula_prefs)
+    np.save(os.path.join(out_dir, "values.npy"), values)
+    np.save(os.path.join(out_dir, "level_ptr.npy"), level_ptr)
+    np.save(os.path.join(out_dir, "level_offsets.npy"), level_offsets)
+    np.save(os.path.join(out_dir, "entities.npy"), np.asarray(entities, dtype=np.int64))
+    pickle.dump(formulas, open(os.path.join(out_dir, "formulas.pkl"), "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_prefs_columnar(data_dir, mmap_mode="r", id_maps=None, cache_size=4096):
+    """
+    Loads a directory written by save_prefs_columnar with the same layout as
+    load_prefs_by_formula: pref_type -> formula -> sequence of preferences.
+    id_maps    -- as for load_prefs_by_formula, applied as the preferences are built
+    cache_size -- number of built preferences kept per formula (see ColumnarPrefs)
+    """
+    columns = {name: np.load(os.path.join(data_dir, name + ".npy"), mmap_mode=mmap_mode)
+               for name in ["values", "level_ptr", "level_offsets", "entities"]}
+    prefs = defaultdict(lambda : defaultdict(list))
+    for pref_type, attributes, start, end in pickle.load(open(os.path.join(data_dir, "formulas.pkl"), "rb")):
+        formula = PrefFormula.get(pref_type, attributes)
+        prefs[pref_type][formula] = ColumnarPrefs(formula, columns, start, end, id_maps, cache_size)
+    return prefs
+
+
+def convert_prefs_to_columnar(data_file, out_dir):
+    raw_info = pickle.load(open(data_file, "rb"))
+    save_prefs_columnar([SingleValPreference.deserialize(info) for info in raw_info], out_dir)
+
+
+PREF_TYPES = ["UIUP-1", "UIUP-2", "UIUP-3", "UIUP-1-reverse", "UIUP-2-reverse", "UIUP-3-reverse",
+              "UICP-2", "CIUP-3a", "CIUP-3b", "CICP-3"]
+
+# graphs shared with the sampling workers; set before the pool forks so that
+# the children read the parent's copy instead of unpickling their own
+_shared_graphs = {}
+
+
+def _pref_type_args(pref_type):
+    if "1" in pref_type:
+        return 1, ["sideeffects", "function", "disease", "protein", "drug"]
+    elif "2" in pref_type:
+        return 2, ["function", "disease", "protein", "drug"]
+    elif "3" in pref_type:
+        return 3, ["protein", "drug"]
+
+
+def _sample_prefs_shard(task):
+    graph_name, pref_type, num_samples, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+    num_pref_atts, entity_type = _pref_type_args(pref_type)
+    prefs = _shared_graphs[graph_name].sample_singlev_preferences(
+        entity_type=entity_type,
+        pref_type=pref_type,
+        num_samples=num_samples,
+        num_pref_atts=num_pref_atts,
+        question_sample_max=10,
+        verbose=False
+    )
+    return [pref.serialize() for pref in prefs]
+
+
+def _shard_seed(seed, graph_name, pref_index, shard):
+    """
+    Seed of one sampling shard, distinct for every (seed, graph_name, pref_type, shard) so
+    that e.g. the train and test graphs sampled with the same seed draw different streams.
+    """
+    entropy = [seed, zlib.crc32(graph_name.encode("utf-8")), pref_index, shard]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def parallel_sample_prefs(graph, samples, num_workers=1, seed=0, shard_size=10000, graph_name="train"):
+    """
+    Samples `samples` preferences of every type in PREF_TYPES.
+    The work is split into shards of at most shard_size preferences, each with its own seed
+    derived from (seed, graph_name, pref_type, shard) (see _shard_seed), so the result only
+    depends on seed and shard_size, not on the number of workers. The shards seed the global
+    random and np.random generators; run in this process (num_workers=1), their state is
+    restored afterwards, so the caller's random streams are left as they were.
+    Returns a map from pref_type -> list of SingleValPreference.
+    """
+    # build the CSR store once in the parent so the workers share it
+    graph._csr_adj_lists()
+    _shared_graphs[graph_name] = graph
+    tasks = []
+    for i, pref_type in enumerate(PREF_TYPES):
+        for shard, offset in enumerate(range(0, samples, shard_size)):
+            tasks.append((graph_name, pref_type, min(shard_size, samples - offset),
+                          _shard_seed(seed, graph_name, i, shard)))
+    if num_workers > 1:
+        with get_context("fork").Pool(num_workers) as pool:
+            results = pool.map(_sample_prefs_shard, tasks, chunksize=1)
+    else:
+        random_state, np_random_state = random.getstate(), np.random.get_state()
+        try:
+            results = [_sample_prefs_shard(task) for task in tasks]
+        finally:
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+    del _shared_graphs[graph_name]
+
+    prefs = defaultdict(list)
+    for task, serial_prefs in zip(tasks, results):
+        prefs[task[1]].extend([SingleValPreference.deserialize(info) for info in serial_prefs])
+    for pref_type in PREF_TYPES:
+        print("finish sampling pref:", pref_type, "(" + graph_name + ")")
+    return prefs
+
+
+def _pref_key(pref):
+    return (pref.pref_type, tuple(pref.attributes), tuple(pref.values))
+
+
+def sample_prefs(samples, data_dir, num_workers=1, seed=0, columnar=True, csr=False):
+    graph, _, _ = load_graph(data_dir, 10, csr=csr)
     # if test:
     print("Loading test/val data...")
     test_edges = load_queries(data_dir + "/test_edges.pkl")
@@ -41,7 +269,8 @@ def sample_prefs(samples, data_dir):
     # else:
     #     test_edges = []
     #     val_edges = []
-    train_graph.remove_edges([(q.target_node, q.formula.rels[0], q.anchor_nodes[0]) for q in test_edges+val_edges])
+    train_graph, test_graph = graph.split(
+        [[(q.target_node, q.formula.rels[0], q.anchor_nodes[0]) for q in test_edges+val_edges]])
     # if test:
     #     pref_graph = test_graph
     #     t_graph = train_graph
@@ -49,55 +278,14 @@ def sample_prefs(samples, data_dir):
     #     pref_graph = train_graph
     #     t_graph = None
 
-    train_data = defaultdict(list)
-    test_data = defaultdict(list)
-
     print("sampling train data...")
-    for pref_type in ["UIUP-1", "UIUP-2", "UIUP-3", "UIUP-1-reverse", "UIUP-2-reverse", "UIUP-3-reverse",
-                  "UICP-2", "CIUP-3a", "CIUP-3b", "CICP-3"]:
-        if "1" in pref_type:
-            num_pref_atts = 1
-            entity_type = ["sideeffects", "function", "disease", "protein", "drug"]
-        elif "2" in pref_type:
-            num_pref_atts = 2
-            entity_type = ["function", "disease", "protein", "drug"]
-        elif "3" in pref_type:
-            num_pref_atts = 3
-            entity_type = ["protein", "drug"]
-        current_data = train_graph.sample_singlev_preferences(
-            entity_type=entity_type,
-            pref_type=pref_type,
-            num_samples=samples,
-            num_pref_atts=num_pref_atts,
-            question_sample_max=10,
-            verbose=True
-        )
-        train_data[pref_type] = current_data
-        print("finish sampling pref:", pref_type, "(train)")
+    train_data = parallel_sample_prefs(train_graph, samples, num_workers, seed=seed, graph_name="train")
 
     print("sampling test data...")
-    for pref_type in ["UIUP-1", "UIUP-2", "UIUP-3", "UIUP-1-reverse", "UIUP-2-reverse", "UIUP-3-reverse",
-                      "UICP-2", "CIUP-3a", "CIUP-3b", "CICP-3"]:
-        if "1" in pref_type:
-            num_pref_atts = 1
-            entity_type = ["sideeffects", "function", "disease", "protein", "drug"]
-        elif "2" in pref_type:
-            num_pref_atts = 2
-            entity_type = ["function", "disease", "protein", "drug"]
-        elif "3" in pref_type:
-            num_pref_atts = 3
-            entity_type = ["protein", "drug"]
-        current_data = test_graph.sample_singlev_preferences(
-            entity_type=entity_type,
-            pref_type=pref_type,
-            num_samples=samples//10,
-            num_pref_atts=num_pref_atts,
-            question_sample_max=10,
-            verbose=True
-        )
-        current_data = list(set(current_data) - set(train_data[pref_type]))
-        test_data[pref_type] = current_data
-        print("finish sampling pref:", pref_type, "(test)")
+    test_data = parallel_sample_prefs(test_graph, samples//10, num_workers, seed=seed, graph_name="test")
+    for pref_type in PREF_TYPES:
+        train_keys = set([_pref_key(pref) for pref in train_data[pref_type]])
+        test_data[pref_type] = [pref for pref in test_data[pref_type] if not _pref_key(pref) in train_keys]
 
     train_pref_1 = []
     train_pref_2 = []
@@ -105,8 +293,7 @@ def sample_prefs(samples, data_dir):
     test_pref_1 = []
     test_pref_2 = []
     test_pref_3 = []
-    for pref_type in ["UIUP-1", "UIUP-2", "UIUP-3", "UIUP-1-reverse", "UIUP-2-reverse", "UIUP-3-reverse",
-                      "UICP-2", "CIUP-3a", "CIUP-3b", "CICP-3"]:
+    for pref_type in PREF_TYPES:
         if "1" in pref_type:
             train_pref_1 += train_data[pref_type]
             test_pref_1 += test_data[pref_type]
@@ -123,10 +310,14 @@ def sample_prefs(samples, data_dir):
     pickle.dump([pref.serialize() for pref in test_pref_1], open(data_dir + "/preference/test_pref_1.pkl", "wb"), protocol=pickle.HIGHEST_PROTOCOL)
     pickle.dump([pref.serialize() for pref in test_pref_2], open(data_dir + "/preference/test_pref_2.pkl", "wb"), protocol=pickle.HIGHEST_PROTOCOL)
     pickle.dump([pref.serialize() for pref in test_pref_3], open(data_dir + "/preference/test_pref_3.pkl", "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+    if columnar:
+        for name, prefs in [("train_pref_1", train_pref_1), ("train_pref_2", train_pref_2), ("train_pref_3", train_pref_3),
+                            ("test_pref_1", test_pref_1), ("test_pref_2", test_pref_2), ("test_pref_3", test_pref_3)]:
+            save_prefs_columnar(prefs, data_dir + "/preference/" + name)
 
     return
 
 
 if __name__ == '__main__':
     data_dir = "./bio/bio_data"
-    sample_prefs(samples=200000, data_dir=data_dir)
+    sample_prefs(samples=200000, data_dir=data_dir, num_workers=10)
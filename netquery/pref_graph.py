@@ -3,7 +3,10 @@ from collections import OrderedDict, defaultdict
 from tqdm import tqdm
 import random
 import sys
+import numpy as np
 import torch
+from netquery.graph_base import BaseGraph
+from netquery.csr_graph import _segment_indices
 
 def _reverse_relation(relation):
     return (relation[-1], relation[1], relation[0])
@@ -12,6 +15,26 @@ def _reverse_relation(relation):
 def _reverse_edge(edge):
     return (edge[-1], _reverse_relation(edge[1]), edge[0])
 
+# Order of the truth-table buckets (t: entity has the i-th attribute value, f: it does not)
+# in SingleValPreference.sampled_entities, from the least to the most preferred level.
+# Buckets joined by "+" are merged into one level.
+_PREF_BUCKETS = {
+    "UIUP-1": ["t", "f"],
+    "UIUP-1-reverse": ["f", "t"],
+    "UIUP-2": ["ff", "ft", "tf", "tt"],
+    "UIUP-2-reverse": ["tf", "tt", "ff", "ft"],
+    "UICP-2": ["ft", "ff", "tf", "tt"],
+    "UIUP-3": ["fff", "fft", "ftf", "ftt", "tff", "tft", "ttf", "ttt"],
+    "UIUP-3-reverse": ["tff", "tft", "ttf", "ttt", "fff", "fft", "ftf", "ftt"],
+    "CIUP-3a": ["fff+ftf", "ftt+fft", "tff+tft", "ttf+ttt"],
+    "CIUP-3b": ["fff", "ftf", "fft", "ftt", "tff", "tft", "ttf", "ttt"],
+    "CICP-3": ["ftt", "fft", "ftf", "fff", "tff", "tft", "ttf", "ttt"],
+}
+
+
+def _bucket_code(bucket):
+    return sum(1 << i for i, c in enumerate(bucket) if c == "t")
+
 class Preference():
 
     def __init__(self, pref_info, questions, hard_questions, question_max=100, keep_info=False):
@@ -552,12 +575,12 @@ class Preference():
 
 class SingleValPreference():
     def __init__(self, pref_type, attributes, values, sampled_entities=[], questions=None, hard_questions=None,
-                 keep_graph=False):
+                 keep_graph=False, formula=None):
         # questions, hard_questions, question_max=100
         self.pref_type = pref_type
         self.attributes = attributes
         self.values = values
-        self.formula = PrefFormula(pref_type=pref_type, attributes=attributes)
+        self.formula = formula if formula is not None else PrefFormula.get(pref_type, attributes)
         self.num_atts = len(self.attributes)
         self.sampled_entities = sampled_entities
         self.questions = questions if questions else []
@@ -752,6 +775,18 @@ class SingleValPreference():
                     else:
                         return -1, judge_basis
 
+    def remap(self, id_maps):
+        '''
+        Renumbers the values and sampled entities in place.
+        id_maps: map from mode -> old node id -> new node id
+        '''
+        self.values = [id_maps[self.attributes[i][-1]][v] for i, v in enumerate(self.values)]
+        entity_map = id_maps[self.attributes[0][0]]
+        self.sampled_entities = [[entity_map[e] for e in level] for level in self.sampled_entities]
+        if self.pref_graph is not None:
+            self.pref_graph = self.gen_pref_graph()
+        return self
+
     def serialize(self):
         return (self.pref_type, self.attributes, self.values, self.sampled_entities)
 
@@ -765,6 +800,22 @@ class PrefFormula():
     '''
     The formula of preferences, including the preference type and the considered attributes
     '''
+    # interned formulas, see PrefFormula.get
+    registry = {}
+
+    @staticmethod
+    def get(pref_type, attributes):
+        '''
+        Returns the shared formula for (pref_type, attributes), building it on first use.
+        Preferences of the same formula all point to this one object, so its tensors
+        (and their cudify'd copies) exist once; changes made to it are seen by all of them.
+        '''
+        num_atts = 1 if "1" in pref_type else 2 if "2" in pref_type else 3 if "3" in pref_type else len(attributes)
+        key = (pref_type, tuple([tuple(att) for att in attributes[:num_atts]]))
+        if not key in PrefFormula.registry:
+            PrefFormula.registry[key] = PrefFormula(pref_type, key[1])
+        return PrefFormula.registry[key]
+
     def __init__(self, pref_type, attributes):
         self.pref_type = pref_type
         if "1" in pref_type:
@@ -776,6 +827,8 @@ class PrefFormula():
         else:
             self.attributes = None
         self.entity_type = attributes[0][0]
+        self.device = None
+        self.batch_cache_size = 16
         self.edge_index = self.gen_edge_idx()
         self.reverse_edge_idx = self.gen_reverse_edge_idx()
         self.rel_pos, self.vec_e_pos, self.vec_p_pos, self.vec_n_pos = self.gen_formula_info()
@@ -785,6 +838,7 @@ class PrefFormula():
             self.p_pos += self.vec_p_pos[i]
             self.n_pos += self.vec_n_pos[i]
         self.node_num = len(self.rel_pos[0])
+        self._layouts = {}
 
     def gen_formula_info(self):
         if self.pref_type == "UIUP-1":
@@ -973,6 +1027,8 @@ class PrefFormula():
         return rel_pos, vec_e_pos, vec_p_pos, vec_n_pos
 
     def cudify(self):
+        if self.device is not None and self.device.type == "cuda":
+            return
         for i in range(len(self.rel_pos)):
             self.rel_pos[i] = self.rel_pos[i].cuda()
         for i in range(len(self.vec_p_pos)):
@@ -984,6 +1040,78 @@ class PrefFormula():
 
         self.p_pos = self.p_pos.cuda()
         self.n_pos = self.n_pos.cuda()
+        self.device = torch.device("cuda")
+
+    @property
+    def edge_index(self):
+        return self._edge_index
+
+    @edge_index.setter
+    def edge_index(self, edge_index):
+        # the batched graphs are built from edge_index, so they are stale once it changes
+        self._edge_index = edge_index
+        self._batch_cache = OrderedDict()
+        self._graph_templates = {}
+
+    def _graph_template(self, device):
+        if not device in self._graph_templates:
+            adj = torch.Tensor(self.edge_index)
+            nz = adj.nonzero().t()
+            self._graph_templates[device] = (nz.to(device), adj[nz[0], nz[1]].to(device))
+        return self._graph_templates[device]
+
+    def node_layout(self, device=None):
+        '''
+        Sparse form of the position masks, used to scatter the node embeddings of a
+        batch straight into their rows instead of multiplying dense one-hot masks:
+            rel_weight: [node_num, atts_num] float, the rel_pos masks side by side
+            vals: per attribute, (positions, weights) of the value nodes
+            p, n, e: (positions, weights) of the positive, negative and edge nodes
+        device: defaults to the formula's device (set by cudify).
+        '''
+        device = torch.device(device if device is not None else self.device or "cpu")
+        key = str(device)
+        if not key in self._layouts:
+            def sparse(weights):
+                pos = weights.nonzero().view(-1)
+                return pos.to(device), weights[pos].float().to(device)
+            rel_weight = torch.stack([rel.cpu() for rel in self.rel_pos], dim=1).float().to(device)
+            vals = [sparse((self.vec_p_pos[i] + self.vec_n_pos[i]).cpu()) for i in range(len(self.rel_pos))]
+            self._layouts[key] = {
+                "rel_weight": rel_weight,
+                "vals": vals,
+                "p": sparse(self.p_pos.cpu()),
+                "n": sparse(self.n_pos.cpu()),
+                "e": sparse(self.vec_e_pos.cpu()),
+            }
+        return self._layouts[key]
+
+    def batch_graph(self, batch_size, device=None):
+        '''
+        Block-diagonal graph of batch_size copies of the preference graph, as
+        (edge_index, edge_type, batch, mask), matching dense_to_sparse on the stacked
+        adjacency matrices. Built once per batch size by offsetting a single-graph
+        template and kept in an LRU cache of batch_cache_size entries.
+        device: defaults to the formula's device (set by cudify).
+        '''
+        device = torch.device(device if device is not None else self.device or "cpu")
+        key = (batch_size, str(device))
+        if key in self._batch_cache:
+            self._batch_cache.move_to_end(key)
+            return self._batch_cache[key]
+        nz, types = self._graph_template(device)
+        node_num = len(self.edge_index)
+        offsets = torch.arange(batch_size, device=device) * node_num
+        edge_index = (nz.unsqueeze(1) + offsets.view(1, -1, 1)).reshape(2, -1)
+        edge_type = types.repeat(batch_size)
+        batch = torch.arange(batch_size, device=device).repeat_interleave(node_num)
+        mask = torch.zeros(batch_size, node_num, dtype=torch.long, device=device)
+        mask[:, 0] = 1
+        graph = (edge_index, edge_type, batch, mask.view(-1))
+        self._batch_cache[key] = graph
+        if len(self._batch_cache) > self.batch_cache_size:
+            self._batch_cache.popitem(last=False)
+        return graph
 
 
     def gen_edge_idx(self):
@@ -1208,67 +1336,11 @@ class Query():
                      None if serial_info[1] is None else len(serial_info[1]), keep_graph=keep_graph)
 
 
-class Graph():
+class Graph(BaseGraph):
     """
     Simple container for heteregeneous graph data.
     """
 
-    def __init__(self, features, feature_dims, relations, adj_lists):
-        self.features = features
-        self.feature_dims = feature_dims
-        self.relations = relations
-        self.adj_lists = adj_lists
-        self.full_sets = defaultdict(set)
-        self.full_lists = {}
-        self.meta_neighs = defaultdict(dict)
-        for rel, adjs in self.adj_lists.items():
-            full_set = set(self.adj_lists[rel].keys())
-            self.full_sets[rel[0]] = self.full_sets[rel[0]].union(full_set)
-        for mode, full_set in self.full_sets.items():
-            self.full_lists[mode] = list(full_set)
-        self._cache_edge_counts()
-        self._make_flat_adj_lists()
-
-    def _make_flat_adj_lists(self):
-        self.flat_adj_lists = defaultdict(lambda: defaultdict(list))
-        for rel, adjs in self.adj_lists.items():
-            for node, neighs in adjs.items():
-                self.flat_adj_lists[rel[0]][node].extend([(rel, neigh) for neigh in neighs])
-
-    def _cache_edge_counts(self):
-        self.edges = 0.
-        self.rel_edges = {}
-        for r1 in self.relations:
-            for r2 in self.relations[r1]:
-                rel = (r1, r2[1], r2[0])
-                self.rel_edges[rel] = 0.
-                for adj_list in list(self.adj_lists[rel].values()):
-                    self.rel_edges[rel] += len(adj_list)
-                    self.edges += 1.
-        self.rel_weights = OrderedDict()
-        self.mode_edges = defaultdict(float)
-        self.mode_weights = OrderedDict()
-        for rel, edge_count in self.rel_edges.items():
-            self.rel_weights[rel] = edge_count / self.edges
-            self.mode_edges[rel[0]] += edge_count
-        for mode, edge_count in self.mode_edges.items():
-            self.mode_weights[mode] = edge_count / self.edges
-
-    def remove_edges(self, edge_list):
-        for edge in edge_list:
-            try:
-                self.adj_lists[edge[1]][edge[0]].remove(edge[-1])
-            except Exception:
-                continue
-
-            try:
-                self.adj_lists[_reverse_relation(edge[1])][edge[-1]].remove(edge[0])
-            except Exception:
-                continue
-        self.meta_neighs = defaultdict(dict)
-        self._cache_edge_counts()
-        self._make_flat_adj_lists()
-
     def get_all_edges(self, seed=0, exclude_rels=set([])):
         """
         Returns all edges in the form (node1, relation, node2)
@@ -1309,15 +1381,52 @@ class Graph():
         neg_nodes = list(neg_nodes) if len(neg_nodes) <= num else random.sample(list(neg_nodes), num)
         return neg_nodes
 
-    def sample_test_queries(self, train_graph, q_types, samples_per_type, neg_sample_max, verbose=True):
+    def sample_test_queries(self, train_graph, q_types, samples_per_type, neg_sample_max, verbose=True,
+            batch_size=1000):
+        """
+        Candidate query graphs are drawn batch_size at a time, and the metapaths their
+        checks against train_graph and their negatives need are expanded for the whole
+        batch at once (see prefetch_metapath_neighs).
+        """
         queries = []
         for q_type in q_types:
             sampled = 0
             while sampled < samples_per_type:
-                q = self.sample_query_subgraph_bytype(q_type)
-                if q is None or not train_graph._is_negative(q, q[1][0], False):
-                    continue
-                negs, hard_negs = self.get_negative_samples(q)
+                num_cands = min(batch_size, max(4 * (samples_per_type - sampled), 256))
+                batch = [self.sample_query_subgraph_bytype(q_type) for _ in range(num_cands)]
+                batch = [q for q in batch if not q is None]
+                train_graph.prefetch_metapath_neighs([path for q in batch for path in train_graph._negative_check_metapaths(q, q[1][0])])
+                batch = [q for q in batch if train_graph._is_negative(q, q[1][0], False)]
+                self.prefetch_metapath_neighs([path for q in batch for path in self._query_metapaths(q)])
+                for q in batch:
+                    if sampled == samples_per_type:
+                        break
+                    negs, hard_negs = self.get_negative_samples(q, neg_sample_max)
+                    if negs is None or ("inter" in q[0] and hard_negs is None):
+                        continue
+                    query = Query(q, negs, hard_negs, neg_sample_max=neg_sample_max, keep_graph=True)
+                    queries.append(query)
+                    sampled += 1
+                    if sampled % 1000 == 0 and verbose:
+                        print("Sampled", sampled)
+        return queries
+
+    def sample_queries(self, arity, num_samples, neg_sample_max, verbose=True, batch_size=1000):
+        """
+        Query graphs are drawn and their metapaths expanded batch_size at a time,
+        as in sample_test_queries.
+        """
+        sampled = 0
+        queries = []
+        while sampled < num_samples:
+            num_cands = min(batch_size, max(4 * (num_samples - sampled), 256))
+            batch = [self.sample_query_subgraph(arity) for _ in range(num_cands)]
+            batch = [q for q in batch if not q is None]
+            self.prefetch_metapath_neighs([path for q in batch for path in self._query_metapaths(q)])
+            for q in batch:
+                if sampled == num_samples:
+                    break
+                negs, hard_negs = self.get_negative_samples(q, neg_sample_max)
                 if negs is None or ("inter" in q[0] and hard_negs is None):
                     continue
                 query = Query(q, negs, hard_negs, neg_sample_max=neg_sample_max, keep_graph=True)
@@ -1327,76 +1436,6 @@ class Graph():
                     print("Sampled", sampled)
         return queries
 
-    def sample_queries(self, arity, num_samples, neg_sample_max, verbose=True):
-        sampled = 0
-        queries = []
-        while sampled < num_samples:
-            q = self.sample_query_subgraph(arity)
-            if q is None:
-                continue
-            negs, hard_negs = self.get_negative_samples(q)
-            if negs is None or ("inter" in q[0] and hard_negs is None):
-                continue
-            query = Query(q, negs, hard_negs, neg_sample_max=neg_sample_max, keep_graph=True)
-            queries.append(query)
-            sampled += 1
-            if sampled % 1000 == 0 and verbose:
-                print("Sampled", sampled)
-        return queries
-
-    def get_negative_samples(self, query):
-        if query[0] == "3-chain" or query[0] == "2-chain":
-            edges = query[1:]
-            rels = [_reverse_relation(edge[1]) for edge in edges[::-1]]
-            meta_neighs = self.get_metapath_neighs(query[-1][-1], tuple(rels))
-            negative_samples = self.full_sets[query[1][1][0]] - meta_neighs
-            if len(negative_samples) == 0:
-                return None, None
-            else:
-                return negative_samples, None
-        elif query[0] == "2-inter" or query[0] == "3-inter":
-            rel_1 = _reverse_relation(query[1][1])
-            union_neighs = self.adj_lists[rel_1][query[1][-1]]
-            inter_neighs = self.adj_lists[rel_1][query[1][-1]]
-            for i in range(2, len(query)):
-                rel = _reverse_relation(query[i][1])
-                union_neighs = union_neighs.union(self.adj_lists[rel][query[i][-1]])
-                inter_neighs = inter_neighs.intersection(self.adj_lists[rel][query[i][-1]])
-            neg_samples = self.full_sets[query[1][1][0]] - inter_neighs
-            hard_neg_samples = union_neighs - inter_neighs
-            if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
-                return None, None
-            return neg_samples, hard_neg_samples
-        elif query[0] == "3-inter_chain":
-            rel_1 = _reverse_relation(query[1][1])
-            union_neighs = self.adj_lists[rel_1][query[1][-1]]
-            inter_neighs = self.adj_lists[rel_1][query[1][-1]]
-            chain_rels = [_reverse_relation(edge[1]) for edge in query[2][::-1]]
-            chain_neighs = self.get_metapath_neighs(query[2][-1][-1], tuple(chain_rels))
-            union_neighs = union_neighs.union(chain_neighs)
-            inter_neighs = inter_neighs.intersection(chain_neighs)
-            neg_samples = self.full_sets[query[1][1][0]] - inter_neighs
-            hard_neg_samples = union_neighs - inter_neighs
-            if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
-                return None, None
-            return neg_samples, hard_neg_samples
-        elif query[0] == "3-chain_inter":
-            inter_rel_1 = _reverse_relation(query[-1][0][1])
-            inter_neighs_1 = self.adj_lists[inter_rel_1][query[-1][0][-1]]
-            inter_rel_2 = _reverse_relation(query[-1][1][1])
-            inter_neighs_2 = self.adj_lists[inter_rel_2][query[-1][1][-1]]
-
-            inter_neighs = inter_neighs_1.intersection(inter_neighs_2)
-            union_neighs = inter_neighs_1.union(inter_neighs_2)
-            rel = _reverse_relation(query[1][1])
-            pos_nodes = set([n for neigh in inter_neighs for n in self.adj_lists[rel][neigh]])
-            union_pos_nodes = set([n for neigh in union_neighs for n in self.adj_lists[rel][neigh]])
-            neg_samples = self.full_sets[query[1][1][0]] - pos_nodes
-            hard_neg_samples = union_pos_nodes - pos_nodes
-            if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
-                return None, None
-            return neg_samples, hard_neg_samples
-
     def sample_edge(self, node, mode):
         rel, neigh = random.choice(self.flat_adj_lists[mode][node])
         edge = (node, rel, neigh)
@@ -1539,15 +1578,6 @@ class Graph():
                 edge_2 = (node, rel_2, neigh_2)
                 return ("2-inter", edge_1, edge_2)
 
-    def get_metapath_neighs(self, node, rels):
-        if node in self.meta_neighs[rels]:
-            return self.meta_neighs[rels][node]
-        current_set = [node]
-        for rel in rels:
-            current_set = set([neigh for n in current_set for neigh in self.adj_lists[rel][n]])
-        self.meta_neighs[rels][node] = current_set
-        return current_set
-
     def sample_preferences(self, entity_type, pref_type, num_pref_atts, num_samples, question_sample_max, verbose=True):
         '''
         todo: how to represent graph with multi-instances of one entity?
@@ -1569,7 +1599,14 @@ class Graph():
         return
 
     def sample_singlev_preferences(self, entity_type, pref_type, num_pref_atts, num_samples, question_sample_max,
-                                   test_flag=False, train_graph=None, verbose=True):
+                                   test_flag=False, train_graph=None, verbose=True, batch_size=4096):
+        '''
+        batch_size: number of candidates drawn at once by the vectorized sampler,
+                    None falls back to sampling one preference at a time.
+        '''
+        if batch_size:
+            return self.sample_singlev_preferences_batched(entity_type, pref_type, num_pref_atts, num_samples,
+                                                           batch_size=batch_size, verbose=verbose)
         print("Sampling", pref_type)
         sampled = 0
         sampled_preferences = []
@@ -1742,6 +1779,117 @@ class Graph():
         print("in pref_graph sampled preferences:", len(sampled_preferences))
         return sampled_preferences
 
+    def sample_singlev_preferences_batched(self, entity_type, pref_type, num_pref_atts, num_samples,
+                                           batch_size=4096, bucket_max=10, verbose=True):
+        '''
+        Vectorized version of sample_singlev_preferences.
+        Draws batch_size (entity, attributes, values) candidates at once and computes
+        the truth-table buckets of all candidates with array operations over the CSR store.
+        '''
+        print("Sampling", pref_type)
+        csr = self._csr_adj_lists()
+        rng = np.random.RandomState(random.getrandbits(32))
+        sampled_preferences = []
+        while len(sampled_preferences) < num_samples:
+            num_cands = min(batch_size, max(4 * (num_samples - len(sampled_preferences)), 256))
+            type_counts = rng.multinomial(num_cands, [1. / len(entity_type)] * len(entity_type))
+            batch_preferences = []
+            for starting_type, count in zip(entity_type, type_counts):
+                if count > 0:
+                    batch_preferences.extend(self._sample_singlev_batch(
+                        csr, starting_type, count, pref_type, num_pref_atts, bucket_max, rng))
+            rng.shuffle(batch_preferences)
+            for sampled_atts, sampled_vals, sampled_entities in \
+                    batch_preferences[:num_samples - len(sampled_preferences)]:
+                sampled_preferences.append(SingleValPreference(pref_type, sampled_atts, sampled_vals,
+                                                               sampled_entities=sampled_entities))
+            if verbose:
+                print("Sampled:", len(sampled_preferences))
+        print("in pref_graph sampled preferences:", len(sampled_preferences))
+        return sampled_preferences
+
+    def _sample_singlev_batch(self, csr, mode, num_cands, pref_type, num_pref_atts, bucket_max, rng):
+        node_index = csr.node_index[mode]
+        n_mode = len(node_index)
+        full_pos = node_index.lookup_many(self.full_lists[mode])
+        rels = [rel for rel in csr.keys() if rel[0] == mode]
+        if len(rels) < num_pref_atts:
+            return []
+
+        # starting entities and their candidate attributes
+        nodes = full_pos[rng.randint(len(full_pos), size=num_cands)]
+        degs = np.stack([csr[rel].ends[nodes] - csr[rel].indptr[nodes] for rel in rels], axis=1)
+        keep = (degs > 0).sum(axis=1) >= num_pref_atts
+        nodes, degs = nodes[keep], degs[keep]
+        num_cands = len(nodes)
+        if num_cands == 0:
+            return []
+        keys = rng.rand(*degs.shape)
+        keys[degs == 0] = -1
+        att_idx = np.argsort(-keys, axis=1)[:, :num_pref_atts]
+
+        # one value per sampled attribute, and the entities having that value
+        vals = np.zeros((num_cands, num_pref_atts), dtype=np.int64)
+        cands, ents, bits = [], [], []
+        for j in range(num_pref_atts):
+            for r in np.unique(att_idx[:, j]):
+                sel = np.nonzero(att_idx[:, j] == r)[0]
+                adj = csr[rels[r]]
+                offsets = (rng.rand(len(sel)) * degs[sel, r]).astype(np.int64)
+                vals[sel, j] = adj.indices[adj.indptr[nodes[sel]] + offsets]
+                rev = csr.reverse(rels[r])
+                starts = rev.indptr[vals[sel, j]]
+                lengths = rev.ends[vals[sel, j]] - starts
+                ents.append(rev.indices[_segment_indices(starts, lengths)].astype(np.int64))
+                cands.append(np.repeat(sel, lengths))
+                bits.append(np.full(int(lengths.sum()), 1 << j, dtype=np.int64))
+        pairs = np.concatenate(cands) * n_mode + np.concatenate(ents)
+        bits = np.concatenate(bits)
+        order = np.argsort(pairs, kind="stable")
+        pairs, bits = pairs[order], bits[order]
+        pairs, first = np.unique(pairs, return_index=True)
+        codes = np.bitwise_or.reduceat(bits, first) if len(first) > 0 else bits
+        pair_cands = pairs // n_mode
+        pair_ents = pairs % n_mode
+
+        # bucket sizes, where bucket 0 (all false) is the complement of the positive entities
+        num_codes = 1 << num_pref_atts
+        counts = np.bincount(pair_cands * num_codes + codes, minlength=num_cands * num_codes)
+        counts = counts.reshape(num_cands, num_codes)
+        counts[:, 0] = len(full_pos) - np.bincount(pair_cands, minlength=num_cands)
+        accepted = (counts > 0).all(axis=1) if num_pref_atts > 1 else np.ones(num_cands, dtype=bool)
+
+        # keep at most bucket_max random entities per positive bucket
+        order = np.lexsort((rng.rand(len(pairs)), codes, pair_cands))
+        groups = (pair_cands * num_codes + codes)[order]
+        group_start = np.searchsorted(groups, groups)
+        kept = order[(np.arange(len(order)) - group_start) < bucket_max]
+        kept = kept[accepted[pair_cands[kept]]]
+
+        buckets = [defaultdict(list) for _ in range(num_cands)]
+        for c, code, e in zip(pair_cands[kept].tolist(), codes[kept].tolist(),
+                              node_index.to_ids(pair_ents[kept]).tolist()):
+            buckets[c][code].append(e)
+
+        # negatives are drawn from the full entity list, rejecting the positives
+        draws = full_pos[rng.randint(len(full_pos), size=(num_cands, 4 * bucket_max))]
+        is_pos = np.isin(np.arange(num_cands)[:, None] * n_mode + draws, pairs)
+        sampled = []
+        for c in np.nonzero(accepted)[0].tolist():
+            num_neg = min(int(counts[c, 0]), bucket_max)
+            negs = list(OrderedDict.fromkeys(draws[c][~is_pos[c]].tolist()))[:num_neg]
+            if len(negs) < num_neg:
+                negs = np.setdiff1d(full_pos, pair_ents[pair_cands == c])
+                negs = rng.choice(negs, num_neg, replace=False).tolist()
+            buckets[c][0] = node_index.to_ids(np.asarray(negs, dtype=np.int64)).tolist()
+
+            sampled_atts = [rels[r] for r in att_idx[c].tolist()]
+            sampled_vals = [csr.node_index[att[-1]].to_ids(vals[c, j]).item() for j, att in enumerate(sampled_atts)]
+            sampled_entities = [[e for bucket in level.split("+") for e in buckets[c][_bucket_code(bucket)]]
+                                for level in _PREF_BUCKETS[pref_type]]
+            sampled.append((sampled_atts, sampled_vals, sampled_entities))
+        return sampled
+
 
     ## TESTING CODE
 
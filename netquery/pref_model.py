@@ -9,6 +9,20 @@ from torch_geometric.nn import global_add_pool, global_mean_pool
 
 import time
 
+def _stack_views(edge_index, edge_type, batch, mask, num_nodes, num_graphs):
+    '''
+    Duplicates a batched graph so that a second view of the node features
+    can be appended after the first one.
+
+    num_nodes -- number of nodes in the batched graph
+    num_graphs -- number of graphs in the batched graph
+    '''
+    edge_index = torch.cat([edge_index, edge_index + num_nodes], dim=1)
+    edge_type = torch.cat([edge_type, edge_type])
+    batch = torch.cat([batch, batch + num_graphs])
+    mask = torch.cat([mask, mask])
+    return edge_index, edge_type, batch, mask
+
 class PrefRGCN(nn.Module):
     '''
 
@@ -55,53 +69,91 @@ class PrefRGCN(nn.Module):
 
         self.cos = nn.CosineSimilarity(dim=-1)
 
+    def use_snapshot(self, snapshot):
+        '''
+        Reads the entity embeddings (preference values and targets) from a
+        snapshot.EmbeddingSnapshot instead of running the graph query encoder.
+        '''
+        self.gq_model.use_snapshot(snapshot)
+
     def forward(self, formula, prefs, edge_index, edge_type, batch, mask, targets):
         '''
 
         targets: [bs]
         '''
+        pref_vecs = self.encode_preferences(formula, prefs, edge_index, edge_type, batch)
+        return self.score(pref_vecs, targets, formula.attributes[0][0])
 
-        atts = formula.attributes
-        vals = [] # [vals_num, bs]
-        node_embeds = [] # [vals_num, bs, dim]
-        rel_embeds = [] # [rels_num, dim]
-
-        targets_embeds = self.gq_model.enc.forward(targets, atts[0][0]).t() # [bs, dim]
-
-        for i in range(len(atts)):
-            vals.append([pref.values[i] for pref in prefs])
-
+    def encode_preferences(self, formula, prefs, edge_index=None, edge_type=None, batch=None):
+        '''
+        Pooled preference vectors [bs, emb_dim], in the entity embedding space.
+        They do not depend on the target, so they can be scored against any
+        number of candidates with score().
+        edge_index, edge_type, batch -- the batched graph, formula.batch_graph(len(prefs))
+            when not given
+        '''
         node_num = formula.node_num
-        bs = len(vals[0])
-        # print("node num:", node_num, "bs:", bs)
-
-        for i in range(len(atts)):
-            node_embeds.append(self.gq_model.enc.forward(vals[i], atts[i][-1]).t().unsqueeze(0).repeat(node_num, 1, 1))
-            rel_embeds.append(self.rel_proj(self.gq_model.path_dec.mats[atts[i]]).t().unsqueeze(0).repeat(formula.node_num, len(prefs), 1))
-
-        emb = rel_embeds[0] * formula.rel_pos[0].unsqueeze(-1).unsqueeze(-1) + \
-            node_embeds[0] * (formula.vec_p_pos[0] + formula.vec_n_pos[0]).unsqueeze(-1).unsqueeze(-1)
-        # [node_num, bs, emb_dim]
-        for i in range(1, len(atts)):
-            emb += rel_embeds[i] * formula.rel_pos[i].unsqueeze(-1).unsqueeze(-1) + \
-            node_embeds[i] * (formula.vec_p_pos[i] + formula.vec_n_pos[i]).unsqueeze(-1).unsqueeze(-1)
+        bs = len(prefs)
+        device = self.reproj.weight.device
+        if edge_index is None:
+            edge_index, edge_type, batch, _ = formula.batch_graph(bs, device)
+        layout = formula.node_layout(device)
 
+        emb = self._embed_nodes(formula, prefs, layout) # [bs * node_num, emb_dim]
         # 肯定点+否定点+边
-        x = self.positive_proj(emb) * formula.p_pos.unsqueeze(-1).unsqueeze(-1) + \
-            self.negative_proj(emb) * formula.n_pos.unsqueeze(-1).unsqueeze(-1) + \
-            self.other_proj(emb) * formula.vec_e_pos.unsqueeze(-1).unsqueeze(-1)
-        # [node_num, bs, hidden]
-        x = x.transpose(1, 0).reshape(node_num * bs, -1)
+        x = self._project_nodes(emb, layout, bs, node_num, layout["p"], layout["n"])
+        # [bs * node_num, hidden]
         x = F.relu(self.conv1(x, edge_index, edge_type))
         x = F.relu(self.conv2(x, edge_index, edge_type))
         x = self.conv3(x, edge_index, edge_type)
         # x = global_add_pool(x * mask.unsqueeze(-1), batch)
         x = global_add_pool(x, batch)
 
-        x = self.reproj(x)
+        return self.reproj(x)
+
+    def score(self, pref_vecs, targets, mode, index=None):
+        '''
+        Scores of target entities against preference vectors from encode_preferences.
+        targets -- list of entity ids of type mode
+        index -- for each target, the row of pref_vecs it is scored against;
+            defaults to one target per preference
+        '''
+        targets_embeds = self.gq_model.embed(targets, mode).t() # [targets_num, dim]
+        if index is not None:
+            pref_vecs = pref_vecs[torch.as_tensor(index, dtype=torch.long, device=pref_vecs.device)]
+        return (pref_vecs * targets_embeds).sum(-1)
+
+    def _embed_nodes(self, formula, prefs, layout):
+        '''
+        Input embeddings of the batched preference graphs, [bs * node_num, emb_dim] with
+        the nodes of each graph contiguous. The relation embeddings are shared by every
+        graph, the value embeddings are scattered into the rows given by the layout.
+        '''
+        atts = formula.attributes
+        node_num = formula.node_num
+        bs = len(prefs)
+
+        rel_embeds = torch.cat([self.rel_proj(self.gq_model.path_dec.mats[att]).t() for att in atts], dim=0)
+        emb = torch.mm(layout["rel_weight"], rel_embeds).repeat(bs, 1)
+        offsets = torch.arange(bs, device=emb.device).unsqueeze(1) * node_num
+        for i in range(len(atts)):
+            pos, weights = layout["vals"][i]
+            node_embeds = self.gq_model.embed([pref.values[i] for pref in prefs], atts[i][-1]).t() # [bs, dim]
+            emb.index_add_(0, (offsets + pos).view(-1),
+                           (node_embeds.unsqueeze(1) * weights.view(1, -1, 1)).view(-1, emb.size(1)))
+        return emb
 
-        score = (x * targets_embeds).sum(-1)
-        return score
+    def _project_nodes(self, emb, layout, bs, node_num, p, n):
+        '''
+        Applies positive_proj, negative_proj and other_proj to the rows of the
+        positive (p), negative (n) and edge nodes only.
+        '''
+        x = emb.new_zeros(emb.size(0), self.reproj.in_features)
+        offsets = torch.arange(bs, device=emb.device).unsqueeze(1) * node_num
+        for proj, (pos, weights) in ((self.positive_proj, p), (self.negative_proj, n), (self.other_proj, layout["e"])):
+            rows = (offsets + pos).view(-1)
+            x.index_add_(0, rows, proj(emb[rows]) * weights.repeat(bs).unsqueeze(-1))
+        return x
 
     def margin_loss(self, formula, prefs, edge_index, edge_type, batch, mask, margin=1):
         t = random.randint(0, len(prefs[0].sampled_entities)-2)
@@ -114,65 +166,35 @@ class PrefRGCN(nn.Module):
         loss = loss.mean()
         return loss
 
-    def contrast_loss(self, formula, prefs, edge_index, edge_type, batch, mask):
-        atts = formula.attributes
-        vals = []  # [vals_num, bs]
-        node_embeds = []  # [vals_num, bs, dim]
-        rel_embeds = []  # [rels_num, dim]
-
-        for i in range(len(atts)):
-            vals.append([pref.values[i] for pref in prefs])
-
-        node_num = formula.node_num
-        bs = len(vals[0])
-
-        for i in range(len(atts)):
-            node_embeds.append(self.gq_model.enc.forward(vals[i], atts[i][-1]).t().unsqueeze(0).repeat(node_num, 1, 1))
-            rel_embeds.append(
-                self.rel_proj(self.gq_model.path_dec.mats[atts[i]]).t().unsqueeze(0).repeat(formula.node_num,
-                                                                                            len(prefs), 1))
-
-        emb = rel_embeds[0] * formula.rel_pos[0].unsqueeze(-1).unsqueeze(-1) + \
-              node_embeds[0] * (formula.vec_p_pos[0] + formula.vec_n_pos[0]).unsqueeze(-1).unsqueeze(-1)
-
-        # [node_num, bs, emb_dim]
-        for i in range(1, len(atts)):
-            emb += rel_embeds[i] * formula.rel_pos[i].unsqueeze(-1).unsqueeze(-1) + \
-                   node_embeds[i] * (formula.vec_p_pos[i] + formula.vec_n_pos[i]).unsqueeze(-1).unsqueeze(-1)
-
-        # print("edge_index:", edge_index)
-        # print("edge_type:", edge_type)
-        # print("emb:", emb)
-
-        # 肯定点+否定点+边
-        x = self.positive_proj(emb) * formula.p_pos.unsqueeze(-1).unsqueeze(-1) + \
-            self.negative_proj(emb) * formula.n_pos.unsqueeze(-1).unsqueeze(-1) + \
-            self.other_proj(emb) * formula.vec_e_pos.unsqueeze(-1).unsqueeze(-1)
-
-        x1 = self.positive_proj(emb) * formula.n_pos.unsqueeze(-1).unsqueeze(-1) + \
-            self.negative_proj(emb) * formula.p_pos.unsqueeze(-1).unsqueeze(-1) + \
-            self.other_proj(emb) * formula.vec_e_pos.unsqueeze(-1).unsqueeze(-1)
-
-        # [node_num, bs, hidden]
-        x = x.transpose(1, 0).reshape(node_num * bs, -1)
-        # print("x:", x)
+    def _encode_graph(self, x, edge_index, edge_type, batch, mask):
         x = F.relu(self.conv1(x, edge_index, edge_type))
-        # print("x':", x)
         x = F.relu(self.conv2(x, edge_index, edge_type))
         x = self.conv3(x, edge_index, edge_type)
-        # print("x'':", x)
-        x = global_add_pool(x * mask.unsqueeze(-1), batch)
-        # x = global_add_pool(x, batch)
-
-        x1 = x1.transpose(1, 0).reshape(node_num * bs, -1)
-        # print("x1:", x1)
-        x1 = F.relu(self.conv1(x1, edge_index, edge_type))
-        # print("x1':", x1)
-        x1 = F.relu(self.conv2(x1, edge_index, edge_type))
-        x1 = self.conv3(x1, edge_index, edge_type)
-        # print("x1'':", x1)
-        x1 = global_add_pool(x1 * mask.unsqueeze(-1), batch)
-        # x1 = global_add_pool(x1, batch)
+        return global_add_pool(x * mask.unsqueeze(-1), batch)
+
+    def contrast_loss(self, formula, prefs, edge_index, edge_type, batch, mask, fused=True):
+        '''
+        fused -- stack the two views into one batched graph so that the
+            convolutions and pooling run once per step
+        '''
+        node_num = formula.node_num
+        bs = len(prefs)
+        layout = formula.node_layout(self.reproj.weight.device)
+
+        emb = self._embed_nodes(formula, prefs, layout) # [bs * node_num, emb_dim]
+
+        # 肯定点+否定点+边, and the view with positive and negative nodes swapped
+        x = self._project_nodes(emb, layout, bs, node_num, layout["p"], layout["n"])
+        x1 = self._project_nodes(emb, layout, bs, node_num, layout["n"], layout["p"])
+        # [bs * node_num, hidden]
+        if fused:
+            # both views as one batch of 2*bs disjoint graphs
+            x = self._encode_graph(torch.cat([x, x1], dim=0),
+                                   *_stack_views(edge_index, edge_type, batch, mask, node_num * bs, bs))
+            x, x1 = x[:bs], x[bs:]
+        else:
+            x = self._encode_graph(x, edge_index, edge_type, batch, mask)
+            x1 = self._encode_graph(x1, edge_index, edge_type, batch, mask)
 
         loss = 1 + self.cos(x, x1)
         loss = loss.mean()
@@ -0,0 +1,255 @@
+"""
+Top-k entity retrieval for preference queries.
+
+The preference vectors of PrefRGCN.encode_preferences are scored against the
+L2-normalized entity embeddings (as DirectEncoder does), so the best entities
+for a preference are a maximum inner product search over feature_modules[mode].
+ExactIndex does this with blocked matrix products, IVFPQIndex is an approximate
+inverted-file / product-quantized index for large entity sets.
+"""
+import numpy as np
+import torch
+
+
+def _as_array(queries):
+    if isinstance(queries, torch.Tensor):
+        queries = queries.data.cpu().numpy()
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def _topk(scores, k):
+    """
+    Column positions and values of the k largest scores of every row, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        pos = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        pos = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    vals = np.take_along_axis(scores, pos, axis=1)
+    order = np.argsort(-vals, axis=1, kind="stable")
+    return np.take_along_axis(pos, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+def _assign(data, centroids, block_size=65536):
+    c_norms = (centroids ** 2).sum(1)
+    assign = np.zeros(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        assign[start:start + block_size] = np.argmin(c_norms - 2 * block.dot(centroids.T), axis=1)
+    return assign
+
+
+def _kmeans(data, num_clusters, num_iters, rng, points_per_cluster=64):
+    """
+    Lloyd's k-means with random initialization, returns (centroids, assignments).
+    The centroids are trained on a sample of at most points_per_cluster points per
+    cluster, then every point is assigned.
+    """
+    num_clusters = min(num_clusters, len(data))
+    train = data
+    if len(data) > num_clusters * points_per_cluster:
+        train = data[rng.choice(len(data), num_clusters * points_per_cluster, replace=False)]
+    centroids = train[rng.choice(len(train), num_clusters, replace=False)].copy()
+    for it in range(num_iters):
+        assign = _assign(train, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=num_clusters)
+        nonempty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        centroids[nonempty] = np.add.reduceat(train[order], starts, axis=0) / counts[nonempty, None]
+    return centroids, _assign(data, centroids)
+
+
+def entity_embeddings(feature_modules, node_maps, mode, dense=False):
+    """
+    Normalized embeddings of the entities of a mode, as (ids, embeds), the ids being
+    in the id space of the graph the model was trained on.
+
+    node_maps -- map from mode -> original entity id -> position, as returned by load_graph;
+                 row position+1 of feature_modules[mode] embeds the entity
+    dense     -- the graph was loaded with dense=True, so its node ids are the positions
+                 themselves and those are returned instead of the original ids
+    """
+    weight = feature_modules[mode].weight.data.cpu().numpy().astype(np.float32)
+    if dense:
+        ids = np.array(sorted([pos for n, pos in node_maps[mode].items() if n != -1]), dtype=np.int64)
+        rows = ids + 1
+    else:
+        ids = np.array([n for n in node_maps[mode] if n != -1])
+        rows = np.array([node_maps[mode][n] + 1 for n in ids], dtype=np.int64)
+    embeds = weight[rows]
+    embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+    return ids, embeds
+
+
+class ExactIndex():
+    """
+    Exact maximum inner product search by blocked matrix products.
+    """
+    def __init__(self, ids, embeds, block_size=65536):
+        """
+        ids         -- entity ids, one per row of embeds
+        embeds      -- [num_entities, dim] float array
+        block_size  -- number of entities scored at once, bounds the memory of a search
+        """
+        self.ids = np.asarray(ids)
+        self.embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=10):
+        """
+        Returns (ids, scores), both [num_queries, k], best first.
+
+        queries -- [num_queries, dim] array or tensor of preference vectors
+        """
+        queries = _as_array(queries)
+        best_pos = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.ids), self.block_size):
+            pos, scores = _topk(queries.dot(self.embeds[start:start + self.block_size].T), k)
+            cand_pos = np.hstack([best_pos, pos + start])
+            keep, best_scores = _topk(np.hstack([best_scores, scores]), k)
+            best_pos = np.take_along_axis(cand_pos, keep, axis=1)
+        return self.ids[best_pos], best_scores
+
+
+class IVFPQIndex():
+    """
+    Approximate maximum inner product search.
+    Entities are split into num_lists k-means clusters (the inverted file); the
+    residual of every entity to its centroid is product-quantized into num_subspaces
+    one-byte codes. A search only scores the entities of the n_probe clusters whose
+    centroids best match the query, with table lookups instead of dot products.
+    """
+    def __init__(self, ids, embeds, num_lists=256, num_subspaces=8, num_codes=256,
+            num_iters=10, seed=0, keep_embeds=True):
+        """
+        ids             -- entity ids, one per row of embeds
+        embeds          -- [num_entities, dim] float array, dim divisible by num_subspaces
+        num_lists       -- number of clusters of the inverted file
+        num_subspaces   -- number of product quantization codes per entity
+        num_codes       -- codebook size of every subspace (at most 256)
+        keep_embeds     -- keep the exact embeddings to rerank the candidates
+        """
+        embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+        dim = embeds.shape[1]
+        if dim % num_subspaces != 0:
+            raise Exception("Embedding dimension {:d} is not divisible by {:d} subspaces".format(dim, num_subspaces))
+        if num_codes > 256:
+            raise Exception("At most 256 codes per subspace are supported")
+        rng = np.random.RandomState(seed)
+        self.num_subspaces = num_subspaces
+        self.sub_dim = dim // num_subspaces
+
+        self.centroids, assign = _kmeans(embeds, num_lists, num_iters, rng)
+        order = np.argsort(assign, kind="stable")
+        self.list_ptr = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))])
+        self.ids = np.asarray(ids)[order]
+        residuals = (embeds - self.centroids[assign])[order]
+
+        self.codebooks = []
+        self.codes = np.zeros((len(embeds), num_subspaces), dtype=np.uint8)
+        for m in range(num_subspaces):
+            sub = np.ascontiguousarray(residuals[:, m * self.sub_dim:(m + 1) * self.sub_dim])
+            codebook, self.codes[:, m] = _kmeans(sub, num_codes, num_iters, rng)
+            self.codebooks.append(codebook)
+        self.codebooks = np.stack(self.codebooks) # [num_subspaces, num_codes, sub_dim]
+        self.embeds = embeds[order] if keep_embeds else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=10, n_probe=8, rerank=True):
+        """
+        Returns (ids, scores), both [num_queries, k], best first. Rows with fewer than k
+        candidates in the probed clusters are padded with id -1 and score -inf.
+
+        queries -- [num_queries, dim] array or tensor of preference vectors
+        n_probe -- number of clusters scored per query
+        rerank  -- score the candidates exactly when the embeddings are kept
+        """
+        queries = _as_array(queries)
+        num_queries = len(queries)
+        n_probe = min(n_probe, len(self.centroids))
+        lists, list_scores = _topk(queries.dot(self.centroids.T), n_probe)
+        exact = rerank and self.embeds is not None
+        if not exact:
+            # lookup tables: [num_queries, num_subspaces, num_codes]
+            tables = np.einsum("qms,mcs->qmc",
+                               queries.reshape(num_queries, self.num_subspaces, self.sub_dim), self.codebooks)
+
+        # score cluster by cluster, each against all the queries probing it
+        probe_queries = np.repeat(np.arange(num_queries), n_probe)
+        probe_lists = lists.reshape(-1)
+        probe_scores = list_scores.reshape(-1)
+        order = np.argsort(probe_lists, kind="stable")
+        bounds = np.flatnonzero(np.diff(probe_lists[order])) + 1
+        cand_queries, cand_rows, cand_scores = [], [], []
+        for group in np.split(order, bounds):
+            l = probe_lists[group[0]]
+            start, end = self.list_ptr[l], self.list_ptr[l + 1]
+            if start == end:
+                continue
+            qs = probe_queries[group]
+            if exact:
+                scores = queries[qs].dot(self.embeds[start:end].T)
+            else:
+                codes = self.codes[start:end]
+                scores = np.repeat(probe_scores[group][:, None], end - start, axis=1)
+                for m in range(self.num_subspaces):
+                    scores += tables[qs, m][:, codes[:, m]]
+            pos, scores = _topk(scores, k)
+            cand_queries.append(np.repeat(qs, pos.shape[1]))
+            cand_rows.append((pos + start).reshape(-1))
+            cand_scores.append(scores.reshape(-1))
+
+        out_ids = np.full((num_queries, k), -1, dtype=self.ids.dtype)
+        out_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        if not cand_queries:
+            return out_ids, out_scores
+        cand_queries = np.concatenate(cand_queries)
+        cand_rows = np.concatenate(cand_rows)
+        cand_scores = np.concatenate(cand_scores)
+        # top k of every query's candidates: sort by (query, -score) and keep the first k
+        order = np.lexsort((-cand_scores, cand_queries))
+        counts = np.bincount(cand_queries, minlength=num_queries)
+        rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = order[rank < k]
+        rank = rank[rank < k]
+        out_ids[cand_queries[keep], rank] = self.ids[cand_rows[keep]]
+        out_scores[cand_queries[keep], rank] = cand_scores[keep]
+        return out_ids, out_scores
+
+
+def build_entity_indexes(feature_modules, node_maps, modes=None, approximate=False, dense=False, **kwargs):
+    """
+    Builds a retrieval index per entity mode, map from mode -> index.
+
+    modes       -- modes to index, defaults to all modes of node_maps
+    approximate -- IVFPQIndex instead of ExactIndex
+    dense       -- the graph was loaded with dense ids (see entity_embeddings)
+    kwargs      -- passed to the index constructor
+    """
+    modes = modes if modes is not None else list(node_maps.keys())
+    indexes = {}
+    for mode in modes:
+        ids, embeds = entity_embeddings(feature_modules, node_maps, mode, dense)
+        indexes[mode] = IVFPQIndex(ids, embeds, **kwargs) if approximate else ExactIndex(ids, embeds, **kwargs)
+    return indexes
+
+
+def retrieve(model, formula, prefs, indexes, k=10, **kwargs):
+    """
+    Top-k entities for every preference, as (ids, scores) of shape [len(prefs), k].
+
+    model   -- PrefRGCN
+    indexes -- map from mode -> index, see build_entity_indexes
+    kwargs  -- passed to the index search
+    """
+    with torch.no_grad():
+        pref_vecs = model.encode_preferences(formula, prefs)
+    return indexes[formula.attributes[0][0]].search(pref_vecs, k, **kwargs)
@@ -0,0 +1,102 @@
+"""
+Precomputed node embeddings for inference.
+
+materialize runs an encoder once over every node of every mode and writes the
+results as one memory-mapped array per mode, with the sorted node ids of its
+rows. EmbeddingSnapshot reads them back and behaves like the encoder it was
+computed from (forward(nodes, mode) -> [dim, len(nodes)]), so a trained
+QueryEncoderDecoder or PrefRGCN can serve from a snapshot (see their
+use_snapshot) without running the encoder per request.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+
+def _ids_file(snapshot_dir, mode):
+    return os.path.join(snapshot_dir, "{:s}-ids.npy".format(mode))
+
+
+def _embeds_file(snapshot_dir, mode):
+    return os.path.join(snapshot_dir, "{:s}-embeds.npy".format(mode))
+
+
+def materialize(enc, node_lists, snapshot_dir, dtype=np.float32, batch_size=10000):
+    """
+    Writes the embeddings enc gives every node to snapshot_dir.
+
+    enc          -- encoder with forward(nodes, mode) -> [dim, len(nodes)], e.g. DirectEncoder
+    node_lists   -- map from mode -> node ids to embed, e.g. graph.full_lists
+    snapshot_dir -- output directory, one <mode>-ids.npy and <mode>-embeds.npy per mode
+    dtype        -- np.float32 or np.float16 storage of the embeddings
+    batch_size   -- number of nodes encoded at once
+    """
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    modes = {}
+    with torch.no_grad():
+        for mode, nodes in node_lists.items():
+            ids = np.unique(np.asarray(list(nodes), dtype=np.int64))
+            np.save(_ids_file(snapshot_dir, mode), ids)
+            embeds = None
+            for start in range(0, len(ids), batch_size):
+                batch = enc.forward(torch.from_numpy(ids[start:start+batch_size]), mode).t()
+                batch = batch.data.cpu().numpy()
+                if embeds is None:
+                    embeds = np.lib.format.open_memmap(_embeds_file(snapshot_dir, mode), mode="w+",
+                                                       dtype=dtype, shape=(len(ids), batch.shape[1]))
+                embeds[start:start+len(batch)] = batch
+            if not embeds is None:
+                embeds.flush()
+                modes[mode] = [len(ids), embeds.shape[1]]
+                del embeds
+    json.dump({"dtype": np.dtype(dtype).name, "modes": modes},
+              open(os.path.join(snapshot_dir, "snapshot.json"), "w"))
+    return EmbeddingSnapshot(snapshot_dir)
+
+
+class EmbeddingSnapshot():
+    """
+    Embeddings written by materialize, memory-mapped, looked up like an encoder.
+    """
+
+    def __init__(self, snapshot_dir, mmap_mode="r", cuda=False):
+        """
+        snapshot_dir -- directory written by materialize
+        mmap_mode    -- np.load mmap_mode of the embeddings, None reads them into memory
+        cuda         -- whether forward returns the embeddings on the GPU
+        """
+        self.info = json.load(open(os.path.join(snapshot_dir, "snapshot.json")))
+        self.ids = {}
+        self.embeds = {}
+        for mode in self.info["modes"]:
+            self.ids[mode] = np.load(_ids_file(snapshot_dir, mode))
+            self.embeds[mode] = np.load(_embeds_file(snapshot_dir, mode), mmap_mode=mmap_mode)
+        self.cuda = cuda
+
+    def rows(self, nodes, mode):
+        """
+        Rows of the embeddings of mode holding nodes; raises on nodes not in the snapshot.
+        """
+        if isinstance(nodes, torch.Tensor):
+            nodes = nodes.cpu().numpy()
+        nodes = np.asarray(nodes, dtype=np.int64)
+        ids = self.ids[mode]
+        rows = np.minimum(np.searchsorted(ids, nodes), len(ids) - 1)
+        if len(nodes) > 0 and not np.array_equal(ids[rows], nodes):
+            raise Exception("Nodes missing from the {:s} embedding snapshot".format(mode))
+        return rows
+
+    def forward(self, nodes, mode):
+        """
+        Embeddings of nodes as a [dim, len(nodes)] float tensor, like enc.forward.
+        """
+        embeds = torch.from_numpy(np.asarray(self.embeds[mode][self.rows(nodes, mode)], dtype=np.float32))
+        if self.cuda:
+            embeds = embeds.cuda()
+        return embeds.t()
+
+    def __call__(self, nodes, mode):
+        return self.forward(nodes, mode)
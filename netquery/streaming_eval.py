@@ -0,0 +1,212 @@
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import torch
+
+from netquery.metrics import RankingMetrics, auc_score
+
+"""
+Streaming evaluation of query models.
+
+The batches of eval_auc_queries / eval_perc_queries (query lists repeated per
+negative, sampled negatives, targets) are built on a background thread and
+queued ahead of the model, so the next batch is ready while the current forward
+pass runs. Every evaluation also records throughput and batch latencies per
+query type.
+"""
+
+
+class Prefetcher():
+    """
+    Iterates over a generator run on a background thread, at most depth items ahead.
+    Exceptions raised by the generator are raised again on iteration.
+    """
+    _done = object()
+
+    def __init__(self, generator, depth=2):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(generator,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, generator):
+        try:
+            for item in generator:
+                if not self._put(item):
+                    return
+            self._put(Prefetcher._done)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if item is Prefetcher._done:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class EvalStats():
+    """
+    Throughput and latency of the evaluated batches, per query type.
+    """
+    def __init__(self):
+        self.num_queries = defaultdict(int)
+        self.latencies = defaultdict(list)
+        self.wait_time = defaultdict(float)
+
+    def add(self, query_type, num_queries, latency):
+        self.num_queries[query_type] += num_queries
+        self.latencies[query_type].append(latency)
+
+    def summary(self):
+        """
+        Map from query type -> {queries, queries_per_sec, wait_sec, latency_p50_ms,
+        latency_p90_ms, latency_p99_ms}; latencies are per batch.
+        """
+        summary = OrderedDict()
+        for query_type, latencies in self.latencies.items():
+            total = sum(latencies) + self.wait_time[query_type]
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+            summary[query_type] = OrderedDict([
+                ("queries", self.num_queries[query_type]),
+                ("queries_per_sec", self.num_queries[query_type] / total if total > 0 else float("inf")),
+                ("wait_sec", self.wait_time[query_type]),
+                ("latency_p50_ms", p50),
+                ("latency_p90_ms", p90),
+                ("latency_p99_ms", p99)])
+        return summary
+
+    def log(self, logger):
+        for query_type, stats in self.summary().items():
+            logger.info("{:s} eval: {:d} queries, {:.1f} queries/sec, batch latency p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms, waited {:.2f}s".format(
+                str(query_type), stats["queries"], stats["queries_per_sec"],
+                stats["latency_p50_ms"], stats["latency_p90_ms"], stats["latency_p99_ms"], stats["wait_sec"]))
+
+
+def _neg_samples(query, hard_negatives):
+    return query.hard_neg_samples if hard_negatives else query.neg_samples
+
+
+def auc_batches(test_queries, batch_size, hard_negatives=False, seed=0):
+    """
+    Batches of eval_auc_queries, one random negative per query:
+    (formula, queries, targets, lengths), queries and targets as enc_dec.forward takes them.
+    """
+    rng = random.Random(seed)
+    for formula in test_queries:
+        formula_queries = test_queries[formula]
+        for offset in range(0, len(formula_queries), batch_size):
+            batch_queries = formula_queries[offset:offset+batch_size]
+            negatives = [rng.choice(_neg_samples(q, hard_negatives)) for q in batch_queries]
+            targets = [q.target_node for q in batch_queries] + negatives
+            yield formula, batch_queries + batch_queries, targets, [1] * len(batch_queries)
+
+
+def perc_batches(test_queries, batch_size, hard_negatives=False):
+    """
+    Batches of eval_perc_queries, every query against all of its negatives:
+    (formula, queries, targets, lengths), queries and targets as enc_dec.forward takes them.
+    """
+    for formula in test_queries:
+        formula_queries = test_queries[formula]
+        for offset in range(0, len(formula_queries), batch_size):
+            batch_queries = formula_queries[offset:offset+batch_size]
+            lengths = [len(_neg_samples(q, hard_negatives)) for q in batch_queries]
+            repeated = [q for i, q in enumerate(batch_queries) for _ in range(lengths[i])]
+            negatives = [n for q in batch_queries for n in _neg_samples(q, hard_negatives)]
+            targets = [q.target_node for q in batch_queries] + negatives
+            yield formula, batch_queries + repeated, targets, lengths
+
+
+class StreamingEvaluator():
+    """
+    Evaluates a query encoder-decoder on batches prepared by a background thread.
+    """
+    def __init__(self, enc_dec, batch_size=1000, prefetch=2, seed=0):
+        """
+        enc_dec     -- model with forward(formula, queries, targets)
+        batch_size  -- number of queries per forward pass
+        prefetch    -- number of batches prepared ahead of the model,
+                       0 prepares them on the calling thread
+        seed        -- seed of the negative sampling of the AUC evaluation
+        """
+        self.enc_dec = enc_dec
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.seed = seed
+        self.stats = EvalStats()
+
+    def _score(self, batches, stats_key):
+        prefetcher = Prefetcher(batches, self.prefetch) if self.prefetch > 0 else None
+        batches = iter(prefetcher if prefetcher is not None else batches)
+        try:
+            with torch.no_grad():
+                while True:
+                    start = time.time()
+                    try:
+                        formula, queries, targets, lengths = next(batches)
+                    except StopIteration:
+                        break
+                    ready = time.time()
+                    self.stats.wait_time[stats_key] += ready - start
+                    scores = self.enc_dec.forward(formula, queries, targets).detach()
+                    self.stats.add(stats_key, len(lengths), time.time() - ready)
+                    yield formula, scores, lengths
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    def eval_auc(self, test_queries, hard_negatives=False, stats_key="auc"):
+        """
+        Same as utils.eval_auc_queries: (overall AUC, map from formula -> AUC).
+        """
+        predictions = defaultdict(list)
+        labels = defaultdict(list)
+        batches = auc_batches(test_queries, self.batch_size, hard_negatives, self.seed)
+        for formula, scores, lengths in self._score(batches, stats_key):
+            predictions[formula].append(scores)
+            labels[formula].extend([1] * len(lengths) + [0] * len(lengths))
+        formula_aucs = OrderedDict()
+        for formula in predictions:
+            predictions[formula] = torch.cat(predictions[formula])
+            formula_aucs[formula] = auc_score(predictions[formula], labels[formula])
+        overall_auc = auc_score(torch.cat(list(predictions.values())),
+                                [l for formula in predictions for l in labels[formula]])
+        return overall_auc, formula_aucs
+
+    def eval_perc(self, test_queries, hard_negatives=False, breakdown=False, stats_key="perc"):
+        """
+        Same as utils.eval_perc_queries: mean percentile rank of the targets, and
+        with breakdown the per formula summary of RankingMetrics.
+        """
+        metrics = RankingMetrics()
+        batches = perc_batches(test_queries, self.batch_size, hard_negatives)
+        for formula, scores, lengths in self._score(batches, stats_key):
+            metrics.add(formula, scores[:len(lengths)], scores[len(lengths):], lengths)
+        summary = metrics.summary()
+        if breakdown:
+            return summary["all"]["perc"], summary
+        return summary["all"]["perc"]
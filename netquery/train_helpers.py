@@ -1,5 +1,5 @@
 import numpy as np
-from .utils import eval_auc_queries, eval_perc_queries
+from .streaming_eval import StreamingEvaluator, EvalStats
 import torch
 
 def check_conv(vals, window=2, tol=1e-6):
@@ -16,31 +16,39 @@ def update_loss(loss, losses, ema_loss, ema_alpha=0.01):
         ema_loss = (1-ema_alpha)*ema_loss + ema_alpha*loss
     return losses, ema_loss
 
-def run_eval(model, queries, iteration, logger, by_type=False):
+def run_eval(model, queries, iteration, logger, by_type=False, evaluator=None):
+    '''
+    evaluator -- StreamingEvaluator of model, by default one evaluating synchronously
+    '''
     vals = {}
     def _print_by_rel(rel_aucs, logger):
         for rels, auc in rel_aucs.items():
             logger.info(str(rels) + "\t" + str(auc))
+    if evaluator is None:
+        evaluator = StreamingEvaluator(model, prefetch=0)
+    evaluator.stats = EvalStats()
     for query_type in queries["one_neg"]:
-        auc, rel_aucs = eval_auc_queries(queries["one_neg"][query_type], model)
-        perc = eval_perc_queries(queries["full_neg"][query_type], model)
+        auc, rel_aucs = evaluator.eval_auc(queries["one_neg"][query_type], stats_key=query_type)
+        perc = evaluator.eval_perc(queries["full_neg"][query_type], stats_key=query_type)
         vals[query_type] = auc
         logger.info("{:s} val AUC: {:f} val perc {:f}; iteration: {:d}".format(query_type, auc, perc, iteration))
         if by_type:
             _print_by_rel(rel_aucs, logger)
         if "inter" in query_type:
-            auc, rel_aucs = eval_auc_queries(queries["one_neg"][query_type], model, hard_negatives=True)
-            perc = eval_perc_queries(queries["full_neg"][query_type], model, hard_negatives=True)
+            auc, rel_aucs = evaluator.eval_auc(queries["one_neg"][query_type], hard_negatives=True, stats_key="Hard-" + query_type)
+            perc = evaluator.eval_perc(queries["full_neg"][query_type], hard_negatives=True, stats_key="Hard-" + query_type)
             logger.info("Hard-{:s} val AUC: {:f} val perc {:f}; iteration: {:d}".format(query_type, auc, perc, iteration))
             if by_type:
                 _print_by_rel(rel_aucs, logger)
             vals[query_type + "hard"] = auc
+    evaluator.stats.log(logger)
     return vals
 
 def run_train(model, optimizer, train_queries, val_queries, test_queries, logger,
         max_burn_in =100000, batch_size=512, log_every=100, val_every=1000, tol=1e-6,
-        max_iter=int(10e7), inter_weight=0.005, path_weight=0.01, model_file=None):
+        max_iter=int(10e7), inter_weight=0.005, path_weight=0.01, model_file=None, eval_prefetch=2):
     edge_conv = False
+    evaluator = StreamingEvaluator(model, prefetch=eval_prefetch)
     ema_loss = None
     vals = []
     losses = []
@@ -52,7 +60,7 @@ def run_train(model, optimizer, train_queries, val_queries, test_queries, logger
         if not edge_conv and (check_conv(vals) or len(losses) >= max_burn_in):
             logger.info("Edge converged at iteration {:d}".format(i-1))
             logger.info("Testing at edge conv...")
-            conv_test = run_eval(model, test_queries, i, logger)
+            conv_test = run_eval(model, test_queries, i, logger, evaluator=evaluator)
             conv_test = np.mean(list(conv_test.values()))
             edge_conv = True
             losses = []
@@ -82,13 +90,13 @@ def run_train(model, optimizer, train_queries, val_queries, test_queries, logger
             logger.info("Iter: {:d}; ema_loss: {:f}".format(i, ema_loss))
             
         if i >= val_every and i % val_every == 0:
-            v = run_eval(model, val_queries, i, logger)
+            v = run_eval(model, val_queries, i, logger, evaluator=evaluator)
             if edge_conv:
                 vals.append(np.mean(list(v.values())))
             else:
                 vals.append(v["1-chain"])
     
-    v = run_eval(model, test_queries, i, logger)
+    v = run_eval(model, test_queries, i, logger, evaluator=evaluator)
     logger.info("Test macro-averaged val: {:f}".format(np.mean(list(v.values()))))
     logger.info("Improvement from edge conv: {:f}".format((np.mean(list(v.values()))-conv_test)/conv_test))
 
@@ -1,11 +1,9 @@
-import numpy as np
-import scipy
-import scipy.stats as stats
 import torch
-from sklearn.metrics import roc_auc_score
 from netquery.decoders import BilinearMetapathDecoder, TransEMetapathDecoder, BilinearDiagMetapathDecoder, SetIntersection, SimpleSetIntersection
 from netquery.encoders import DirectEncoder, Encoder
 from netquery.aggregators import MeanAggregator
+from netquery.csr_graph import NeighborSampler
+from netquery.metrics import percentile_scores, auc_score, RankingMetrics
 import pickle as pickle
 import logging
 import random
@@ -14,23 +12,30 @@ import random
 Misc utility functions..
 """
 
+def make_features(feature_modules, node_maps=None, cuda=False):
+    """
+    Feature function mapping (nodes, mode) to the embeddings of the nodes.
+    nodes is a list or a LongTensor of node ids; an id n is embedded by row
+    node_maps[mode][n]+1 of feature_modules[mode] (row n+1 without node_maps).
+    """
+    def features(nodes, mode):
+        if node_maps is None:
+            rows = torch.as_tensor(nodes, dtype=torch.long) + 1
+        else:
+            if isinstance(nodes, torch.Tensor):
+                nodes = nodes.tolist()
+            rows = torch.LongTensor([node_maps[mode][n] for n in nodes]) + 1
+        if cuda:
+            rows = rows.cuda()
+        return feature_modules[mode](rows)
+    return features
+
 def cudify(feature_modules, node_maps=None):
-   if node_maps is None:
-       features = lambda nodes, mode : feature_modules[mode](
-            torch.autograd.Variable(torch.LongTensor(nodes)+1).cuda())
-   else:
-       features = lambda nodes, mode : feature_modules[mode](
-            torch.autograd.Variable(torch.LongTensor([node_maps[mode][n] for n in nodes])+1).cuda())
-   return features
+    return make_features(feature_modules, node_maps, cuda=True)
 
 def _get_perc_scores(scores, lengths):
-    perc_scores = []
-    cum_sum = 0
-    neg_scores = scores[len(lengths):]
-    for i, length in enumerate(lengths):
-        perc_scores.append(stats.percentileofscore(neg_scores[cum_sum:cum_sum+length], scores[i]))
-        cum_sum += length
-    return perc_scores
+    scores = torch.as_tensor(scores, dtype=torch.float64)
+    return percentile_scores(scores[:len(lengths)], scores[len(lengths):], lengths).tolist()
 
 def eval_auc_queries(test_queries, enc_dec, batch_size=1000, hard_negatives=False, seed=0):
     predictions = []
@@ -58,17 +63,22 @@ def eval_auc_queries(test_queries, enc_dec, batch_size=1000, hard_negatives=Fals
             batch_scores = enc_dec.forward(formula, 
                     batch_queries+[b for i, b in enumerate(batch_queries) for _ in range(lengths[i])], 
                     [q.target_node for q in batch_queries] + negatives)
-            batch_scores = batch_scores.data.tolist()
-            formula_predictions.extend(batch_scores)
-        formula_aucs[formula] = roc_auc_score(formula_labels, np.nan_to_num(formula_predictions))
+            formula_predictions.append(batch_scores.detach())
+        formula_predictions = torch.cat(formula_predictions)
+        formula_aucs[formula] = auc_score(formula_predictions, formula_labels)
         labels.extend(formula_labels)
-        predictions.extend(formula_predictions)
-    overall_auc = roc_auc_score(labels, np.nan_to_num(predictions))
+        predictions.append(formula_predictions)
+    overall_auc = auc_score(torch.cat(predictions), labels)
     return overall_auc, formula_aucs
 
     
-def eval_perc_queries(test_queries, enc_dec, batch_size=1000, hard_negatives=False):
-    perc_scores = []
+def eval_perc_queries(test_queries, enc_dec, batch_size=1000, hard_negatives=False, breakdown=False):
+    '''
+    Mean percentile rank of the targets among their negatives.
+    breakdown -- also return the per formula summary of netquery.metrics.RankingMetrics
+                 (percentile, MRR, Hits@k and AUC)
+    '''
+    metrics = RankingMetrics()
     for formula in test_queries:
         formula_queries = test_queries[formula]
         offset = 0
@@ -86,9 +96,12 @@ def eval_perc_queries(test_queries, enc_dec, batch_size=1000, hard_negatives=Fal
             batch_scores = enc_dec.forward(formula, 
                     batch_queries+[b for i, b in enumerate(batch_queries) for _ in range(lengths[i])], 
                     [q.target_node for q in batch_queries] + negatives)
-            batch_scores = batch_scores.data.tolist()
-            perc_scores.extend(_get_perc_scores(batch_scores, lengths))
-    return np.mean(perc_scores)
+            batch_scores = batch_scores.detach()
+            metrics.add(formula, batch_scores[:len(lengths)], batch_scores[len(lengths):], lengths)
+    summary = metrics.summary()
+    if breakdown:
+        return summary["all"]["perc"], summary
+    return summary["all"]["perc"]
 
 def get_encoder(depth, graph, out_dims, feature_modules, cuda): 
     if depth < 0 or depth > 3:
@@ -97,13 +110,14 @@ def get_encoder(depth, graph, out_dims, feature_modules, cuda):
     if depth == 0:
          enc = DirectEncoder(graph.features, feature_modules)
     else:
+        sampler = NeighborSampler(graph.adj_lists)
         aggregator1 = MeanAggregator(graph.features)
         enc1 = Encoder(graph.features, 
                 graph.feature_dims, 
                 out_dims, 
                 graph.relations, 
                 graph.adj_lists, feature_modules=feature_modules, 
-                cuda=cuda, aggregator=aggregator1)
+                cuda=cuda, aggregator=aggregator1, sampler=sampler)
         enc = enc1
         if depth >= 2:
             aggregator2 = MeanAggregator(lambda nodes, mode : enc1(nodes, mode).t().squeeze())
@@ -111,8 +125,8 @@ def get_encoder(depth, graph, out_dims, feature_modules, cuda):
                     enc1.out_dims, 
                     out_dims, 
                     graph.relations, 
-                    graph.adj_lists, base_model=enc1,
-                    cuda=cuda, aggregator=aggregator2)
+                    graph.adj_lists, base_model=enc1, feature_layer=1,
+                    cuda=cuda, aggregator=aggregator2, sampler=sampler)
             enc = enc2
             if depth >= 3:
                 aggregator3 = MeanAggregator(lambda nodes, mode : enc2(nodes, mode).t().squeeze())
@@ -120,8 +134,8 @@ def get_encoder(depth, graph, out_dims, feature_modules, cuda):
                         enc2.out_dims, 
                         out_dims, 
                         graph.relations, 
-                        graph.adj_lists, base_model=enc2,
-                        cuda=cuda, aggregator=aggregator3)
+                        graph.adj_lists, base_model=enc2, feature_layer=1,
+                        cuda=cuda, aggregator=aggregator3, sampler=sampler)
                 enc = enc3
     return enc
 
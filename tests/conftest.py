@@ -0,0 +1,85 @@
+import pickle
+import random
+from collections import defaultdict
+
+import pytest
+import torch
+
+from netquery.bio.data_utils import load_graph
+from netquery.graph import Graph
+from netquery.model import QueryEncoderDecoder
+from netquery.utils import get_encoder, get_intersection_decoder, get_metapath_decoder
+
+MODES = ["drug", "protein", "disease", "function", "sideeffects"]
+
+RELATIONS = [("drug", "targets", "protein"), ("protein", "assoc", "disease"),
+             ("protein", "has_function", "function"), ("drug", "causes", "sideeffects"),
+             ("drug", "treats", "disease"), ("protein", "interacts", "protein"),
+             ("disease", "dis_func", "function"), ("function", "f_side", "sideeffects"),
+             ("drug", "dd", "drug")]
+
+
+def make_graph_data(seed=0, num_nodes=60, edge_prob=0.08):
+    """
+    Small random graph over the modes of the bio data, as (relations, adj_lists, node_ids)
+    in the layout of graph_data.pkl. Node ids are distinct across modes.
+    """
+    rng = random.Random(seed)
+    node_ids = {mode: list(range(i * num_nodes, (i + 1) * num_nodes)) for i, mode in enumerate(MODES)}
+    relations = defaultdict(list)
+    adj_lists = {}
+    for head, name, tail in RELATIONS:
+        rel, rev_rel = (head, name, tail), (tail, name, head)
+        relations[head].append((tail, name))
+        if rel != rev_rel:
+            relations[tail].append((head, name))
+        adj_lists.setdefault(rel, defaultdict(set))
+        adj_lists.setdefault(rev_rel, defaultdict(set))
+        for a in node_ids[head]:
+            for b in node_ids[tail]:
+                if rng.random() < edge_prob:
+                    adj_lists[rel][a].add(b)
+                    adj_lists[rev_rel][b].add(a)
+    return dict(relations), adj_lists, node_ids
+
+
+def build_enc_dec(data_dir, embed_dim=16, dense=False):
+    torch.manual_seed(0)
+    graph, feature_modules, node_maps = load_graph(data_dir, embed_dim, dense=dense)
+    out_dims = {mode: embed_dim for mode in graph.relations}
+    enc = get_encoder(0, graph, out_dims, feature_modules, False)
+    dec = get_metapath_decoder(graph, out_dims, "bilinear")
+    inter_dec = get_intersection_decoder(graph, out_dims, "mean")
+    return QueryEncoderDecoder(graph, enc, dec, inter_dec)
+
+
+def copy_adj_lists(adj_lists):
+    return {rel: defaultdict(set, {node: set(neighs) for node, neighs in adjs.items()})
+            for rel, adjs in adj_lists.items()}
+
+
+def sample_query_file(graph_data, path):
+    """
+    Samples 2- and 3-edge queries on graph_data and pickles them to path, as the
+    query files of data_utils are written.
+    """
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    random.seed(0)
+    queries = graph.sample_queries(2, 80, 20, verbose=False) + graph.sample_queries(3, 80, 20, verbose=False)
+    pickle.dump([q.serialize() for q in queries], open(path, "wb"))
+    return graph, queries
+
+
+@pytest.fixture
+def graph_data():
+    return make_graph_data()
+
+
+@pytest.fixture
+def data_dir(tmp_path, graph_data):
+    """
+    Directory with the graph_data.pkl of graph_data, for the loaders of bio/data_utils.py.
+    """
+    pickle.dump(graph_data, open(str(tmp_path / "graph_data.pkl"), "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+    return str(tmp_path) + "/"
@@ -0,0 +1,102 @@
+import math
+import random
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from netquery.aggregators import (MeanAggregator, FastMeanAggregator, PoolAggregator,
+                                  FastPoolAggregator, _sample_neighs)
+
+REL = ("drug", "targets", "protein")
+
+
+def make_features(num_nodes=50, dim=8):
+    torch.manual_seed(0)
+    embedding = nn.Embedding(num_nodes, dim)
+    return lambda nodes, mode: embedding(torch.as_tensor(list(nodes), dtype=torch.long))
+
+
+def make_neighs(num_nodes=50, batch=12, seed=0):
+    rng = random.Random(seed)
+    return [rng.sample(range(num_nodes), rng.randint(1, 15)) for _ in range(batch)]
+
+
+def dense_mask_mean(features, samp_neighs, rel, pool_matrix=None):
+    """
+    The mask based aggregation the embedding bag replaced: a row normalized (or, for
+    pooling, 0/1) node x unique neighbor mask times the neighbor embeddings.
+    """
+    samp_neighs = [set(samp_neigh) for samp_neigh in samp_neighs]
+    unique_nodes_list = list(set.union(*samp_neighs))
+    unique_nodes = {n: i for i, n in enumerate(unique_nodes_list)}
+    mask = torch.zeros(len(samp_neighs), len(unique_nodes))
+    column_indices = [unique_nodes[n] for samp_neigh in samp_neighs for n in samp_neigh]
+    row_indices = [i for i in range(len(samp_neighs)) for j in range(len(samp_neighs[i]))]
+    mask[row_indices, column_indices] = 1
+    embed_matrix = features(unique_nodes_list, rel[-1])
+    if pool_matrix is None:
+        return mask.div(mask.sum(1, keepdim=True)).mm(embed_matrix)
+    return F.relu(mask.mm(embed_matrix.mm(pool_matrix)))
+
+
+def sample_reference(to_neighs, keep_prob, max_keep):
+    return [random.sample(to_neigh, min(int(math.ceil(len(to_neigh) * keep_prob)), max_keep))
+            for to_neigh in to_neighs]
+
+
+@pytest.mark.parametrize("keep_prob,max_keep", [(1.0, 100), (0.5, 10), (0.3, 3)])
+def test_mean_aggregator_matches_dense_mask(keep_prob, max_keep):
+    features = make_features()
+    agg = MeanAggregator(features)
+    to_neighs = make_neighs()
+    random.seed(7)
+    out = agg(to_neighs, REL, keep_prob, max_keep)
+    random.seed(7)
+    expected = dense_mask_mean(features, sample_reference(to_neighs, keep_prob, max_keep), REL)
+    assert torch.allclose(out, expected, atol=1e-6)
+
+
+def test_mean_aggregator_aggregate_matches_dense_mask():
+    features = make_features()
+    agg = MeanAggregator(features)
+    to_neighs = make_neighs(seed=3)
+    random.seed(1)
+    neighs, offsets = _sample_neighs(to_neighs, 0.5, 10)
+    bounds = offsets.tolist() + [len(neighs)]
+    samp_neighs = [neighs[bounds[i]:bounds[i+1]] for i in range(len(to_neighs))]
+    expected = dense_mask_mean(features, samp_neighs, REL)
+    assert torch.allclose(agg.aggregate(neighs, offsets, REL), expected, atol=1e-6)
+
+
+def test_pool_aggregator_matches_dense_mask():
+    features = make_features()
+    agg = PoolAggregator(features, {"drug": 8})
+    to_neighs = make_neighs(seed=5)
+    random.seed(2)
+    out = agg(to_neighs, REL, 0.5, 6)
+    random.seed(2)
+    expected = dense_mask_mean(features, sample_reference(to_neighs, 0.5, 6), REL,
+                               pool_matrix=agg.pool_matrix["drug"])
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_fast_aggregators_pool_node_major_samples():
+    features = make_features()
+    to_neighs = make_neighs(seed=9)
+    max_keep = 6
+    rng = random.Random(0)
+    samp_neighs = [[rng.choice(to_neigh) for _ in range(max_keep)] for to_neigh in to_neighs]
+    neighs = [n for samp_neigh in samp_neighs for n in samp_neigh]
+    offsets = torch.arange(0, len(neighs), max_keep)
+
+    mean_agg = FastMeanAggregator(features)
+    expected = torch.stack([features(samp_neigh, "protein").mean(dim=0) for samp_neigh in samp_neighs])
+    assert torch.allclose(mean_agg.aggregate(neighs, offsets, REL), expected, atol=1e-6)
+
+    pool_agg = FastPoolAggregator(features, {"drug": 8})
+    pool_matrix = pool_agg.pool_matrix["drug"]
+    expected = torch.stack([features(samp_neigh, "protein").mm(pool_matrix).mean(dim=0)
+                            for samp_neigh in samp_neighs])
+    assert torch.allclose(pool_agg.aggregate(neighs, offsets, REL), expected, atol=1e-5)
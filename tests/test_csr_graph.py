@@ -0,0 +1,145 @@
+import math
+from collections import Counter
+
+import pytest
+import torch
+
+from netquery import graph, pref_graph
+from netquery.csr_graph import CSRAdjLists, NeighborSampler, SparseMetapaths
+from tests.conftest import copy_adj_lists
+
+
+def test_adjacency_reads_like_dict(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    csr = CSRAdjLists.from_adj_lists(adj_lists)
+    for rel, adjs in adj_lists.items():
+        adj = csr[rel]
+        assert len(adj) == len(adjs)
+        assert sorted(adj.keys()) == sorted(adjs.keys())
+        assert sum(len(neighs) for neighs in adjs.values()) == adj.num_edges()
+        for node in node_ids[rel[0]]:
+            assert (node in adj) == (node in adjs)
+            assert adj[node] == adjs.get(node, set())
+            assert adj.degree(node) == len(adjs.get(node, ()))
+            assert adj.get(node) == (set(adjs[node]) if node in adjs else None)
+            for tail in node_ids[rel[-1]][:10]:
+                assert adj.has_edge(node, tail) == (tail in adjs.get(node, ()))
+        assert adj.get(-1, "missing") == "missing"
+        assert adj[-1] == frozenset()
+
+
+def test_neighbor_sets_are_read_only(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    csr = CSRAdjLists.from_adj_lists(adj_lists)
+    rel = next(iter(adj_lists))
+    node = next(iter(adj_lists[rel]))
+    with pytest.raises(AttributeError):
+        csr[rel][node].add(-1)
+
+
+@pytest.mark.parametrize("graph_cls", [graph.Graph, pref_graph.Graph])
+def test_graph_matches_dict_graph(graph_data, graph_cls):
+    relations, adj_lists, node_ids = graph_data
+    dict_graph = graph_cls(None, None, relations, copy_adj_lists(adj_lists))
+    csr_graph = graph_cls(None, None, relations, CSRAdjLists.from_adj_lists(adj_lists))
+    assert csr_graph.rel_edges == dict_graph.rel_edges
+    assert csr_graph.edges == dict_graph.edges
+    assert {mode: set(nodes) for mode, nodes in csr_graph.full_sets.items()} == \
+           {mode: set(nodes) for mode, nodes in dict_graph.full_sets.items()}
+    for mode, nodes in dict_graph.full_sets.items():
+        for node in nodes:
+            assert Counter(csr_graph.flat_adj_lists[mode][node]) == Counter(dict_graph.flat_adj_lists[mode][node])
+    rels = (("drug", "targets", "protein"), ("protein", "assoc", "disease"))
+    for node in node_ids["drug"]:
+        assert set(csr_graph.get_metapath_neighs(node, rels)) == set(dict_graph.get_metapath_neighs(node, rels))
+
+
+def test_neighbor_sampler_without_replacement(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    sampler = NeighborSampler(adj_lists, seed=0)
+    for rel, adjs in adj_lists.items():
+        nodes = node_ids[rel[0]] + [-1, 10**6]
+        for keep_prob, max_keep in [(0.5, 3), (1.0, 100), (None, 2)]:
+            neighs, offsets = sampler.sample(nodes, rel, keep_prob, max_keep)
+            bounds = offsets.tolist() + [len(neighs)]
+            for i, node in enumerate(nodes):
+                samp = neighs[bounds[i]:bounds[i+1]].tolist()
+                full = adjs.get(node, set())
+                if len(full) == 0:
+                    assert samp == [-1]
+                    continue
+                deg = len(full)
+                expected = min(deg if keep_prob is None else int(math.ceil(deg*keep_prob)), max_keep)
+                assert len(samp) == expected
+                assert len(set(samp)) == len(samp)
+                assert set(samp) <= full
+
+
+def test_neighbor_sampler_with_replacement(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    rel = ("drug", "targets", "protein")
+    adjs = adj_lists[rel]
+    nodes = torch.LongTensor(node_ids["drug"] + [-1])
+    sampler = NeighborSampler(CSRAdjLists.from_adj_lists(adj_lists), seed=0)
+    seen = Counter()
+    for _ in range(20):
+        neighs, offsets = sampler.sample(nodes, rel, None, 4, replace=True)
+        bounds = offsets.tolist() + [len(neighs)]
+        for i, node in enumerate(nodes.tolist()):
+            samp = neighs[bounds[i]:bounds[i+1]].tolist()
+            if len(adjs.get(node, ())) == 0:
+                # the null neighbor fills all max_keep draws, as [-1] did in FastMeanAggregator
+                assert samp == [-1] * 4
+            else:
+                assert len(samp) == 4
+                assert set(samp) <= adjs[node]
+                seen.update((node, n) for n in samp)
+    # every edge of the relation is drawn sooner or later
+    assert set(seen) == set((node, n) for node, neighs in adjs.items() for n in neighs
+                            if node in node_ids["drug"])
+
+
+def test_neighbor_sampler_keeps_dict_snapshot(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    adj_lists = copy_adj_lists(adj_lists)
+    rel = ("drug", "targets", "protein")
+    node = next(node for node, neighs in adj_lists[rel].items() if len(neighs) > 0)
+    sampler = NeighborSampler(adj_lists, seed=0)
+    before = set(adj_lists[rel][node])
+    adj_lists[rel][node] = set()
+    neighs, _ = sampler.sample([node], rel, 1.0, 100)
+    assert set(neighs.tolist()) == before
+
+
+def metapath_frontiers(adj_lists, node, rels):
+    """
+    Nodes reached from node after each step of rels, by following the dict adjacency.
+    """
+    current_set = set([node])
+    reached = []
+    for rel in rels:
+        current_set = set([neigh for n in current_set for neigh in adj_lists[rel].get(n, ())])
+        reached.append(current_set)
+    return reached
+
+
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_sparse_metapaths_match_adjacency(graph_data, chunk_size):
+    relations, adj_lists, node_ids = graph_data
+    metapaths = SparseMetapaths(adj_lists)
+    rels_choices = [(("drug", "targets", "protein"), ("protein", "assoc", "disease")),
+                    (("drug", "dd", "drug"), ("drug", "treats", "disease")),
+                    (("protein", "targets", "drug"), ("drug", "causes", "sideeffects"))]
+    paths = [(node, rels) for rels in rels_choices for node in node_ids[rels[0][0]][:25]]
+    paths.append((10**6, rels_choices[0]))
+    nodes, rels_list = zip(*paths)
+    seen = 0
+    for start, reached, frontiers in metapaths.reach(nodes, rels_list, chunk_size):
+        assert len(frontiers) == 1
+        for i in range(reached.shape[0]):
+            node, rels = paths[start+i]
+            expected = metapath_frontiers(adj_lists, node, rels)
+            assert set(metapaths.row_ids(reached, i).tolist()) == expected[-1]
+            assert set(metapaths.row_ids(frontiers[0], i).tolist()) == expected[0]
+            seen += 1
+    assert seen == len(paths)
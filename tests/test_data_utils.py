@@ -0,0 +1,54 @@
+import os
+
+import torch
+
+from netquery.bio.data_utils import load_graph
+from netquery.data_utils import load_dense_graph_data, load_queries_by_formula
+from tests.conftest import build_enc_dec, sample_query_file
+
+
+def test_dense_graph_matches_original(data_dir, graph_data):
+    relations, adj_lists, node_ids = graph_data
+    torch.manual_seed(0)
+    graph, _, node_maps = load_graph(data_dir, 8)
+    torch.manual_seed(0)
+    dense_graph, _, dense_maps = load_graph(data_dir, 8, dense=True)
+    assert dense_maps == node_maps
+    for mode, ids in node_ids.items():
+        assert sorted(dense_graph.full_sets[mode]) == sorted(node_maps[mode][n] for n in graph.full_sets[mode])
+        orig = torch.LongTensor(ids)
+        dense = torch.LongTensor([node_maps[mode][n] for n in ids])
+        assert torch.equal(graph.features(orig, mode), dense_graph.features(dense, mode))
+    for rel, adjs in adj_lists.items():
+        for node, neighs in adjs.items():
+            expected = set(node_maps[rel[-1]][n] for n in neighs)
+            assert set(dense_graph.adj_lists[rel][node_maps[rel[0]][node]]) == expected
+
+
+def test_dense_graph_file_is_reused(data_dir):
+    first = load_dense_graph_data(data_dir)
+    dense_file = os.path.join(data_dir, "graph_data-dense.pkl")
+    assert os.path.exists(dense_file)
+    mtime = os.path.getmtime(dense_file)
+    assert load_dense_graph_data(data_dir) == first
+    assert os.path.getmtime(dense_file) == mtime
+
+
+def test_dense_queries_score_as_original(data_dir, graph_data, tmp_path):
+    sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    enc_dec = build_enc_dec(data_dir)
+    dense_enc_dec = build_enc_dec(data_dir, dense=True)
+    node_maps = load_graph(data_dir, 8)[2]
+    queries = load_queries_by_formula(str(tmp_path / "queries.pkl"))
+    dense_queries = load_queries_by_formula(str(tmp_path / "queries.pkl"), id_maps=node_maps)
+    for query_type, by_formula in queries.items():
+        for formula, formula_queries in by_formula.items():
+            dense_formula_queries = dense_queries[query_type][formula]
+            targets = [q.target_node for q in formula_queries]
+            dense_targets = [node_maps[formula.target_mode][n] for n in targets]
+            assert [q.target_node for q in dense_formula_queries] == dense_targets
+            with torch.no_grad():
+                scores = enc_dec.forward(formula, formula_queries[0:len(formula_queries)], targets)
+                dense_scores = dense_enc_dec.forward(formula, dense_formula_queries[0:len(formula_queries)],
+                                                     dense_targets)
+            assert torch.allclose(scores, dense_scores, atol=1e-6)
@@ -0,0 +1,76 @@
+import torch
+
+from netquery.decoders import BilinearMetapathDecoder
+
+DIM = 8
+
+CHAINS = [[("drug", "targets", "protein")],
+          [("drug", "targets", "protein"), ("protein", "assoc", "disease")],
+          [("drug", "targets", "protein"), ("protein", "interacts", "protein"),
+           ("protein", "has_function", "function")]]
+
+
+def build_decoder(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    torch.manual_seed(0)
+    return BilinearMetapathDecoder(relations, {mode: DIM for mode in relations})
+
+
+def sequential_forward(dec, embeds1, embeds2, rels):
+    act = embeds1.t()
+    for i_rel in rels:
+        act = act.mm(dec.mats[i_rel])
+    return dec.cos(act.t(), embeds2)
+
+
+def sequential_project(dec, embeds, rels):
+    for rel in rels:
+        embeds = dec.project(embeds, rel)
+    return embeds
+
+
+def test_composed_chain_matches_sequential(graph_data):
+    dec = build_decoder(graph_data)
+    embeds1 = torch.randn(DIM, 11)
+    embeds2 = torch.randn(DIM, 11)
+    for rels in CHAINS:
+        reverse = [(rel[-1], rel[1], rel[0]) for rel in rels[::-1]]
+        for grad in [True, False]:
+            with torch.set_grad_enabled(grad):
+                assert torch.allclose(dec.forward(embeds1, embeds2, rels),
+                                      sequential_forward(dec, embeds1, embeds2, rels), atol=1e-6)
+                assert torch.allclose(dec.project_path(embeds2, reverse),
+                                      sequential_project(dec, embeds2, reverse), atol=1e-6)
+
+
+def test_composed_gradients_match_sequential(graph_data):
+    dec = build_decoder(graph_data)
+    embeds1 = torch.randn(DIM, 5)
+    embeds2 = torch.randn(DIM, 5)
+    rels = CHAINS[2]
+    params = [dec.mats[rel] for rel in rels]
+    composed = torch.autograd.grad(dec.forward(embeds1, embeds2, rels).sum(), params)
+    sequential = torch.autograd.grad(sequential_forward(dec, embeds1, embeds2, rels).sum(), params)
+    for a, b in zip(composed, sequential):
+        assert torch.allclose(a, b, atol=1e-6)
+
+
+def test_cached_products_follow_parameter_updates(graph_data):
+    dec = build_decoder(graph_data)
+    embeds1 = torch.randn(DIM, 5)
+    embeds2 = torch.randn(DIM, 5)
+    rels = CHAINS[1]
+    with torch.no_grad():
+        first = dec.composed(rels)
+        assert dec.composed(rels) is first
+    optimizer = torch.optim.SGD(dec.parameters(), lr=0.5)
+    dec.forward(embeds1, embeds2, rels).sum().backward()
+    optimizer.step()
+    with torch.no_grad():
+        assert not dec.composed(rels) is first
+        assert torch.allclose(dec.forward(embeds1, embeds2, rels),
+                              sequential_forward(dec, embeds1, embeds2, rels), atol=1e-6)
+        state = {name: torch.randn_like(value) for name, value in dec.state_dict().items()}
+        dec.load_state_dict(state)
+        assert torch.allclose(dec.forward(embeds1, embeds2, rels),
+                              sequential_forward(dec, embeds1, embeds2, rels), atol=1e-6)
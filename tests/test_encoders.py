@@ -0,0 +1,94 @@
+import functools
+
+import pytest
+import torch
+
+from netquery.bio.data_utils import load_graph
+from netquery.encoders import _gather_rows
+from netquery.utils import get_encoder
+
+EMBED_DIM = 8
+
+
+def build_encoder(data_dir, depth, csr=False):
+    torch.manual_seed(0)
+    graph, feature_modules, node_maps = load_graph(data_dir, EMBED_DIM, csr=csr)
+    out_dims = {mode: EMBED_DIM for mode in graph.relations}
+    return graph, get_encoder(depth, graph, out_dims, feature_modules, False)
+
+
+def without_sampler(enc, keep_prob=1.0, max_keep=1000):
+    """
+    Switches the stack to the node by node lookup. The lower layers are called through
+    the features of the layer above, with the default sampling parameters, so these are
+    pinned to keep_prob and max_keep.
+    """
+    for layer in enc.layers():
+        layer.sampler = None
+        if not layer is enc:
+            layer.forward = functools.partial(layer.forward, keep_prob=keep_prob, max_keep=max_keep)
+
+
+@pytest.mark.parametrize("csr", [False, True])
+@pytest.mark.parametrize("depth", [1, 2, 3])
+def test_sampled_encoder_matches_node_lookup(data_dir, graph_data, depth, csr):
+    """
+    Keeping every neighbor, the batched sampler and the layer by layer computation give
+    the embeddings of the node by node adjacency lookup.
+    """
+    relations, adj_lists, node_ids = graph_data
+    graph, enc = build_encoder(data_dir, depth, csr=csr)
+    nodes = node_ids["protein"][:20] + node_ids["protein"][:5]
+    with torch.no_grad():
+        sampled = enc(nodes, "protein", keep_prob=1.0, max_keep=1000)
+        without_sampler(enc)
+        expected = enc(nodes, "protein", keep_prob=1.0, max_keep=1000)
+    assert sampled.size() == (EMBED_DIM, len(nodes))
+    assert torch.allclose(sampled, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("depth", [1, 2])
+def test_cached_embeddings_match_uncached(data_dir, graph_data, depth):
+    relations, adj_lists, node_ids = graph_data
+    graph, enc = build_encoder(data_dir, depth, csr=True)
+    nodes = node_ids["drug"][:30]
+    with torch.no_grad():
+        uncached = enc(nodes, "drug", keep_prob=1.0, max_keep=1000)
+        enc.cache_embeddings(keep_prob=1.0, max_keep=1000, batch_size=17)
+        cached = enc(nodes, "drug")
+    assert torch.allclose(cached, uncached, atol=1e-5)
+    enc.clear_cache()
+    assert enc.embed_cache is None
+
+
+def test_cached_embeddings_missing_nodes(data_dir, graph_data):
+    relations, adj_lists, node_ids = graph_data
+    graph, enc = build_encoder(data_dir, 1)
+    with torch.no_grad():
+        enc.cache_embeddings()
+        with pytest.raises(KeyError, match="1000000"):
+            enc(node_ids["drug"][:3] + [10**6], "drug")
+        # the ids of the other modes are no drugs either
+        with pytest.raises(KeyError):
+            enc(node_ids["protein"][:3], "drug")
+    with pytest.raises(KeyError):
+        _gather_rows(torch.LongTensor([]), torch.zeros(0, 4), [1])
+
+
+def test_forward_layers_per_layer_sampling(data_dir, graph_data):
+    relations, adj_lists, node_ids = graph_data
+    graph, enc = build_encoder(data_dir, 2)
+    calls = []
+    for k, layer in enumerate(enc.layers()):
+        def record(mode, nodes, keep_prob, max_keep, k=k, sample=layer._sample):
+            calls.append((k, keep_prob, max_keep))
+            return sample(mode, nodes, keep_prob, max_keep)
+        layer._sample = record
+    with torch.no_grad():
+        enc(node_ids["drug"][:5], "drug", keep_prob=[0.2, 0.7], max_keep=[3, 9])
+        assert set(calls) == set([(0, 0.2, 3), (1, 0.7, 9)])
+        del calls[:]
+        enc(node_ids["drug"][:5], "drug", keep_prob=0.4, max_keep=5)
+        assert set(calls) == set([(0, 0.4, 5), (1, 0.4, 5)])
+        with pytest.raises(Exception, match="layers"):
+            enc(node_ids["drug"][:5], "drug", keep_prob=[0.2, 0.5, 0.7])
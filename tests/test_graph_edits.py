@@ -0,0 +1,162 @@
+import random
+from collections import Counter
+
+import pytest
+
+from netquery import graph, pref_graph
+from netquery.csr_graph import CSRAdjLists
+from tests.conftest import copy_adj_lists
+
+GRAPH_CLASSES = [graph.Graph, pref_graph.Graph]
+
+
+def _reverse_relation(rel):
+    return (rel[-1], rel[1], rel[0])
+
+
+def make_graph(graph_cls, relations, adj_lists, csr):
+    adj_lists = CSRAdjLists.from_adj_lists(adj_lists) if csr else copy_adj_lists(adj_lists)
+    return graph_cls(None, None, relations, adj_lists)
+
+
+def edited_adj_lists(adj_lists, removed=(), added=()):
+    adj_lists = copy_adj_lists(adj_lists)
+    for head, rel, tail in removed:
+        adj_lists[rel][head].discard(tail)
+        adj_lists[_reverse_relation(rel)][tail].discard(head)
+    for head, rel, tail in added:
+        adj_lists[rel][head].add(tail)
+        adj_lists[_reverse_relation(rel)][tail].add(head)
+    return adj_lists
+
+
+def graph_state(g):
+    """
+    What a graph built from scratch over the same edges would hold: the adjacency
+    (non-empty rows), flat lists, edge counts and weights, and node sets.
+    """
+    adj = {rel: {node: frozenset(g.adj_lists[rel][node]) for node in g.adj_lists[rel].keys()
+                 if len(g.adj_lists[rel][node]) > 0}
+           for rel in g.adj_lists.keys()}
+    flat = {mode: {node: Counter(g.flat_adj_lists[mode][node]) for node in nodes
+                   if len(g.flat_adj_lists[mode][node]) > 0}
+            for mode, nodes in g.full_sets.items()}
+    rel_weights = {rel: round(weight, 12) for rel, weight in g.rel_weights.items()}
+    mode_weights = {mode: round(weight, 12) for mode, weight in g.mode_weights.items()}
+    return (adj, flat, dict(g.rel_edges), g.edges, rel_weights, mode_weights,
+            {mode: set(nodes) for mode, nodes in g.full_sets.items()},
+            {mode: sorted(nodes) for mode, nodes in g.full_lists.items()})
+
+
+def negative_samples(g, query_graphs):
+    return [tuple(None if samples is None else set(samples) for samples in g.get_negative_samples(q))
+            for q in query_graphs]
+
+
+def sample_query_graphs(g, seed, num=60):
+    random.seed(seed)
+    query_graphs = [q for q in (g.sample_query_subgraph(3) for _ in range(num)) if not q is None]
+    assert len(query_graphs) > 0
+    return query_graphs
+
+
+@pytest.mark.parametrize("csr", [False, True])
+@pytest.mark.parametrize("graph_cls", GRAPH_CLASSES)
+def test_incremental_edits_match_rebuild(graph_data, graph_cls, csr):
+    relations, adj_lists, node_ids = graph_data
+    g = make_graph(graph_cls, relations, adj_lists, csr)
+    original = graph_state(g)
+    edges = random.Random(0).sample(g.get_all_edges(seed=3), 120)
+
+    def rebuilt(removed=(), added=()):
+        return make_graph(graph_cls, relations, edited_adj_lists(adj_lists, removed, added), csr)
+
+    view = g.view()
+    view.remove_edges(edges)
+    expected = rebuilt(edges)
+    assert graph_state(view) == graph_state(expected)
+    assert graph_state(g) == original
+    query_graphs = sample_query_graphs(expected, 1)
+    assert negative_samples(view, query_graphs) == negative_samples(expected, query_graphs)
+
+    view_state = graph_state(view)
+    g.remove_edges(edges[:40])
+    assert graph_state(g) == graph_state(rebuilt(edges[:40]))
+    assert graph_state(view) == view_state
+    g.add_edges(edges[:40])
+    assert graph_state(g) == original
+
+    view.add_edges(edges)
+    assert graph_state(view) == original
+    query_graphs = sample_query_graphs(g, 2)
+    assert negative_samples(view, query_graphs) == negative_samples(rebuilt(), query_graphs)
+
+
+@pytest.mark.parametrize("graph_cls", GRAPH_CLASSES)
+def test_dict_view_copies_edited_rows_only(graph_data, graph_cls):
+    relations, adj_lists, node_ids = graph_data
+    g = make_graph(graph_cls, relations, adj_lists, False)
+    edges = random.Random(1).sample(g.get_all_edges(seed=3), 60)
+    rel = edges[0][1]
+    touched = set([head for head, r, tail in edges if r == rel] +
+                  [tail for head, r, tail in edges if _reverse_relation(r) == rel])
+    shared = [node for node in list(g.adj_lists[rel].keys()) if not node in touched]
+    view = g.view()
+    view.remove_edges(edges)
+    assert len(shared) > 0
+    assert all(view.adj_lists[rel][node] is g.adj_lists[rel][node] for node in shared)
+    assert all(not view.adj_lists[rel][node] is g.adj_lists[rel][node] for node in touched)
+
+    new_node = 10**6
+    view.add_edges([(new_node, rel, edges[0][2])])
+    assert new_node in view.full_sets[rel[0]] and not new_node in g.full_sets[rel[0]]
+    assert new_node in view.full_lists[rel[0]] and not new_node in g.full_lists[rel[0]]
+    assert graph_state(view) == graph_state(make_graph(graph_cls, relations,
+        edited_adj_lists(adj_lists, edges, [(new_node, rel, edges[0][2])]), False))
+
+
+@pytest.mark.parametrize("graph_cls", GRAPH_CLASSES)
+def test_csr_rejects_new_nodes(graph_data, graph_cls):
+    relations, adj_lists, node_ids = graph_data
+    g = make_graph(graph_cls, relations, adj_lists, True)
+    head, rel, tail = g.get_all_edges(seed=3)[0]
+    with pytest.raises(Exception):
+        g.add_edges([(10**6, rel, tail)])
+
+
+@pytest.mark.parametrize("csr", [False, True])
+@pytest.mark.parametrize("graph_cls", GRAPH_CLASSES)
+def test_split_matches_removed_edges(graph_data, graph_cls, csr):
+    relations, adj_lists, node_ids = graph_data
+    g = make_graph(graph_cls, relations, adj_lists, csr)
+    original = graph_state(g)
+    all_edges = g.get_all_edges(seed=3)
+    rng = random.Random(0)
+    test_edges = rng.sample(all_edges, 100)
+    val_edges = rng.sample(all_edges, 60)
+    views = g.split([val_edges, test_edges])
+    assert len(views) == 3
+    assert graph_state(g) == original
+    expected = [make_graph(graph_cls, relations, edited_adj_lists(adj_lists, removed), csr)
+                for removed in [val_edges + test_edges, test_edges, []]]
+    for k, (view, ref) in enumerate(zip(views, expected)):
+        assert graph_state(view) == graph_state(ref)
+        query_graphs = sample_query_graphs(ref, 5 + k)
+        assert negative_samples(view, query_graphs) == negative_samples(ref, query_graphs)
+        if csr:
+            for head, rel, tail in rng.sample(all_edges, 100) + test_edges[:30] + val_edges[:30]:
+                adj, ref_adj = view.adj_lists[rel], ref.adj_lists[rel]
+                assert adj.has_edge(head, tail) == ref_adj.has_edge(head, tail)
+                assert adj.degree(head) == ref_adj.degree(head)
+                assert set(adj.neighbors(head).tolist()) == set(ref_adj.neighbors(head).tolist())
+            # the views share one copy of the CSR arrays
+            for rel in g.adj_lists.keys():
+                assert view.adj_lists[rel].indices is views[0].adj_lists[rel].indices
+
+    # editing a view leaves its siblings as they were
+    views[0].add_edges(test_edges[:20])
+    views[0].remove_edges(val_edges[:20])
+    assert graph_state(views[0]) == graph_state(make_graph(graph_cls, relations,
+        edited_adj_lists(edited_adj_lists(adj_lists, val_edges + test_edges, test_edges[:20]), val_edges[:20]), csr))
+    assert graph_state(views[1]) == graph_state(expected[1])
+    assert graph_state(views[2]) == original
@@ -0,0 +1,159 @@
+import random
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from netquery import graph, pref_graph
+from netquery.csr_graph import CSRAdjLists
+from netquery.metapath_cache import MetapathCache, SortedIdSet
+from tests.conftest import copy_adj_lists
+
+METAPATHS = [(("drug", "targets", "protein"),),
+             (("drug", "targets", "protein"), ("protein", "assoc", "disease")),
+             (("drug", "targets", "protein"), ("protein", "interacts", "protein"),
+              ("protein", "has_function", "function")),
+             (("protein", "targets", "drug"), ("drug", "dd", "drug"))]
+
+
+def _reverse_relation(rel):
+    return (rel[-1], rel[1], rel[0])
+
+
+def metapath_neighs(adj_lists, node, rels):
+    current_set = [node]
+    for rel in rels:
+        current_set = set([neigh for n in current_set for neigh in adj_lists[rel].get(n, ())])
+    return current_set
+
+
+def scan_stale(cache, edge_list):
+    """
+    The entries invalidate_edges dropped by scanning the frontiers of every entry.
+    """
+    stale = set()
+    for head, rel, tail in edge_list:
+        for step_rel, step_head in ((rel, head), (_reverse_relation(rel), tail)):
+            for (rels, node), (neighs, frontiers, size) in cache.entries.items():
+                for i, r in enumerate(rels):
+                    if r == step_rel and ((i == 0 and node == step_head) or
+                                          (0 < i <= len(frontiers) and step_head in frontiers[i-1])):
+                        stale.add((rels, node))
+    return stale
+
+
+def warm(g, node_ids):
+    for rels in METAPATHS:
+        for node in node_ids[rels[0][0]]:
+            g.get_metapath_neighs(node, rels)
+
+
+@pytest.mark.parametrize("csr", [False, True])
+@pytest.mark.parametrize("graph_cls", [graph.Graph, pref_graph.Graph])
+def test_invalidation_matches_frontier_scan(graph_data, graph_cls, csr):
+    relations, adj_lists, node_ids = graph_data
+    g_adj_lists = CSRAdjLists.from_adj_lists(adj_lists) if csr else copy_adj_lists(adj_lists)
+    g = graph_cls(None, None, relations, g_adj_lists)
+    reference = copy_adj_lists(adj_lists)
+    warm(g, node_ids)
+    rng = random.Random(0)
+    edges = [(head, rel, tail) for rel in sorted(adj_lists) for head in sorted(adj_lists[rel])
+             for tail in sorted(adj_lists[rel][head])]
+    for _ in range(5):
+        removed = rng.sample(edges, 15)
+        edges = sorted(set(edges) - set(removed))
+        for head, rel, tail in removed:
+            reference[rel][head].discard(tail)
+            reference[_reverse_relation(rel)][tail].discard(head)
+        cached = set(g.meta_neighs.entries)
+        stale = scan_stale(g.meta_neighs, removed)
+        invalidations = g.meta_neighs.invalidations
+        g.remove_edges(removed)
+        assert set(g.meta_neighs.entries) == cached - stale
+        assert g.meta_neighs.invalidations - invalidations == len(stale)
+        # the entries kept are still exact, and the dropped ones are recomputed on the new graph
+        for rels, node in cached:
+            assert set(g.get_metapath_neighs(node, rels)) == metapath_neighs(reference, node, rels)
+    assert sum(len(keys) for keys in g.meta_neighs.by_head.values()) > 0
+    g.meta_neighs.clear()
+    assert len(g.meta_neighs.by_head) == 0
+
+
+def test_index_follows_eviction():
+    cache = MetapathCache(max_entries=2)
+    rels = (("a", "r", "b"), ("b", "s", "c"))
+    cache.put(rels, 1, set([5]), [set([2, 3])])
+    cache.put(rels, 2, set([6]), [set([3, 4])])
+    cache.put(rels, 3, set([7]), [set([4])])
+    assert cache.evictions == 1 and not (rels, 1) in cache
+    assert cache.by_head[(rels[1], 4)] == set([(rels, 2), (rels, 3)])
+    assert cache.by_head[(rels[1], 3)] == set([(rels, 2)])
+    assert not (rels[1], 2) in cache.by_head
+    assert cache.invalidate_edges([(3, rels[1], 9)]) == 1
+    assert cache.invalidate_edges([(9, ("c", "s", "b"), 4)]) == 1
+    assert len(cache) == 0 and len(cache.by_head) == 0
+
+
+def test_clear_resets_statistics():
+    cache = MetapathCache(max_entries=1, compress=True)
+    rels = (("a", "r", "b"),)
+    assert cache.get(rels, 1) is None
+    neighs = cache.put(rels, 1, np.array([4, 2, 4]), [])
+    assert isinstance(neighs, SortedIdSet) and list(neighs) == [2, 4]
+    assert cache.get(rels, 1) is neighs
+    cache.put(rels, 2, set([3]), [])
+    cache.invalidate_edges([(2, rels[0], 3)])
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["invalidations"]) == (1, 1, 1, 1)
+    cache.clear()
+    assert list(cache.stats().values()) == [0, 0, 0, 0, 0., 0, 0]
+
+
+@pytest.mark.parametrize("csr", [False, True])
+@pytest.mark.parametrize("graph_cls", [graph.Graph, pref_graph.Graph])
+def test_prefetch_matches_expansion(graph_data, graph_cls, csr):
+    relations, adj_lists, node_ids = graph_data
+    g_adj_lists = CSRAdjLists.from_adj_lists(adj_lists) if csr else copy_adj_lists(adj_lists)
+    g = graph_cls(None, None, relations, g_adj_lists)
+    expanded = graph_cls(None, None, relations, copy_adj_lists(adj_lists))
+    paths = [(node, rels) for rels in METAPATHS for node in node_ids[rels[0][0]]]
+    random.Random(1).shuffle(paths)
+    g.prefetch_metapath_neighs(paths + paths[:10], chunk_size=13)
+    assert len(g.meta_neighs) == len(paths)
+    warm(expanded, node_ids)
+    for key, (neighs, frontiers, size) in expanded.meta_neighs.entries.items():
+        assert set(g.meta_neighs.entries[key][0]) == set(neighs)
+        assert [set(f.tolist()) for f in g.meta_neighs.entries[key][1]] == \
+               [set(f.tolist()) for f in frontiers]
+    # prefetched entries are served as hits, and invalidated like expanded ones
+    misses = g.meta_neighs.misses
+    for node, rels in paths:
+        assert set(g.get_metapath_neighs(node, rels)) == set(expanded.get_metapath_neighs(node, rels))
+    assert g.meta_neighs.misses == misses
+    removed = random.Random(2).sample(sorted((head, rel, tail) for rel in adj_lists for head in adj_lists[rel]
+                                             for tail in adj_lists[rel][head]), 20)
+    stale = scan_stale(g.meta_neighs, removed)
+    g.remove_edges(removed)
+    expanded.remove_edges(removed)
+    expected = set((rels, node) for node, rels in paths) - stale
+    assert set(g.meta_neighs.entries) == set(expanded.meta_neighs.entries) == expected
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("num_heads", [100, 10**6])
+def test_nbytes_tracks_footprint(compress, num_heads):
+    rng = random.Random(0)
+    rels = (("a", "r", "b"), ("b", "s", "c"), ("c", "t", "d"))
+    paths = [(node, rng.sample(range(10**6), 30), [np.asarray(rng.sample(range(num_heads), 20)),
+                                                   np.asarray(rng.sample(range(num_heads), 40))])
+             for node in range(2000)]
+    cache = MetapathCache(compress=compress)
+    tracemalloc.start()
+    for node, neighs, frontiers in paths:
+        cache.put(rels, node, set(neighs), frontiers)
+    footprint = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # the estimate counts the (rel, head) index along with the entries
+    assert 0.5 < footprint / float(cache.nbytes) < 2
+    cache.invalidate_edges([(node, rels[0], 0) for node, neighs, frontiers in paths])
+    assert len(cache) == 0 and cache.nbytes == 0
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+from scipy import stats
+from sklearn.metrics import roc_auc_score
+
+from netquery.metrics import RankingMetrics, auc_score, percentile_scores, ranking_metrics
+from netquery.utils import _get_perc_scores
+
+
+def ragged_scores(seed, num_queries=50, max_len=12, levels=5):
+    """
+    Scores drawn from a few levels so that many of them are tied.
+    """
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(1, max_len, size=num_queries).tolist()
+    pos = rng.randint(levels, size=num_queries).astype(np.float64)
+    neg = rng.randint(levels, size=sum(lengths)).astype(np.float64)
+    return pos, neg, lengths
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_percentile_scores_match_scipy(seed):
+    pos, neg, lengths = ragged_scores(seed)
+    offsets = np.cumsum([0] + lengths)
+    expected = [stats.percentileofscore(neg[offsets[i]:offsets[i + 1]], pos[i]) for i in range(len(lengths))]
+    got = percentile_scores(torch.tensor(pos), torch.tensor(neg), lengths)
+    assert np.allclose(got.numpy(), expected)
+    assert np.allclose(_get_perc_scores(np.concatenate([pos, neg]).tolist(), lengths), expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_per_query_auc_matches_sklearn(seed):
+    pos, neg, lengths = ragged_scores(seed)
+    offsets = np.cumsum([0] + lengths)
+    metrics = ranking_metrics(torch.tensor(pos), torch.tensor(neg), lengths)
+    for i in range(len(lengths)):
+        scores = np.concatenate([[pos[i]], neg[offsets[i]:offsets[i + 1]]])
+        labels = [1] + [0] * lengths[i]
+        assert np.isclose(metrics["auc"][i].item(), roc_auc_score(labels, scores))
+        rank = 1 + (scores[1:] > pos[i]).sum() + 0.5 * (scores[1:] == pos[i]).sum()
+        assert np.isclose(metrics["rr"][i].item(), 1.0 / rank)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_auc_score_matches_sklearn(seed):
+    rng = np.random.RandomState(seed)
+    scores = rng.randint(6, size=200).astype(np.float64)
+    scores[rng.rand(200) < 0.05] = np.nan
+    labels = rng.rand(200) < 0.4
+    assert np.isclose(auc_score(scores, labels), roc_auc_score(labels, np.nan_to_num(scores)))
+
+
+def test_summary_is_mean_over_batches():
+    metrics = RankingMetrics()
+    expected = []
+    for seed in range(3):
+        pos, neg, lengths = ragged_scores(seed)
+        metrics.add("a", torch.tensor(pos), torch.tensor(neg), lengths)
+        expected.extend(percentile_scores(torch.tensor(pos), torch.tensor(neg), lengths).tolist())
+    summary = metrics.summary()
+    assert np.isclose(summary["a"]["perc"], np.mean(expected))
+    assert np.isclose(summary["all"]["perc"], np.mean(expected))
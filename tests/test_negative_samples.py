@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+from netquery import graph, pref_graph
+from netquery.csr_graph import CSRAdjLists
+from tests.conftest import copy_adj_lists
+
+QUERY_TYPES = ["2-chain", "2-inter", "3-chain", "3-inter", "3-inter_chain", "3-chain_inter"]
+
+
+def _reverse_relation(rel):
+    return (rel[-1], rel[1], rel[0])
+
+
+def metapath_neighs(adj_lists, node, rels):
+    current_set = [node]
+    for rel in rels:
+        current_set = set([neigh for n in current_set for neigh in adj_lists[rel][n]])
+    return current_set
+
+
+def set_negative_samples(adj_lists, full_sets, query):
+    """
+    get_negative_samples as it was computed with python sets, before the bitsets.
+    """
+    full_set = full_sets[query[1][1][0]]
+    if query[0] == "3-chain" or query[0] == "2-chain":
+        rels = [_reverse_relation(edge[1]) for edge in query[1:][::-1]]
+        neg_samples = full_set - metapath_neighs(adj_lists, query[-1][-1], tuple(rels))
+        return (neg_samples, None) if len(neg_samples) > 0 else (None, None)
+    if query[0] == "2-inter" or query[0] == "3-inter":
+        anchor_neighs = [set(adj_lists[_reverse_relation(query[i][1])][query[i][-1]]) for i in range(1, len(query))]
+        inter_neighs = set.intersection(*anchor_neighs)
+        union_neighs = set.union(*anchor_neighs)
+    elif query[0] == "3-inter_chain":
+        neighs = set(adj_lists[_reverse_relation(query[1][1])][query[1][-1]])
+        chain_rels = [_reverse_relation(edge[1]) for edge in query[2][::-1]]
+        chain_neighs = metapath_neighs(adj_lists, query[2][-1][-1], tuple(chain_rels))
+        inter_neighs = neighs & chain_neighs
+        union_neighs = neighs | chain_neighs
+    elif query[0] == "3-chain_inter":
+        inter_neighs_1 = set(adj_lists[_reverse_relation(query[-1][0][1])][query[-1][0][-1]])
+        inter_neighs_2 = set(adj_lists[_reverse_relation(query[-1][1][1])][query[-1][1][-1]])
+        rel = _reverse_relation(query[1][1])
+        inter_neighs = set([n for neigh in inter_neighs_1 & inter_neighs_2 for n in adj_lists[rel][neigh]])
+        union_neighs = set([n for neigh in inter_neighs_1 | inter_neighs_2 for n in adj_lists[rel][neigh]])
+    neg_samples = full_set - inter_neighs
+    hard_neg_samples = union_neighs - inter_neighs
+    if len(neg_samples) == 0 or len(hard_neg_samples) == 0:
+        return None, None
+    return neg_samples, hard_neg_samples
+
+
+def sample_query_graphs(g, num_per_type=40):
+    random.seed(3)
+    query_graphs = []
+    for query_type in QUERY_TYPES:
+        for _ in range(num_per_type):
+            query_graph = g.sample_query_subgraph_bytype(query_type)
+            if not query_graph is None:
+                query_graphs.append(query_graph)
+    return query_graphs
+
+
+@pytest.mark.parametrize("csr", [False, True])
+@pytest.mark.parametrize("graph_cls", [graph.Graph, pref_graph.Graph])
+def test_bitset_negatives_match_sets(graph_data, graph_cls, csr):
+    relations, adj_lists, node_ids = graph_data
+    g_adj_lists = CSRAdjLists.from_adj_lists(adj_lists) if csr else copy_adj_lists(adj_lists)
+    g = graph_cls(None, None, relations, g_adj_lists)
+    full_sets = {mode: set(nodes) for mode, nodes in g.full_sets.items()}
+    query_graphs = sample_query_graphs(g)
+    assert len(set(query_graph[0] for query_graph in query_graphs)) == len(QUERY_TYPES)
+    for query_graph in query_graphs:
+        negatives = g.get_negative_samples(query_graph)
+        assert all(samples is None or isinstance(samples, list) for samples in negatives)
+        assert tuple(None if samples is None else set(samples) for samples in negatives) == \
+               set_negative_samples(adj_lists, full_sets, query_graph)
+
+
+@pytest.mark.parametrize("graph_cls", [graph.Graph, pref_graph.Graph])
+def test_bitset_negatives_sampled(graph_data, graph_cls):
+    relations, adj_lists, node_ids = graph_data
+    g = graph_cls(None, None, relations, copy_adj_lists(adj_lists))
+    full_sets = {mode: set(nodes) for mode, nodes in g.full_sets.items()}
+    for query_graph in sample_query_graphs(g, 10):
+        neg_samples, hard_neg_samples = set_negative_samples(adj_lists, full_sets, query_graph)
+        sampled, hard_sampled = g.get_negative_samples(query_graph, neg_sample_max=5)
+        assert all(samples is None or isinstance(samples, list) for samples in (sampled, hard_sampled))
+        if neg_samples is None:
+            assert sampled is None and hard_sampled is None
+            continue
+        for samples, full in [(sampled, neg_samples), (hard_sampled, hard_neg_samples)]:
+            if full is None:
+                assert samples is None
+                continue
+            assert len(samples) == min(5, len(full))
+            assert len(set(samples)) == len(samples)
+            assert set(samples) <= full
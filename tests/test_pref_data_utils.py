@@ -0,0 +1,80 @@
+import pickle
+import random
+
+import numpy as np
+
+from netquery.pref_data_utils import PREF_TYPES, _pref_key, _shard_seed, load_prefs_by_formula, \
+    load_prefs_columnar, parallel_sample_prefs, save_prefs_columnar
+from netquery.pref_graph import Graph
+from tests.conftest import copy_adj_lists
+
+
+def test_shard_seeds_are_distinct():
+    seeds = [_shard_seed(seed, graph_name, i, shard)
+             for seed in range(3) for graph_name in ["train", "test"]
+             for i in range(len(PREF_TYPES)) for shard in range(4)]
+    assert len(set(seeds)) == len(seeds)
+    assert _shard_seed(0, "train", 1, 2) == _shard_seed(0, "train", 1, 2)
+
+
+def test_train_and_test_draw_different_streams(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    train = parallel_sample_prefs(graph, 40, seed=0, shard_size=20, graph_name="train")
+    test = parallel_sample_prefs(graph, 40, seed=0, shard_size=20, graph_name="test")
+    for pref_type in PREF_TYPES:
+        train_keys = [_pref_key(pref) for pref in train[pref_type]]
+        test_keys = [_pref_key(pref) for pref in test[pref_type]]
+        assert train_keys != test_keys
+
+
+def test_result_does_not_depend_on_workers(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    serial = parallel_sample_prefs(graph, 30, num_workers=1, seed=3, shard_size=10)
+    pooled = parallel_sample_prefs(graph, 30, num_workers=2, seed=3, shard_size=10)
+    for pref_type in PREF_TYPES:
+        assert [pref.serialize() for pref in serial[pref_type]] == [pref.serialize() for pref in pooled[pref_type]]
+
+
+def test_sampling_keeps_the_caller_random_state(graph_data):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    random.seed(11)
+    np.random.seed(11)
+    expected = (random.random(), np.random.random())
+    random.seed(11)
+    np.random.seed(11)
+    parallel_sample_prefs(graph, 10, num_workers=1, seed=3)
+    assert (random.random(), np.random.random()) == expected
+
+
+def test_columnar_prefs_match_pickled_prefs(graph_data, tmp_path):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    prefs = [pref for pref_type, type_prefs in parallel_sample_prefs(graph, 10, seed=1).items() for pref in type_prefs]
+    pickle.dump([pref.serialize() for pref in prefs], open(str(tmp_path / "prefs.pkl"), "wb"))
+    save_prefs_columnar(prefs, str(tmp_path / "columnar"))
+    id_maps = {mode: {node: i for i, node in enumerate(sorted(nodes))} for mode, nodes in node_ids.items()}
+    for maps in [None, id_maps]:
+        by_formula = load_prefs_by_formula(str(tmp_path / "prefs.pkl"), id_maps=maps)
+        columnar = load_prefs_columnar(str(tmp_path / "columnar"), id_maps=maps, cache_size=8)
+        assert set(columnar.keys()) == set(by_formula.keys())
+        for pref_type in by_formula:
+            assert set(columnar[pref_type].keys()) == set(by_formula[pref_type].keys())
+            for formula, expected in by_formula[pref_type].items():
+                got = columnar[pref_type][formula]
+                assert [pref.serialize() for pref in got] == [pref.serialize() for pref in expected]
+                assert [pref.serialize() for pref in got[1:4]] == [pref.serialize() for pref in expected[1:4]]
+                assert all(pref.formula is formula for pref in got)
+
+
+def test_columnar_prefs_reuse_built_objects(graph_data, tmp_path):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    save_prefs_columnar(parallel_sample_prefs(graph, 10, seed=1)["UIUP-2"], str(tmp_path))
+    formula_prefs = next(iter(load_prefs_columnar(str(tmp_path), cache_size=4)["UIUP-2"].values()))
+    batch = formula_prefs[0:3]
+    assert all(formula_prefs[j] is pref for j, pref in enumerate(batch))
+    formula_prefs[3:len(formula_prefs)]
+    assert len(formula_prefs.cache) == min(4, len(formula_prefs))
@@ -0,0 +1,45 @@
+import pytest
+import torch
+from torch_geometric.utils import dense_to_sparse
+
+from netquery.pref_data_utils import PREF_TYPES
+from netquery.pref_graph import PrefFormula, SingleValPreference
+
+ATTRIBUTES = (("drug", "targets", "protein"), ("drug", "treats", "disease"), ("drug", "causes", "sideeffects"))
+
+
+def dense_batch_graph(formula, batch_size):
+    """
+    The batched graph as run_train and run_eval built it before PrefFormula.batch_graph.
+    """
+    edge_idx, edge_type = dense_to_sparse(torch.Tensor([formula.edge_index for _ in range(batch_size)]))
+    batch = []
+    mask = []
+    for j in range(batch_size):
+        batch += [j for _ in range(len(formula.edge_index))]
+        mask += [1] + [0 for _ in range(len(formula.edge_index) - 1)]
+    return edge_idx, edge_type, torch.LongTensor(batch), torch.LongTensor(mask)
+
+
+@pytest.mark.parametrize("pref_type", PREF_TYPES)
+def test_batch_graph_matches_dense_to_sparse(pref_type):
+    formula = PrefFormula.get(pref_type, ATTRIBUTES)
+    for batch_size in [1, 3, 7]:
+        for got, expected in zip(formula.batch_graph(batch_size), dense_batch_graph(formula, batch_size)):
+            assert torch.equal(got, expected.to(got.dtype))
+
+
+def test_batch_graph_cache_follows_edge_index():
+    formula = PrefFormula("UIUP-2", ATTRIBUTES)
+    graph = formula.batch_graph(4)
+    assert formula.batch_graph(4) is graph
+    formula.edge_index = formula.reverse_edge_idx
+    for got, expected in zip(formula.batch_graph(4), dense_batch_graph(formula, 4)):
+        assert torch.equal(got, expected.to(got.dtype))
+
+
+def test_formulas_are_interned():
+    prefs = [SingleValPreference("UIUP-2", [list(att) for att in ATTRIBUTES[:2]], [i, i + 1]) for i in range(3)]
+    assert all(pref.formula is prefs[0].formula for pref in prefs)
+    assert prefs[0].formula is PrefFormula.get("UIUP-2", ATTRIBUTES)
+    assert PrefFormula.get("UIUP-3", ATTRIBUTES) is not PrefFormula.get("UIUP-3-reverse", ATTRIBUTES)
@@ -0,0 +1,136 @@
+import pytest
+import torch
+import torch.nn.functional as F
+import torch_geometric
+from torch_geometric.nn import global_add_pool
+
+from netquery.bio.data_utils import load_graph
+from netquery.model import QueryEncoderDecoder
+from netquery.pref_data_utils import PREF_TYPES, parallel_sample_prefs
+from netquery.pref_graph import Graph
+from netquery.pref_model import PrefRGCN
+from netquery.utils import get_encoder, get_intersection_decoder, get_metapath_decoder
+from tests.conftest import copy_adj_lists
+
+# the batched graphs carry float edge types (as dense_to_sparse gave them), which
+# RGCNConv only takes on its per-relation path
+torch_geometric.backend.use_segment_matmul = False
+
+
+def build_model(data_dir, embed_dim=16, hidden=12, dense=False):
+    torch.manual_seed(0)
+    graph, feature_modules, node_maps = load_graph(data_dir, embed_dim, dense=dense)
+    out_dims = {mode: embed_dim for mode in graph.relations}
+    enc = get_encoder(0, graph, out_dims, feature_modules, False)
+    dec = get_metapath_decoder(graph, out_dims, "bilinear")
+    inter_dec = get_intersection_decoder(graph, out_dims, "mean")
+    model = PrefRGCN(QueryEncoderDecoder(graph, enc, dec, inter_dec), "bilinear", embed_dim, hidden)
+    return model, feature_modules, node_maps
+
+
+def sample_formula_prefs(graph_data, num_samples=8):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    prefs = parallel_sample_prefs(graph, num_samples, seed=2)
+    by_formula = {}
+    for pref_type in PREF_TYPES:
+        for pref in prefs[pref_type]:
+            by_formula.setdefault(pref.formula, []).append(pref)
+    return by_formula
+
+
+def dense_node_features(model, formula, prefs):
+    """
+    Node features [node_num, bs, emb_dim] as contrast_loss and forward built them by
+    repeating the embeddings over every node of every graph.
+    """
+    atts = formula.attributes
+    node_num = formula.node_num
+    emb = 0
+    for i in range(len(atts)):
+        node_embeds = model.gq_model.enc.forward([pref.values[i] for pref in prefs], atts[i][-1]).t() \
+            .unsqueeze(0).repeat(node_num, 1, 1)
+        rel_embeds = model.rel_proj(model.gq_model.path_dec.mats[atts[i]]).t().unsqueeze(0) \
+            .repeat(node_num, len(prefs), 1)
+        emb = emb + rel_embeds * formula.rel_pos[i].unsqueeze(-1).unsqueeze(-1) + \
+              node_embeds * (formula.vec_p_pos[i] + formula.vec_n_pos[i]).unsqueeze(-1).unsqueeze(-1)
+    return emb
+
+
+def dense_view(model, formula, emb, p_pos, n_pos):
+    x = model.positive_proj(emb) * p_pos.unsqueeze(-1).unsqueeze(-1) + \
+        model.negative_proj(emb) * n_pos.unsqueeze(-1).unsqueeze(-1) + \
+        model.other_proj(emb) * formula.vec_e_pos.unsqueeze(-1).unsqueeze(-1)
+    return x.transpose(1, 0).reshape(emb.size(0) * emb.size(1), -1)
+
+
+def dense_encode(model, x, edge_index, edge_type, batch, mask=None):
+    x = F.relu(model.conv1(x, edge_index, edge_type))
+    x = F.relu(model.conv2(x, edge_index, edge_type))
+    x = model.conv3(x, edge_index, edge_type)
+    return global_add_pool(x if mask is None else x * mask.unsqueeze(-1), batch)
+
+
+def dense_contrast_loss(model, formula, prefs, edge_index, edge_type, batch, mask):
+    emb = dense_node_features(model, formula, prefs)
+    x = dense_encode(model, dense_view(model, formula, emb, formula.p_pos, formula.n_pos),
+                     edge_index, edge_type, batch, mask)
+    x1 = dense_encode(model, dense_view(model, formula, emb, formula.n_pos, formula.p_pos),
+                      edge_index, edge_type, batch, mask)
+    return (1 + model.cos(x, x1)).mean()
+
+
+@pytest.fixture
+def model(data_dir):
+    return build_model(data_dir)[0]
+
+
+def test_contrast_loss_matches_two_pass(model, graph_data):
+    for formula, prefs in sample_formula_prefs(graph_data).items():
+        graph = formula.batch_graph(len(prefs))
+        fused = model.contrast_loss(formula, prefs, *graph)
+        two_pass = model.contrast_loss(formula, prefs, *graph, fused=False)
+        expected = dense_contrast_loss(model, formula, prefs, *graph)
+        assert torch.allclose(fused, two_pass, atol=1e-5)
+        assert torch.allclose(fused, expected, atol=1e-5)
+
+
+def dense_forward(model, formula, prefs, edge_index, edge_type, batch, targets):
+    targets_embeds = model.gq_model.enc.forward(targets, formula.attributes[0][0]).t()
+    emb = dense_node_features(model, formula, prefs)
+    x = dense_encode(model, dense_view(model, formula, emb, formula.p_pos, formula.n_pos),
+                     edge_index, edge_type, batch)
+    return (model.reproj(x) * targets_embeds).sum(-1)
+
+
+def test_scattered_features_match_dense_repeat(model, graph_data):
+    for formula, prefs in sample_formula_prefs(graph_data).items():
+        layout = formula.node_layout(None)
+        emb = model._embed_nodes(formula, prefs, layout)
+        dense = dense_node_features(model, formula, prefs)
+        assert torch.allclose(emb, dense.transpose(1, 0).reshape(emb.shape), atol=1e-6)
+        x = model._project_nodes(emb, layout, len(prefs), formula.node_num, layout["p"], layout["n"])
+        assert torch.allclose(x, dense_view(model, formula, dense, formula.p_pos, formula.n_pos), atol=1e-6)
+
+
+def test_forward_matches_dense_repeat(model, graph_data):
+    for formula, prefs in sample_formula_prefs(graph_data).items():
+        targets = [pref.sampled_entities[-1][0] for pref in prefs]
+        edge_index, edge_type, batch, mask = formula.batch_graph(len(prefs))
+        scores = model.forward(formula, prefs, edge_index, edge_type, batch, mask, targets)
+        expected = dense_forward(model, formula, prefs, edge_index, edge_type, batch, targets)
+        assert torch.allclose(scores, expected, atol=1e-5)
+
+
+def test_pooled_scores_match_per_target_forward(model, graph_data):
+    for formula, prefs in sample_formula_prefs(graph_data).items():
+        pref_vecs = model.encode_preferences(formula, prefs)
+        for level in range(len(prefs[0].sampled_entities)):
+            # every entity of the level against its preference, as run_eval scored them
+            index = [i for i, pref in enumerate(prefs) for _ in pref.sampled_entities[level]]
+            targets = [e for pref in prefs for e in pref.sampled_entities[level]]
+            scores = model.score(pref_vecs, targets, formula.attributes[0][0], index=index)
+            current_prefs = [prefs[i] for i in index]
+            edge_index, edge_type, batch, mask = formula.batch_graph(len(current_prefs))
+            expected = model.forward(formula, current_prefs, edge_index, edge_type, batch, mask, targets)
+            assert torch.allclose(scores, expected, atol=1e-5)
@@ -0,0 +1,53 @@
+import random
+
+import numpy as np
+import pytest
+
+from netquery.pref_graph import Graph, _PREF_BUCKETS, _bucket_code, _reverse_relation
+from netquery.pref_data_utils import PREF_TYPES, _pref_type_args
+from tests.conftest import copy_adj_lists
+
+
+def check_preference(graph, pref, bucket_max=10):
+    """
+    Checks a sampled preference against the truth-table buckets that
+    sample_singlev_preferences defines: each level holds the entities of its
+    buckets, up to bucket_max of each, and multi-attribute preferences have
+    every bucket non-empty.
+    """
+    mode = pref.attributes[0][0]
+    positives = [graph.adj_lists[_reverse_relation(att)][val] for att, val in zip(pref.attributes, pref.values)]
+    assert all(att[0] == mode for att in pref.attributes)
+    assert all(len(pos) > 0 for pos in positives)
+    assert len(set(pref.attributes)) == len(pref.attributes)
+
+    def code(entity):
+        return sum(1 << i for i, pos in enumerate(positives) if entity in pos)
+
+    bucket_sizes = np.bincount([code(e) for e in graph.full_lists[mode]], minlength=1 << len(positives))
+    levels = _PREF_BUCKETS[pref.pref_type]
+    assert len(pref.sampled_entities) == len(levels)
+    for level, entities in zip(levels, pref.sampled_entities):
+        assert len(set(entities)) == len(entities)
+        assert set(entities) <= graph.full_sets[mode]
+        codes = [_bucket_code(bucket) for bucket in level.split("+")]
+        assert all(code(e) in codes for e in entities)
+        for c in codes:
+            assert sum(code(e) == c for e in entities) == min(bucket_sizes[c], bucket_max)
+    if len(positives) > 1:
+        assert (bucket_sizes > 0).all()
+
+
+@pytest.mark.parametrize("pref_type", PREF_TYPES)
+@pytest.mark.parametrize("batch_size", [None, 256])
+def test_sampled_preferences_match_buckets(graph_data, pref_type, batch_size):
+    relations, adj_lists, node_ids = graph_data
+    graph = Graph(None, None, relations, copy_adj_lists(adj_lists))
+    num_pref_atts, entity_type = _pref_type_args(pref_type)
+    random.seed(0)
+    np.random.seed(0)
+    prefs = graph.sample_singlev_preferences(entity_type, pref_type, num_pref_atts, 30, 10,
+                                             verbose=False, batch_size=batch_size)
+    assert len(prefs) == 30
+    for pref in prefs:
+        check_preference(graph, pref)
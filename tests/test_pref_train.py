@@ -0,0 +1,18 @@
+import math
+
+from netquery.bio.pref_train import run_eval
+from netquery.pref_data_utils import PREF_TYPES
+from tests.test_pref_model import build_model, sample_formula_prefs
+
+
+def test_run_eval_without_batches_gives_nan(data_dir, graph_data):
+    model = build_model(data_dir)[0]
+    by_formula = sample_formula_prefs(graph_data)
+    prefs = {}
+    for formula, formula_prefs in by_formula.items():
+        prefs.setdefault(formula.pref_type, {})[formula] = formula_prefs
+    evaluated = next(iter(prefs))
+    empty = next(pref_type for pref_type in PREF_TYPES if pref_type != evaluated)
+    perc_scores, auc_scores = run_eval(None, model, {evaluated: prefs[evaluated], empty: {}}, 0, None)
+    assert 0 <= perc_scores[evaluated] <= 100
+    assert math.isnan(perc_scores[empty])
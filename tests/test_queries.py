@@ -0,0 +1,71 @@
+import torch
+
+from netquery.data_utils import load_queries_by_formula
+from netquery.graph import QueryList, RaggedTensor
+from netquery.model import _sample_negatives
+from tests.conftest import build_enc_dec, sample_query_file
+
+
+def test_formulas_are_packed_at_load_time(graph_data, tmp_path):
+    graph, queries = sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    loaded = load_queries_by_formula(str(tmp_path / "queries.pkl"))
+    formula_lists = [formula_queries for by_formula in loaded.values() for formula_queries in by_formula.values()]
+    assert len(formula_lists) > 1
+    assert all(isinstance(q, QueryList) and not q._batch is None for q in formula_lists)
+
+
+def test_lazy_formulas_are_packed_on_first_use(graph_data, tmp_path):
+    graph, queries = sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    loaded = load_queries_by_formula(str(tmp_path / "queries.pkl"), lazy=True)
+    formula_lists = [formula_queries for by_formula in loaded.values() for formula_queries in by_formula.values()]
+    assert len(formula_lists) > 1
+    assert all(isinstance(q, QueryList) and q._batch is None for q in formula_lists)
+    first = formula_lists[0]
+    first[0:5].batch
+    assert first._batch is not None
+    assert all(q._batch is None for q in formula_lists[1:])
+
+
+def test_packed_negatives_match_queries(graph_data, tmp_path):
+    graph, queries = sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    loaded = load_queries_by_formula(str(tmp_path / "queries.pkl"))
+    for by_formula in loaded.values():
+        for formula, formula_queries in by_formula.items():
+            for start, stop in [(0, len(formula_queries)), (1, 4), (3, 3)]:
+                batch = formula_queries[start:stop]
+                assert list(batch) == list(formula_queries)[start:stop]
+                for i, query in enumerate(batch):
+                    assert batch.neg_samples[i].tolist() == list(query.neg_samples)
+                    assert batch.batch.target_nodes[i].item() == query.target_node
+                    assert tuple(batch.batch.anchor_nodes[i].tolist()) == query.anchor_nodes
+            if formula.query_type != "1-chain" and len(formula_queries) > 0:
+                torch.manual_seed(0)
+                negatives = _sample_negatives(graph, formula, formula_queries)
+                assert all(n in query.neg_samples for n, query in zip(negatives.tolist(), formula_queries))
+
+
+def test_ragged_tensor_rows():
+    rows = [[1, 2, 3], None, [4], [5, 6]]
+    ragged = RaggedTensor.from_lists(rows)
+    assert len(ragged) == 4
+    assert [ragged[i].tolist() for i in range(4)] == [[1, 2, 3], [], [4], [5, 6]]
+    assert ragged.lengths().tolist() == [3, 0, 1, 2]
+    tail = ragged[2:4]
+    assert [tail[i].tolist() for i in range(len(tail))] == [[4], [5, 6]]
+    assert tail.values is ragged.values
+    assert len(ragged[3:1]) == 0
+    picks = ragged[2:4].sample(torch.Generator().manual_seed(0)).tolist()
+    assert picks[0] == 4 and picks[1] in (5, 6)
+
+
+def test_query_list_forward_matches_query_objects(graph_data, data_dir, tmp_path):
+    enc_dec = build_enc_dec(data_dir)
+    sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    for by_formula in load_queries_by_formula(str(tmp_path / "queries.pkl")).values():
+        for formula, formula_queries in by_formula.items():
+            batch = formula_queries[0:10]
+            targets = [q.target_node for q in batch]
+            with torch.no_grad():
+                packed = enc_dec.forward(formula, batch, targets)
+                expected = enc_dec.forward(formula, list(batch), targets)
+            assert torch.allclose(packed, expected, atol=1e-6)
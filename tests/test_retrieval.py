@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import torch
+
+from netquery.retrieval import IVFPQIndex, build_entity_indexes, retrieve
+from tests.test_pref_model import build_model, sample_formula_prefs
+
+
+@pytest.mark.parametrize("dense", [False, True])
+def test_retrieved_ids_are_graph_ids(data_dir, graph_data, dense):
+    model, feature_modules, node_maps = build_model(data_dir, dense=dense)
+    graph = model.gq_model.graph
+    indexes = build_entity_indexes(feature_modules, node_maps, dense=dense)
+    for formula, prefs in list(sample_formula_prefs(graph_data).items())[:6]:
+        if dense:
+            prefs = [pref.remap(node_maps) for pref in prefs]
+        mode = formula.attributes[0][0]
+        ids, scores = retrieve(model, formula, prefs, indexes, k=5)
+        assert set(ids.reshape(-1).tolist()) <= graph.full_sets[mode]
+        with torch.no_grad():
+            pref_vecs = model.encode_preferences(formula, prefs)
+            for j in range(ids.shape[1]):
+                expected = model.score(pref_vecs, ids[:, j].tolist(), mode).numpy()
+                assert np.allclose(scores[:, j], expected, atol=1e-5)
+            candidates = sorted(graph.full_sets[mode])
+            all_scores = torch.stack([model.score(pref_vecs, [e] * len(prefs), mode) for e in candidates], dim=1)
+        assert np.allclose(scores[:, 0], all_scores.max(dim=1)[0].numpy(), atol=1e-5)
+
+
+def test_ivfpq_with_every_list_probed_is_exact():
+    rng = np.random.RandomState(0)
+    embeds = rng.randn(500, 16).astype(np.float32)
+    queries = rng.randn(20, 16).astype(np.float32)
+    index = IVFPQIndex(np.arange(500) + 1000, embeds, num_lists=8, num_subspaces=4, num_codes=16)
+    ids, scores = index.search(queries, k=5, n_probe=8)
+    expected = np.sort(queries.dot(embeds.T), axis=1)[:, ::-1][:, :5]
+    assert np.allclose(scores, expected, atol=1e-5)
+    assert np.allclose((queries[:, None, :] * embeds[ids - 1000]).sum(-1), scores, atol=1e-5)
+
+
+def pq_scores(index, queries, ids):
+    """
+    Scores the product quantization gives the entities ids: the query against the centroid
+    of their list plus the codewords of their residuals.
+    """
+    rows = np.argsort(index.ids)[np.searchsorted(np.sort(index.ids), ids)]
+    lists = np.searchsorted(index.list_ptr, rows, side="right") - 1
+    approx = index.centroids[lists] + np.concatenate(
+        [index.codebooks[m][index.codes[rows, m]] for m in range(index.num_subspaces)], axis=-1)
+    return (queries[:, None, :] * approx).sum(-1)
+
+
+def test_ivfpq_quantized_search_recall():
+    rng = np.random.RandomState(0)
+    embeds = rng.randn(2000, 16).astype(np.float32)
+    queries = rng.randn(50, 16).astype(np.float32)
+    exact = np.argsort(-queries.dot(embeds.T), axis=1)[:, :10]
+    index = IVFPQIndex(np.arange(2000) + 1000, embeds, num_lists=16, num_subspaces=8, num_codes=64,
+                       keep_embeds=False)
+    kept = IVFPQIndex(np.arange(2000) + 1000, embeds, num_lists=16, num_subspaces=8, num_codes=64)
+    for n_probe, min_recall in [(16, 0.7), (4, 0.6)]:
+        ids, scores = index.search(queries, k=10, n_probe=n_probe)
+        assert (ids >= 1000).all() and (ids < 3000).all()
+        assert (np.diff(scores, axis=1) <= 1e-6).all()
+        assert np.allclose(scores, pq_scores(index, queries, ids), atol=1e-4)
+        recall = np.mean([len(set((row - 1000).tolist()) & set(best.tolist())) / 10.
+                          for row, best in zip(ids, exact)])
+        assert recall >= min_recall
+        # without rerank, an index keeping the embeddings answers from the codes alike
+        kept_ids, kept_scores = kept.search(queries, k=10, n_probe=n_probe, rerank=False)
+        assert np.array_equal(kept_ids, ids)
+        assert np.allclose(kept_scores, scores)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch
+
+from netquery.data_utils import load_queries_by_formula
+from netquery.snapshot import EmbeddingSnapshot, materialize
+from tests.conftest import build_enc_dec, sample_query_file
+from tests.test_pref_model import build_model, sample_formula_prefs
+
+
+@pytest.mark.parametrize("dtype,atol", [(np.float32, 1e-7), (np.float16, 1e-3)])
+def test_snapshot_matches_encoder(data_dir, graph_data, tmp_path, dtype, atol):
+    relations, adj_lists, node_ids = graph_data
+    enc_dec = build_enc_dec(data_dir)
+    snapshot_dir = str(tmp_path / "snapshot")
+    snapshot = materialize(enc_dec.enc, node_ids, snapshot_dir, dtype=dtype, batch_size=7)
+    for mmap_mode in ["r", None]:
+        reread = EmbeddingSnapshot(snapshot_dir, mmap_mode=mmap_mode)
+        for mode, nodes in node_ids.items():
+            nodes = nodes[::-3] + nodes[:2]
+            with torch.no_grad():
+                expected = enc_dec.enc.forward(nodes, mode)
+            for snap in [snapshot, reread]:
+                embeds = snap(torch.LongTensor(nodes), mode)
+                assert embeds.size() == expected.size()
+                assert torch.allclose(embeds, expected, atol=atol)
+
+
+def test_snapshot_missing_nodes(data_dir, graph_data, tmp_path):
+    relations, adj_lists, node_ids = graph_data
+    enc_dec = build_enc_dec(data_dir)
+    snapshot = materialize(enc_dec.enc, {"drug": node_ids["drug"][:10]}, str(tmp_path / "snapshot"))
+    assert snapshot(node_ids["drug"][:10], "drug").size(1) == 10
+    assert snapshot([], "drug").size(1) == 0
+    for nodes in [node_ids["drug"][9:11], [-1], [10**6]]:
+        with pytest.raises(Exception, match="missing"):
+            snapshot(nodes, "drug")
+
+
+def test_snapshot_scores_match_encoder(data_dir, graph_data, tmp_path):
+    relations, adj_lists, node_ids = graph_data
+    enc_dec = build_enc_dec(data_dir)
+    sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    snapshot = materialize(enc_dec.enc, node_ids, str(tmp_path / "snapshot"))
+    with torch.no_grad():
+        for by_formula in load_queries_by_formula(str(tmp_path / "queries.pkl")).values():
+            for formula, formula_queries in by_formula.items():
+                batch = formula_queries[0:10]
+                targets = [q.target_node for q in batch]
+                enc_dec.use_snapshot(None)
+                expected = enc_dec.forward(formula, batch, targets)
+                enc_dec.use_snapshot(snapshot)
+                assert torch.allclose(enc_dec.forward(formula, batch, targets), expected, atol=1e-6)
+
+
+def test_snapshot_preference_scores_match_encoder(data_dir, graph_data, tmp_path):
+    relations, adj_lists, node_ids = graph_data
+    model = build_model(data_dir)[0]
+    snapshot = materialize(model.gq_model.enc, node_ids, str(tmp_path / "snapshot"))
+    with torch.no_grad():
+        for formula, prefs in sample_formula_prefs(graph_data).items():
+            targets = [pref.sampled_entities[-1][0] for pref in prefs]
+            model.use_snapshot(None)
+            expected = model.score(model.encode_preferences(formula, prefs), targets, formula.attributes[0][0])
+            model.use_snapshot(snapshot)
+            scores = model.score(model.encode_preferences(formula, prefs), targets, formula.attributes[0][0])
+            assert torch.allclose(scores, expected, atol=1e-5)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from netquery.data_utils import load_queries_by_formula
+from netquery.streaming_eval import Prefetcher, StreamingEvaluator
+from netquery.utils import eval_auc_queries, eval_perc_queries
+from tests.conftest import build_enc_dec, sample_query_file
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_streaming_matches_sequential_eval(data_dir, graph_data, tmp_path, prefetch):
+    enc_dec = build_enc_dec(data_dir)
+    sample_query_file(graph_data, str(tmp_path / "queries.pkl"))
+    queries = load_queries_by_formula(str(tmp_path / "queries.pkl"))
+    evaluator = StreamingEvaluator(enc_dec, batch_size=7, prefetch=prefetch, seed=4)
+    for query_type, test_queries in queries.items():
+        overall, per_formula = evaluator.eval_auc(test_queries)
+        expected_overall, expected_per_formula = eval_auc_queries(test_queries, enc_dec, batch_size=7, seed=4)
+        assert np.isclose(overall, expected_overall)
+        assert per_formula.keys() == expected_per_formula.keys()
+        assert all(np.isclose(per_formula[f], expected_per_formula[f]) for f in per_formula)
+        perc, summary = evaluator.eval_perc(test_queries, breakdown=True)
+        expected_perc, expected_summary = eval_perc_queries(test_queries, enc_dec, batch_size=7, breakdown=True)
+        assert np.isclose(perc, expected_perc)
+        assert summary.keys() == expected_summary.keys()
+    stats = evaluator.stats.summary()
+    assert stats["auc"]["queries"] == sum(len(q) for by_formula in queries.values() for q in by_formula.values())
+
+
+def test_prefetcher_raises_generator_errors():
+    def batches():
+        yield 1
+        raise ValueError("bad batch")
+
+    prefetcher = Prefetcher(batches())
+    assert next(prefetcher) == 1
+    with pytest.raises(ValueError):
+        next(prefetcher)
+    prefetcher.close()